@@ -0,0 +1,74 @@
+"""消息格式转换基准：模拟一场辩论每一轮发言前的历史格式化开销
+
+用法（在 backend 目录下）：
+    python benchmarks/bench_message_format.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_format import to_anthropic, to_gemini, to_openai  # noqa: E402
+
+AGENTS = ["DeepSeek", "Qwen", "Doubao"]
+ROUNDS = 10
+REPLY = "这是一段模拟的辩论发言，包含观点、论据和对其他参与者的回应。" * 20
+
+
+def build_debate():
+    """按发言顺序返回每一轮开始前的历史快照"""
+    history = [{"role": "user", "name": "User", "content": "人工智能是否会取代人类工作？"}]
+    snapshots = []
+    for _ in range(ROUNDS):
+        for agent in AGENTS:
+            snapshots.append(list(history))
+            history.append({"role": "assistant", "name": agent, "content": f"{REPLY} ({agent} #{len(history)})"})
+    return snapshots
+
+
+def legacy_openai(messages, system_prompt):
+    """改造前各 Provider 里的写法"""
+    formatted_msgs = [{"role": "system", "content": system_prompt}]
+    for m in messages:
+        role = "user" if m['role'] == "user" else "assistant"
+        content = f"[{m['name']}]: {m['content']}" if m.get('name') else m['content']
+        formatted_msgs.append({"role": role, "content": content})
+    return formatted_msgs
+
+
+def legacy_gemini(messages, system_prompt):
+    history = []
+    for m in messages[:-1]:
+        role = "user" if m['role'] == "user" else "model"
+        content = f"[{m['name']}]: {m['content']}" if m.get('name') else m['content']
+        history.append({"role": role, "parts": [content]})
+    last_msg = messages[-1]
+    last_content = f"[{last_msg['name']}]: {last_msg['content']}" if last_msg.get('name') else last_msg['content']
+    return f"{system_prompt}\n\nContext so far:\n{history}\n\nLatest message:\n{last_content}"
+
+
+def run(label, fn, snapshots, number=20):
+    per_debate = min(timeit.repeat(lambda: [fn(s) for s in snapshots], number=number, repeat=3)) / number
+    print(f"{label:<24} {per_debate * 1000:8.3f} ms / debate ({len(snapshots)} turns)")
+    return per_debate
+
+
+def main():
+    snapshots = build_debate()
+    system_prompt = "You are a helpful assistant in a group debate."
+
+    legacy = run("legacy openai loop", lambda s: legacy_openai(s, system_prompt), snapshots)
+    unified = run("to_openai (cached)", lambda s: to_openai(s, system_prompt), snapshots)
+    run("to_anthropic (cached)", to_anthropic, snapshots)
+    legacy_g = run("legacy gemini prompt", lambda s: legacy_gemini(s, system_prompt), snapshots)
+    unified_g = run("to_gemini (cached)", to_gemini, snapshots)
+
+    legacy_chars = len(legacy_gemini(snapshots[-1], system_prompt))
+    native_chars = sum(len(p) for c in to_gemini(snapshots[-1]) for p in c["parts"]) + len(system_prompt)
+    print(f"\nopenai speedup: {legacy / unified:.1f}x, gemini speedup: {legacy_g / unified_g:.1f}x")
+    print(f"gemini prompt chars on last turn: legacy {legacy_chars}, native {native_chars}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""启动基准：在全新的解释器里导入后端，测量导入耗时、常驻内存和实际加载了哪些 LLM SDK
+
+每个场景各跑 --repeat 次子进程，取导入耗时的中位数；RSS 是导入完成后子进程的常驻内存（读 /proc，仅 Linux）。
+
+    import main            只导入应用（LLM_WARMUP 之前，uvicorn worker 启动时的开销）
+    deployment providers   再创建 DeepSeek / Qwen / Doubao（默认部署实际用到的模型）
+    all providers          再创建所有 Provider
+
+用法（在 backend 目录下）：
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --json startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SDKS = ["openai", "anthropic", "google.generativeai", "dashscope"]
+
+SCENARIOS = {
+    "import main": [],
+    "deployment providers": ["deepseek-chat", "qwen-turbo", "doubao-pro-32k"],
+    "all providers": ["deepseek-chat", "qwen-turbo", "doubao-pro-32k", "gpt-4o", "claude-3-5-sonnet",
+                      "grok-beta", "gemini-2.0-flash"],
+}
+
+# 子进程里执行：导入、按需创建 Provider，然后把结果以 JSON 打印到 stdout
+CHILD = """
+import json, os, sys, time
+start = time.perf_counter()
+import main
+from llm_providers import get_provider
+for model in {models!r}:
+    get_provider(model)
+elapsed = time.perf_counter() - start
+with open("/proc/self/statm") as f:
+    rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+print(json.dumps({{"seconds": elapsed, "rss": rss, "sdks": [m for m in {sdks!r} if m in sys.modules]}}))
+"""
+
+
+def run_child(models) -> dict:
+    env = dict(os.environ, LLM_WARMUP="0")
+    # 创建 Provider 需要 Key，不会真正请求上游
+    for key in ("OPENAI_API_KEY", "DEEPSEEK_API_KEY", "ANTHROPIC_API_KEY", "XAI_API_KEY",
+                "GOOGLE_API_KEY", "DASHSCOPE_API_KEY", "VOLCENGINE_API_KEY"):
+        env.setdefault(key, "bench-key")
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(models=list(models), sdks=SDKS)],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Backend import time / RSS benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'scenario':<24} {'import (ms)':>12} {'RSS (MB)':>10}  SDKs loaded")
+    for name, models in SCENARIOS.items():
+        runs = [run_child(models) for _ in range(args.repeat)]
+        seconds = statistics.median(r["seconds"] for r in runs)
+        rss = statistics.median(r["rss"] for r in runs)
+        results[name] = {"seconds": seconds, "rss": rss, "sdks": runs[-1]["sdks"]}
+        print(f"{name:<24} {seconds * 1000:12.0f} {rss / 2**20:10.1f}  {', '.join(runs[-1]['sdks']) or '-'}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+"""后端热路径微基准：每个 token / 每轮发言都会执行的代码
+
+用法（在 backend 目录下）：
+    python benchmarks/run_benchmarks.py                # 运行并与基线比较（若基线存在）
+    python benchmarks/run_benchmarks.py --save         # 运行并保存为新基线
+    python benchmarks/run_benchmarks.py -k broadcast   # 只跑名字包含 broadcast 的项
+    python benchmarks/run_benchmarks.py --threshold 0.3
+
+任何一项比基线慢超过阈值（默认 25%）时以退出码 1 结束，可直接用在 CI 里。
+基线与机器相关，请在同一台机器上保存和比较。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+import warnings
+from typing import Callable, Dict
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# 创建 Provider 需要 Key，基准只用到格式化部分，不会真正请求上游
+for _key in ("OPENAI_API_KEY", "DEEPSEEK_API_KEY", "ANTHROPIC_API_KEY", "XAI_API_KEY",
+             "GOOGLE_API_KEY", "DASHSCOPE_API_KEY", "VOLCENGINE_API_KEY"):
+    os.environ.setdefault(_key, "bench-key")
+os.environ.setdefault("LLM_WARMUP", "0")
+
+from llm_providers import get_provider  # noqa: E402
+from rooms import ClientConnection, DebateRoom, encode_frame  # noqa: E402
+from wire import WireCodec  # noqa: E402
+from schemas import Message  # noqa: E402
+from web_search import WebSearcher  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+BENCHMARKS: Dict[str, Callable[[], float]] = {}
+
+
+def bench(name: str):
+    """注册一个基准；被注册的函数返回单次操作耗时（秒）"""
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+
+def best_of(fn: Callable[[], None], number: int, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def sample_history(turns: int = 30) -> list:
+    reply = "这是一段模拟的辩论发言，包含观点、论据和对其他参与者的回应。" * 20
+    history = [
+        {"role": "user", "name": "User", "content": "人工智能是否会取代人类工作？", "timestamp": 0.0},
+        {"role": "system", "name": "WebSearch", "content": "【互联网搜索结果】\n\n" + "搜索摘要" * 200, "timestamp": 0.0},
+    ]
+    agents = ["DeepSeek", "Qwen", "Doubao"]
+    for i in range(turns):
+        history.append({"role": "assistant", "name": agents[i % 3], "content": f"{reply} #{i}", "timestamp": 0.0})
+    return history
+
+
+# ---- 历史格式化：每个 Provider 每轮发言前都要做一次 ----
+
+def _register_provider_format(model: str):
+    @bench(f"format_history[{model}]")
+    def run() -> float:
+        provider = get_provider(model)
+        history = sample_history()
+        return best_of(lambda: provider.format_messages(history), number=200)
+
+
+for _model in ("gpt-4o", "deepseek-chat", "claude-3-5-sonnet", "grok-beta", "gemini-2.0-flash",
+               "qwen-turbo", "doubao-pro-32k"):
+    _register_provider_format(_model)
+
+
+# ---- 广播扇出：一帧发给房间内 N 个连接（含各连接写协程取出并发送） ----
+
+class _NullWebSocket:
+    async def send_text(self, text: str):
+        pass
+
+
+def _register_broadcast(subscribers: int, proto: str = "json"):
+    name = "broadcast_fanout" if proto == "json" else f"broadcast_fanout_{proto}"
+
+    @bench(f"{name}[{subscribers}]")
+    def run() -> float:
+        async def measure() -> float:
+            room = DebateRoom("bench")
+            for _ in range(subscribers):
+                codec = WireCodec() if proto == "compact" else None
+                connection = ClientConnection(_NullWebSocket(), room, codec)
+                connection.start()
+                room.subscribe(connection)
+            frame = {"type": "stream_delta", "agent": "DeepSeek", "delta": "这是一段增量内容"}
+            iterations = max(20, 20000 // subscribers)
+            best = float("inf")
+            for _ in range(5):
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    await room.broadcast(frame)
+                    # 让所有写协程把这一帧发出去
+                    await asyncio.sleep(0)
+                best = min(best, (time.perf_counter() - start) / iterations)
+            for connection in list(room.subscribers):
+                connection.close()
+            return best
+        return asyncio.run(measure())
+
+
+for _n in (1, 100, 1000):
+    _register_broadcast(_n)
+_register_broadcast(1000, "compact")
+
+
+# ---- 帧编码 ----
+
+@bench("encode_frame[stream_delta]")
+def bench_encode_delta() -> float:
+    frame = {"type": "stream_delta", "agent": "DeepSeek", "delta": "这是一段增量内容", "seq": 12345}
+    return best_of(lambda: encode_frame(frame), number=20000)
+
+
+@bench("encode_frame[snapshot]")
+def bench_encode_snapshot() -> float:
+    frame = {"type": "snapshot", "seq": 12345, "history": sample_history(), "streaming": []}
+    return best_of(lambda: encode_frame(frame), number=500)
+
+
+# ---- 搜索结果格式化 ----
+
+@bench("format_search_results[5]")
+def bench_format_search() -> float:
+    searcher = WebSearcher()
+    results = [
+        {"title": f"搜索结果标题 {i}", "snippet": "摘要内容" * 40, "url": f"https://example.com/{i}"}
+        for i in range(5)
+    ]
+    return best_of(lambda: searcher.format_search_results(results), number=20000)
+
+
+# ---- Message 模型 ----
+
+@bench("message_construct_dict")
+def bench_message() -> float:
+    def run():
+        Message(role="assistant", name="DeepSeek", content="这是一段发言内容" * 20).dict()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return best_of(run, number=20000)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Backend hot-path microbenchmarks")
+    parser.add_argument("--save", action="store_true", help="保存本次结果为基线")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基线文件路径")
+    parser.add_argument("--threshold", type=float, default=0.25, help="允许比基线慢的比例")
+    parser.add_argument("-k", dest="pattern", default="", help="只运行名字包含该字符串的基准")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<36} {'time/op':>12} {'baseline':>12} {'change':>8}")
+    for name, fn in BENCHMARKS.items():
+        if args.pattern and args.pattern not in name:
+            continue
+        seconds = fn()
+        results[name] = seconds
+        line = f"{name:<36} {seconds * 1e6:10.2f}us"
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line += f" {baseline[name] * 1e6:10.2f}us {change:+7.1%}"
+            if change > args.threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "saved_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "results": results,
+            }, f, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed more than {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
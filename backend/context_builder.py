@@ -0,0 +1,190 @@
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+# 各模型的上下文窗口（token），按模型名前缀匹配；名字里带 "-32k" 这类后缀的直接按后缀算
+MODEL_CONTEXT_WINDOWS = [
+    ("deepseek", 64000),
+    ("qwen-turbo", 131072),
+    ("qwen-plus", 131072),
+    ("qwen-max", 32768),
+    ("doubao", 32768),
+    ("gpt-4o", 128000),
+    ("gpt-4", 8192),
+    ("gpt-3.5", 16385),
+    ("claude", 200000),
+    ("gemini", 1000000),
+    ("grok", 131072),
+]
+DEFAULT_CONTEXT_WINDOW = 32768
+_WINDOW_SUFFIX = re.compile(r"-(\d+)k\b", re.IGNORECASE)
+
+# 预算 = min(窗口 * CONTEXT_BUDGET_RATIO - CONTEXT_OUTPUT_RESERVE, CONTEXT_MAX_TOKENS)
+# CONTEXT_MAX_TOKENS=0 表示只受模型窗口限制
+CONTEXT_BUDGET_RATIO = float(os.environ.get("CONTEXT_BUDGET_RATIO", "0.9"))
+CONTEXT_OUTPUT_RESERVE = int(os.environ.get("CONTEXT_OUTPUT_RESERVE", "2048"))
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", "0"))
+# 超出预算时每次多省略的发言条数粒度，越大前缀越稳定（缓存命中越多），但丢弃的上下文也越多
+CONTEXT_TRIM_STEP = max(int(os.environ.get("CONTEXT_TRIM_STEP", "6")), 1)
+
+# 每条消息的格式开销（角色、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def context_window(model_name: Optional[str]) -> int:
+    name = (model_name or "").lower()
+    suffix = _WINDOW_SUFFIX.search(name)
+    if suffix:
+        return int(suffix.group(1)) * 1024
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if name.startswith(prefix):
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def context_budget(model_name: Optional[str]) -> int:
+    budget = int(context_window(model_name) * CONTEXT_BUDGET_RATIO) - CONTEXT_OUTPUT_RESERVE
+    if CONTEXT_MAX_TOKENS > 0:
+        budget = min(budget, CONTEXT_MAX_TOKENS)
+    return max(budget, 256)
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估算 token 数：中日韩字符约 1 token/字，其余约 4 字符/token"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@lru_cache(maxsize=8192)
+def count_message_tokens(name: Optional[str], content: str) -> int:
+    """单条消息的 token 数（带缓存，历史里的旧消息每轮只算一次）"""
+    tokens = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    if name:
+        tokens += estimate_tokens(name) + 2
+    return tokens
+
+
+def _message_tokens(message: dict) -> int:
+    return count_message_tokens(message.get("name"), message.get("content") or "")
+
+
+@dataclass
+class ContextReport:
+    """一次上下文构建的裁剪情况"""
+    budget: int
+    input_messages: int
+    input_tokens: int
+    kept_messages: int
+    kept_tokens: int
+    dropped_messages: int = 0
+    truncated_messages: int = 0
+
+    @property
+    def trimmed_tokens(self) -> int:
+        return self.input_tokens - self.kept_tokens
+
+    @property
+    def trimmed(self) -> bool:
+        return self.dropped_messages > 0 or self.truncated_messages > 0
+
+    def __str__(self) -> str:
+        return (f"kept {self.kept_messages}/{self.input_messages} messages, "
+                f"~{self.kept_tokens}/{self.input_tokens} tokens (budget {self.budget}), "
+                f"dropped {self.dropped_messages}, truncated {self.truncated_messages}")
+
+
+def _pinned_indexes(messages: List[dict]) -> List[int]:
+    """始终保留的消息：辩题（第一条消息和最近一条用户发言）以及最近一次联网搜索结果"""
+    pinned = set()
+    if messages:
+        pinned.add(0)
+    last_user = last_search = None
+    for i, m in enumerate(messages):
+        if m.get("role") == "user" and m.get("name") == "User":
+            last_user = i
+        elif m.get("name") == "WebSearch":
+            last_search = i
+    for i in (last_user, last_search):
+        if i is not None:
+            pinned.add(i)
+    return sorted(pinned)
+
+
+def _truncate(message: dict, max_tokens: int) -> dict:
+    """按比例截断一条过长消息的开头部分，保留结尾（最新的论点）"""
+    content = message.get("content") or ""
+    tokens = _message_tokens(message)
+    keep_chars = max(int(len(content) * max_tokens / tokens) - 16, 0)
+    return {**message, "content": "…" + content[len(content) - keep_chars:] if keep_chars else "…"}
+
+
+def _omitted(count: int) -> dict:
+    return {"role": "system", "name": None, "content": f"[已省略 {count} 条较早的发言]"}
+
+
+def build_context(messages: List[dict], model_name: Optional[str], system_prompt: str = "",
+                  budget: Optional[int] = None) -> Tuple[List[dict], ContextReport]:
+    """在 token 预算内挑选要发给模型的历史消息
+
+    系统提示词、辩题和搜索结果固定保留，放不下时从最早的发言开始省略，
+    被省略的发言用一条占位消息代替。
+    """
+    if budget is None:
+        budget = context_budget(model_name)
+    token_counts = [_message_tokens(m) for m in messages]
+    input_tokens = sum(token_counts)
+    remaining = budget - estimate_tokens(system_prompt)
+
+    if input_tokens <= remaining:
+        return messages, ContextReport(budget, len(messages), input_tokens, len(messages), input_tokens)
+
+    pinned = set(_pinned_indexes(messages))
+    droppable = [i for i in range(len(messages)) if i not in pinned]
+
+    # 从最早的发言开始省略，直到放得下；省略条数按 CONTEXT_TRIM_STEP 向上取整，
+    # 这样截断点在连续多轮之间保持不变，前缀不变才能命中上游的提示词缓存
+    excess = input_tokens - remaining
+    drop = 0
+    while excess > 0 and drop < len(droppable):
+        excess -= token_counts[droppable[drop]]
+        drop += 1
+    drop = -(-drop // CONTEXT_TRIM_STEP) * CONTEXT_TRIM_STEP
+    # 至少保留最新的一条发言
+    drop = min(drop, max(len(droppable) - 1, 0))
+    dropped = set(droppable[:drop])
+    kept = {i: m for i, m in enumerate(messages) if i not in dropped}
+
+    truncated = 0
+    over = sum(token_counts[i] for i in kept) - remaining
+    if over > 0 and droppable:
+        # 最新的一条发言本身就超出预算，截断后保留
+        newest = droppable[-1]
+        allowed = token_counts[newest] - over
+        if allowed > MESSAGE_OVERHEAD_TOKENS * 8:
+            kept[newest] = _truncate(messages[newest], allowed)
+            truncated = 1
+
+    # 按原顺序输出，每段连续被省略的发言用一条说明代替
+    result = []
+    gap = 0
+    for i, m in enumerate(messages):
+        if i not in kept:
+            gap += 1
+            continue
+        if gap:
+            result.append(_omitted(gap))
+            gap = 0
+        result.append(kept[i])
+    if gap:
+        result.append(_omitted(gap))
+
+    kept_tokens = sum(_message_tokens(m) for m in result)
+    report = ContextReport(budget, len(messages), input_tokens, len(kept), kept_tokens,
+                           dropped_messages=len(messages) - len(kept), truncated_messages=truncated)
+    return result, report
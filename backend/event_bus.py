@@ -0,0 +1,245 @@
+"""房间事件总线：把广播和共享的房间状态从单个进程里抽出来
+
+InProcessEventBus（默认）：单进程，行为与直接广播相同。
+RedisEventBus：多个 worker / 容器共用一个 Redis。事件序号、历史消息的序号、最近事件日志和历史记录都保存在 Redis 中，
+每个 worker 只为本地用到的房间维护一份镜像并只订阅这些房间的频道，由订阅到的事件驱动；客户端连到任何一个 worker
+都能看到在其他 worker 上运行的辩论，也能在任意 worker 上断线续传。
+
+配置 EVENT_BUS_URL=redis://host:6379/0 即启用 Redis，然后就可以 uvicorn --workers N 或部署多个副本。
+"""
+import asyncio
+import json
+import os
+import uuid
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Optional, Set
+
+if TYPE_CHECKING:
+    from rooms import DebateRoom, RoomRegistry
+
+# 为空时使用进程内总线
+EVENT_BUS_URL = os.environ.get("EVENT_BUS_URL", "")
+# Redis 键和频道的前缀，多套环境共用一个 Redis 时用来区分
+EVENT_BUS_PREFIX = os.environ.get("EVENT_BUS_PREFIX", "aidebate")
+
+
+class EventBus(ABC):
+    """事件总线接口"""
+
+    async def start(self, registry: "RoomRegistry"):
+        pass
+
+    async def close(self):
+        pass
+
+    async def watch(self, room_id: str):
+        """本 worker 开始镜像一个房间（在读取共享状态之前调用）"""
+        pass
+
+    def unwatch(self, room_id: str):
+        """房间已从本 worker 回收，不阻塞调用方"""
+        pass
+
+    @abstractmethod
+    async def publish(self, room: "DebateRoom", message: dict):
+        """给事件分配序号并投递给所有订阅了该房间的连接（不论在哪个 worker 上）"""
+
+    async def append_history(self, room: "DebateRoom", message: dict) -> int:
+        """给一条新历史消息分配在完整记录中的序号，并同步给其他 worker；单进程时就是本地历史的长度"""
+        return room.history_offset + len(room.history)
+
+    async def exists(self, room_id: str) -> bool:
+        """共享状态中是否有这个房间"""
+        return False
+
+    async def restore(self, room: "DebateRoom", history_limit: int) -> bool:
+        """从共享状态初始化一个新建的房间镜像；没有共享状态时返回 False"""
+        return False
+
+
+class InProcessEventBus(EventBus):
+    """单进程：房间对象本身就是唯一的状态，直接记录并发给本地连接"""
+
+    async def publish(self, room: "DebateRoom", message: dict):
+        from rooms import encode_frame
+        event = room.record(message)
+        room.fan_out(event, encode_frame(event))
+
+
+# 原子地分配序号、写入事件日志并发布；在 Redis 里一次执行完，所有 worker 看到的顺序一致。
+# ARGV[1] 是不含 seq 的紧凑 JSON 对象，在末尾的 } 之前拼上 seq，订阅方可以直接转发给客户端
+_PUBLISH_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+local frame = string.sub(ARGV[1], 1, -2) .. ',"seq":' .. seq .. '}'
+redis.call('RPUSH', KEYS[2], frame)
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+if tonumber(ARGV[3]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+redis.call('PUBLISH', KEYS[3], frame)
+return seq
+"""
+
+# 分配历史消息的序号、追加到历史并通知各 worker，通知里带上序号，用于去重和按序写入镜像。
+# ARGV[2] 是本地已知的下一个序号：Redis 中的历史过期后房间从记录存储恢复，序号要接着存储里的继续，
+# 此时清空过期残留的列表，保证列表中的消息序号连续（最后一条的序号 = 计数 - 1）
+_HISTORY_SCRIPT = """
+local index = redis.call('INCR', KEYS[1]) - 1
+local floor = tonumber(ARGV[2])
+if index < floor then
+    index = floor
+    redis.call('SET', KEYS[1], floor + 1)
+    redis.call('DEL', KEYS[2])
+end
+redis.call('RPUSH', KEYS[2], ARGV[1])
+if tonumber(ARGV[3]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+redis.call('PUBLISH', KEYS[3], index .. '\\n' .. ARGV[1])
+return index
+"""
+
+
+class RedisEventBus(EventBus):
+    """基于 Redis 发布/订阅的多 worker 总线
+
+    键（{room} 为哈希标签）：
+      <prefix>:{room}:seq          事件序号
+      <prefix>:{room}:events       最近 ROOM_EVENT_BUFFER 个事件（已编码的帧）
+      <prefix>:{room}:history      历史消息（JSON）
+      <prefix>:{room}:history_seq  下一条历史消息的序号，各 worker 写入记录存储时使用，不会冲突
+    频道：<prefix>:events:<room>（事件帧）、<prefix>:history:<room>（新历史消息，带序号），
+    每个 worker 在房间镜像创建时订阅、回收时退订。
+    """
+
+    def __init__(self, url: str = EVENT_BUS_URL, client=None, prefix: str = EVENT_BUS_PREFIX):
+        if client is None:
+            # 只有启用 Redis 时才需要安装 redis 包
+            import redis.asyncio as redis
+            client = redis.from_url(url, decode_responses=True)
+        self.redis = client
+        self.prefix = prefix
+        self.worker_id = uuid.uuid4().hex
+        self.registry: Optional["RoomRegistry"] = None
+        self.listener: Optional[asyncio.Task] = None
+        self._publish = self.redis.register_script(_PUBLISH_SCRIPT)
+        self._append_history = self.redis.register_script(_HISTORY_SCRIPT)
+        self._pubsub = None
+        # 订阅和退订串行执行，房间回收后马上重建时不会把新的订阅退掉
+        self._subscriptions = asyncio.Lock()
+        # 至少订阅了一个房间；没有订阅时 listen() 会立即返回，监听协程在这里等待
+        self._watching = asyncio.Event()
+        self._unwatching: Set[asyncio.Task] = set()
+
+    def _key(self, room_id: str, name: str) -> str:
+        return f"{self.prefix}:{{{room_id}}}:{name}"
+
+    def _channels(self, room_id: str):
+        return f"{self.prefix}:events:{room_id}", f"{self.prefix}:history:{room_id}"
+
+    async def start(self, registry: "RoomRegistry"):
+        self.registry = registry
+        self._pubsub = self.redis.pubsub()
+        self.listener = asyncio.create_task(self._listen())
+        print(f"[EventBus] Redis worker {self.worker_id[:8]}")
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        await self.redis.aclose()
+
+    async def watch(self, room_id: str):
+        async with self._subscriptions:
+            await self._pubsub.subscribe(*self._channels(room_id))
+        self._watching.set()
+
+    def unwatch(self, room_id: str):
+        task = asyncio.create_task(self._unwatch(room_id))
+        self._unwatching.add(task)
+        task.add_done_callback(self._unwatching.discard)
+
+    async def _unwatch(self, room_id: str):
+        async with self._subscriptions:
+            # 退订前房间又被创建了，保留订阅
+            if self.registry.get(room_id) is not None:
+                return
+            try:
+                await self._pubsub.unsubscribe(*self._channels(room_id))
+            except Exception as e:
+                print(f"[EventBus] unsubscribe failed for room {room_id}: {e}")
+
+    async def publish(self, room: "DebateRoom", message: dict):
+        from rooms import EVENT_BUFFER_SIZE, ROOM_MAX_AGE, encode_frame
+        # 本 worker 的连接也通过订阅收到这一帧，保证所有 worker 上的顺序一致
+        await self._publish(
+            keys=[self._key(room.id, "seq"), self._key(room.id, "events"), self._channels(room.id)[0]],
+            args=[encode_frame(room.stamp(message)), EVENT_BUFFER_SIZE, int(ROOM_MAX_AGE)]
+        )
+
+    async def append_history(self, room: "DebateRoom", message: dict) -> int:
+        from rooms import ROOM_MAX_AGE
+        return await self._append_history(
+            keys=[self._key(room.id, "history_seq"), self._key(room.id, "history"), self._channels(room.id)[1]],
+            args=[json.dumps(dict(message), ensure_ascii=False), room.history_offset + len(room.history),
+                  int(ROOM_MAX_AGE)]
+        )
+
+    async def _listen(self):
+        events_prefix = f"{self.prefix}:events:"
+        history_prefix = f"{self.prefix}:history:"
+        while True:
+            try:
+                await self._watching.wait()
+                async for item in self._pubsub.listen():
+                    if item["type"] != "message":
+                        continue
+                    channel, data = item["channel"], item["data"]
+                    if channel.startswith(events_prefix):
+                        room = self.registry.get(channel[len(events_prefix):])
+                        if room is not None:
+                            room.deliver(data)
+                    elif channel.startswith(history_prefix):
+                        # 本 worker 写入的消息也会收到，按序号去重
+                        index, payload = data.split("\n", 1)
+                        room = self.registry.get(channel[len(history_prefix):])
+                        if room is not None:
+                            room.mirror_history(int(index), json.loads(payload))
+                # 所有房间都已退订
+                if not self._pubsub.subscribed:
+                    self._watching.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[EventBus] subscription error, retrying: {e}")
+                await asyncio.sleep(1)
+
+    async def exists(self, room_id: str) -> bool:
+        return bool(await self.redis.exists(self._key(room_id, "seq"), self._key(room_id, "history_seq")))
+
+    async def restore(self, room: "DebateRoom", history_limit: int) -> bool:
+        from rooms import EVENT_BUFFER_SIZE
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.get(self._key(room.id, "history_seq"))
+            pipe.lrange(self._key(room.id, "history"), -history_limit, -1)
+            pipe.lrange(self._key(room.id, "events"), -EVENT_BUFFER_SIZE, -1)
+            pipe.get(self._key(room.id, "seq"))
+            next_index, history, frames, seq = await pipe.execute()
+        if not next_index and not seq:
+            return False
+        # 列表中的序号是连续的，最后一条是 next_index - 1
+        offset = int(next_index or 0) - len(history)
+        room.restore([(offset + i, json.loads(data)) for i, data in enumerate(history)])
+        room.seq = int(seq or 0)
+        for frame in frames:
+            room.apply(json.loads(frame))
+        return True
+
+
+def create_event_bus() -> EventBus:
+    if EVENT_BUS_URL:
+        return RedisEventBus(EVENT_BUS_URL)
+    return InProcessEventBus()
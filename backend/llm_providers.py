@@ -1,28 +1,250 @@
 import os
+import asyncio
 from abc import ABC, abstractmethod
-from typing import List, AsyncGenerator
-import openai
-import anthropic
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List, AsyncGenerator, Dict, Iterable, Optional, Tuple, Type
+import httpx
 from dotenv import load_dotenv
-import google.generativeai as genai
-import dashscope
+from context_builder import build_context, context_budget, count_message_tokens
+from message_format import to_anthropic, to_dashscope, to_gemini, to_openai
+from metrics import provider_error
+from rate_limit import RATE_LIMIT_COMPLETION_ESTIMATE, rate_limits
 # from volcengine.ark import Ark
 
+# 各家 SDK 在第一次创建对应的客户端时才导入：只启用 DeepSeek / Qwen / Doubao 时
+# 不会加载 anthropic 和 google.generativeai，worker 启动更快、常驻内存更小
+if TYPE_CHECKING:
+    import anthropic
+    import openai
+
 # Suppress logging warnings for clean output
 import logging
 logging.getLogger("absl").setLevel(logging.ERROR)
 
 load_dotenv()
 
+# 上游 HTTP 连接池参数：每个 (provider, key, base_url) 共享一个客户端，复用 TCP+TLS 连接
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.environ.get("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "120"))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "600"))
+# 缓存的 Provider 实例数上限，按 (插件, 模型) 计，超过后按最近最少使用淘汰；SDK 客户端不随之关闭，仍按 (provider, key, base_url) 共享
+LLM_PROVIDER_CACHE_SIZE = int(os.environ.get("LLM_PROVIDER_CACHE_SIZE", "64"))
+
+# 在支持的 API 上显式标记可缓存的提示词前缀（Anthropic cache_control），默认关闭；
+# DeepSeek 等兼容接口的前缀缓存是自动的，不需要标记
+PROMPT_CACHE_MARKERS = os.environ.get("PROMPT_CACHE_MARKERS", "0") == "1"
+
+# 不支持助手前缀续写的接口，续写时追加的用户消息
+CONTINUE_PROMPT = "你的上一条回复在传输中被截断了。请从截断处直接接着写，不要重复已经写过的内容，也不要加任何说明。"
+
+@dataclass
+class PromptUsage:
+    """一次调用的 token 用量；cached_tokens 是命中上游提示词缓存的输入 token"""
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def uncached_tokens(self) -> int:
+        return max(self.prompt_tokens - self.cached_tokens, 0)
+
+    def as_dict(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "uncached_tokens": self.uncached_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+    def __str__(self) -> str:
+        return (f"prompt {self.prompt_tokens} (cached {self.cached_tokens}, uncached {self.uncached_tokens}), "
+                f"completion {self.completion_tokens}")
+
+    def record_openai(self, usage):
+        """OpenAI 兼容接口的 usage：DeepSeek 用 prompt_cache_hit_tokens，其余用 prompt_tokens_details.cached_tokens"""
+        self.prompt_tokens = usage.prompt_tokens or 0
+        self.completion_tokens = usage.completion_tokens or 0
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+        if cached is None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", None) if details else None
+        self.cached_tokens = cached or 0
+
+    def record_anthropic(self, usage):
+        cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+        self.prompt_tokens = usage.input_tokens + cache_read + cache_write
+        self.cached_tokens = cache_read
+        self.completion_tokens = usage.output_tokens
+
+    def record_gemini(self, usage_metadata):
+        self.prompt_tokens = usage_metadata.prompt_token_count
+        self.cached_tokens = getattr(usage_metadata, "cached_content_token_count", 0) or 0
+        self.completion_tokens = usage_metadata.candidates_token_count
+
+class ProviderRegistry:
+    """进程内共享的 Provider 实例与 SDK 客户端缓存
+
+    每轮每个 Agent 都新建客户端意味着每次都要重新握手；这里按
+    (provider, api_key, base_url) 缓存一个客户端，后续发言直接复用连接池。
+    SDK 自带的重试关闭，429 和临时错误由 rate_limit 统一重试，限流状态才能在各次调用之间共享。
+    """
+
+    def __init__(self):
+        self._clients: Dict[Tuple[str, str, str], object] = {}
+        self._http_clients: Dict[Tuple[str, str, str], httpx.AsyncClient] = {}
+        # 按解析后的 (插件, 模型) 缓存：同一模型的不同写法共用一个实例，客户端随意传的模型名也不会让缓存无限增长
+        self._providers: "OrderedDict[Tuple[str, str], LLMProvider]" = OrderedDict()
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        )
+
+    def openai_client(self, provider: str, api_key: Optional[str], base_url: Optional[str] = None) -> "openai.AsyncOpenAI":
+        key = (provider, api_key or "", base_url or "")
+        client = self._clients.get(key)
+        if client is None:
+            import openai
+            http_client = openai.DefaultAsyncHttpxClient(limits=self._limits(), timeout=LLM_TIMEOUT)
+            client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+            self._clients[key] = client
+            self._http_clients[key] = http_client
+        return client
+
+    def anthropic_client(self, api_key: Optional[str]) -> "anthropic.AsyncAnthropic":
+        key = ("anthropic", api_key or "", "")
+        client = self._clients.get(key)
+        if client is None:
+            import anthropic
+            http_client = anthropic.DefaultAsyncHttpxClient(limits=self._limits(), timeout=LLM_TIMEOUT)
+            client = anthropic.AsyncAnthropic(api_key=api_key, http_client=http_client, max_retries=0)
+            self._clients[key] = client
+            self._http_clients[key] = http_client
+        return client
+
+    def get(self, name: str) -> "LLMProvider":
+        plugin, model = resolve_model(name)
+        key = (plugin.key, model)
+        provider = self._providers.get(key)
+        if provider is None:
+            provider = plugin.cls(model_name=model)
+            self._providers[key] = provider
+            while len(self._providers) > LLM_PROVIDER_CACHE_SIZE:
+                self._providers.popitem(last=False)
+        else:
+            self._providers.move_to_end(key)
+        return provider
+
+    async def warm_up(self, names: Iterable[str]):
+        """预先创建 Provider，并向各上游发一个轻量请求，把连接提前建好"""
+        for name in names:
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"Warm-up skipped {name}: {e}")
+
+        async def touch(key: Tuple[str, str, str], http_client: httpx.AsyncClient):
+            # 状态码无所谓，只要连接建立并留在连接池里
+            try:
+                await http_client.get(str(self._clients[key].base_url), timeout=5)
+            except Exception as e:
+                print(f"Warm-up failed for {key[0]}: {e}")
+
+        await asyncio.gather(*[touch(k, c) for k, c in list(self._http_clients.items())])
+
+    async def aclose(self):
+        """关闭所有连接池"""
+        for http_client in self._http_clients.values():
+            try:
+                await http_client.aclose()
+            except Exception:
+                pass
+        self._clients.clear()
+        self._http_clients.clear()
+        self._providers.clear()
+
+registry = ProviderRegistry()
+
+class UnknownModelError(ValueError):
+    """没有 Provider 负责这个模型名"""
+
+@dataclass
+class ProviderPlugin:
+    """插件表中的一项：Provider 类和它负责的模型名前缀（小写）"""
+    key: str
+    cls: Type["LLMProvider"]
+    prefixes: Tuple[str, ...]
+
+# key -> 插件；Provider 类用 register_provider 登记，SDK 在类第一次被实例化时才导入
+PROVIDER_PLUGINS: Dict[str, ProviderPlugin] = {}
+
+def register_provider(key: str, *prefixes: str):
+    """把 Provider 类登记到插件表；prefixes 是它负责的模型名前缀，如 "gpt-"、"claude-"。"""
+    def decorator(cls):
+        PROVIDER_PLUGINS[key] = ProviderPlugin(key, cls, tuple(p.lower() for p in prefixes))
+        return cls
+    return decorator
+
+def resolve_model(name: str) -> Tuple[ProviderPlugin, str]:
+    """模型名 -> (插件, 传给 Provider 的模型名)
+
+    "<key>:<model>" 显式指定插件（如 "openai:ft-my-model"）；否则按模型名前缀匹配，最长的前缀优先。
+    没有匹配的插件时抛出 UnknownModelError，不会悄悄换成别的模型。
+    """
+    key, sep, model = name.partition(":")
+    if sep and key.lower() in PROVIDER_PLUGINS:
+        return PROVIDER_PLUGINS[key.lower()], model
+    lowered = name.lower()
+    best, matched = None, 0
+    for plugin in PROVIDER_PLUGINS.values():
+        for prefix in plugin.prefixes:
+            if len(prefix) > matched and lowered.startswith(prefix):
+                best, matched = plugin, len(prefix)
+    if best is None:
+        raise UnknownModelError(f"Unknown model '{name}', expected one of: "
+                                + ", ".join(p + "*" for plugin in PROVIDER_PLUGINS.values() for p in plugin.prefixes))
+    return best, name
+
 class LLMProvider(ABC):
+    model_name: str = ""
+    system_prompt: str = ""
+
+    def fit_context(self, messages: List[dict]) -> List[dict]:
+        """按模型上下文窗口裁剪历史，并打印本次裁剪了多少"""
+        fitted, report = build_context(messages, self.model_name, self.system_prompt)
+        if report.trimmed:
+            print(f"[Context] {self.name} ({self.model_name}): {report}")
+        return fitted
+
+    def estimate_tokens(self, messages: List[dict]) -> int:
+        """预估一次调用消耗的 token 数（输入 + 预留的回复），用于 TPM 限流"""
+        prompt = sum(count_message_tokens(m.get("name"), m.get("content") or "") for m in messages)
+        return min(prompt, context_budget(self.model_name)) + RATE_LIMIT_COMPLETION_ESTIMATE
+
+    def record_usage(self, estimated: int, usage: Optional[PromptUsage]):
+        if usage is not None:
+            rate_limits.get(self.name).record_usage(estimated, usage.prompt_tokens + usage.completion_tokens)
+
     @abstractmethod
-    async def generate_response(self, messages: List[dict]) -> str:
-        """根据历史消息生成回复"""
+    async def generate_response(self, messages: List[dict], usage: Optional[PromptUsage] = None) -> str:
+        """根据历史消息生成回复；传入 usage 时写入本次调用的 token 用量，请求失败时抛出异常"""
         pass
     
     @abstractmethod
-    async def stream_response(self, messages: List[dict]) -> AsyncGenerator[str, None]:
-        """根据历史消息流式生成回复"""
+    async def stream_response(self, messages: List[dict], usage: Optional[PromptUsage] = None,
+                              prefix: str = "") -> AsyncGenerator[str, None]:
+        """根据历史消息流式生成回复；传入 usage 时在流结束后写入本次调用的 token 用量
+
+        prefix 非空时是续写请求：回复的开头 prefix 已经输出过，只生成后续内容。
+        推理模型输出推理过程时产出空字符串，表示上游仍在输出（计入首 token / 停顿超时），调用方应忽略。
+        请求失败时抛出异常（调用方据此续写或报错）。
+        """
         pass
 
     @property
@@ -30,183 +252,218 @@ class LLMProvider(ABC):
     def name(self) -> str:
         pass
 
-class OpenAIProvider(LLMProvider):
-    def __init__(self, model_name: str = "gpt-4o", api_key: str = None):
-        self.model_name = model_name
-        self.client = openai.AsyncOpenAI(api_key=api_key or os.environ.get("OPENAI_API_KEY"))
+class OpenAICompatibleProvider(LLMProvider):
+    """走 OpenAI Chat Completions 兼容接口的 Provider 共用实现"""
+    # 流式请求时是否带 stream_options.include_usage，以便在最后一个 chunk 拿到用量
+    include_usage: bool = True
 
     @property
-    def name(self) -> str:
-        return "ChatGPT"
+    def request_model(self) -> str:
+        """请求里 model 参数的值"""
+        return self.model_name
+
+    def format_messages(self, messages: List[dict]) -> List[dict]:
+        return to_openai(self.fit_context(messages), self.system_prompt)
+
+    def continuation(self, formatted: List[dict], prefix: str) -> List[dict]:
+        """续写请求的消息：默认把已输出的部分作为助手消息，再请模型接着写"""
+        return formatted + [{"role": "assistant", "content": prefix}, {"role": "user", "content": CONTINUE_PROMPT}]
+
+    def continuation_client(self):
+        return self.client
 
-    async def generate_response(self, messages: List[dict]) -> str:
-        # ...existing code...
+    async def generate_response(self, messages: List[dict], usage: Optional[PromptUsage] = None) -> str:
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model_name,
-                messages=formatted_msgs
+            formatted = self.format_messages(messages)
+            tokens = self.estimate_tokens(messages)
+            response = await rate_limits.get(self.name).call(
+                lambda: self.client.chat.completions.create(model=self.request_model, messages=formatted),
+                tokens
             )
+            if usage is not None and response.usage:
+                usage.record_openai(response.usage)
+                self.record_usage(tokens, usage)
             return response.choices[0].message.content
         except Exception as e:
-            return f"Error from OpenAI: {str(e)}"
-
-    async def stream_response(self, messages: List[dict]) -> AsyncGenerator[str, None]:
-        formatted_msgs = [{"role": "system", "content": "You are a participant in a group debate. Express your opinion clearly, critique others constructively, and try to reach a conclusion."}]
-        for m in messages:
-            role = "user" if m['role'] == "user" else "assistant"
-            content = f"[{m['name']}]: {m['content']}" if m.get('name') else m['content']
-            formatted_msgs.append({"role": role, "content": content})
+            provider_error(self.name, e)
+            raise
 
+    async def stream_response(self, messages: List[dict], usage: Optional[PromptUsage] = None,
+                              prefix: str = "") -> AsyncGenerator[str, None]:
         try:
-            stream = await self.client.chat.completions.create(
-                model=self.model_name,
-                messages=formatted_msgs,
-                stream=True
+            extra = {}
+            if usage is not None and self.include_usage:
+                extra["stream_options"] = {"include_usage": True}
+            formatted = self.format_messages(messages)
+            tokens = self.estimate_tokens(messages)
+            client = self.client
+            if prefix:
+                formatted = self.continuation(formatted, prefix)
+                client = self.continuation_client()
+            stream = await rate_limits.get(self.name).call(
+                lambda: client.chat.completions.create(
+                    model=self.request_model,
+                    messages=formatted,
+                    stream=True,
+                    **extra
+                ),
+                tokens
             )
             async for chunk in stream:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
+                if chunk.choices:
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        yield delta.content
+                    elif getattr(delta, "reasoning_content", None):
+                        # deepseek-reasoner 等推理模型先输出很长的推理过程，不计入回复，只用来说明上游仍在输出
+                        yield ""
+                if usage is not None and chunk.usage:
+                    usage.record_openai(chunk.usage)
+            self.record_usage(tokens, usage)
         except Exception as e:
-            yield f"Error from OpenAI: {str(e)}"
+            provider_error(self.name, e)
+            raise
+
+@register_provider("openai", "gpt-", "chatgpt-", "o1", "o3", "o4")
+class OpenAIProvider(OpenAICompatibleProvider):
+    system_prompt = "You are a participant in a group debate. Express your opinion clearly, critique others constructively, and try to reach a conclusion."
+
+    def __init__(self, model_name: str = "gpt-4o", api_key: str = None):
+        self.model_name = model_name
+        self.client = registry.openai_client(
+            "openai",
+            api_key or os.environ.get("OPENAI_API_KEY"),
+            base_url=os.environ.get("OPENAI_BASE_URL")
+        )
+
+    @property
+    def name(self) -> str:
+        return "ChatGPT"
+
+@register_provider("deepseek", "deepseek-")
+class DeepSeekProvider(OpenAICompatibleProvider):
+    system_prompt = "You are a helpful and sharp AI assistant participating in a debate."
 
-class DeepSeekProvider(LLMProvider):
     def __init__(self, model_name: str = "deepseek-chat", api_key: str = None):
         self.model_name = model_name
         # DeepSeek 通常兼容 OpenAI SDK
-        self.client = openai.AsyncOpenAI(
-            api_key=api_key or os.environ.get("DEEPSEEK_API_KEY"),
-            base_url="https://api.deepseek.com"
+        self.client = registry.openai_client(
+            "deepseek",
+            api_key or os.environ.get("DEEPSEEK_API_KEY"),
+            base_url=os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
         )
+        self.api_key = api_key or os.environ.get("DEEPSEEK_API_KEY")
 
     @property
     def name(self) -> str:
         return "DeepSeek"
 
-    async def generate_response(self, messages: List[dict]) -> str:
-        # ...existing code...
-        try:
-            response = await self.client.chat.completions.create(
-                model=self.model_name,
-                messages=formatted_msgs
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"Error from DeepSeek: {str(e)}"
-
-    async def stream_response(self, messages: List[dict]) -> AsyncGenerator[str, None]:
-        formatted_msgs = [{"role": "system", "content": "You are a helpful and sharp AI assistant participating in a debate."}]
-        for m in messages:
-            role = "user" if m['role'] == "user" else "assistant"
-            content = f"[{m['name']}]: {m['content']}" if m.get('name') else m['content']
-            formatted_msgs.append({"role": role, "content": content})
+    def continuation(self, formatted: List[dict], prefix: str) -> List[dict]:
+        # 对话前缀续写（beta 接口）：模型直接从 prefix 末尾接着生成
+        return formatted + [{"role": "assistant", "content": prefix, "prefix": True}]
 
-        try:
-            stream = await self.client.chat.completions.create(
-                model=self.model_name,
-                messages=formatted_msgs,
-                stream=True
-            )
-            async for chunk in stream:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
-        except Exception as e:
-            yield f"Error from DeepSeek: {str(e)}"
+    def continuation_client(self):
+        base_url = str(self.client.base_url).rstrip("/")
+        return registry.openai_client("deepseek", self.api_key, base_url=f"{base_url}/beta")
 
+@register_provider("anthropic", "claude-")
 class ClaudeProvider(LLMProvider):
+    system_prompt = "You are Claude, participating in a group chat debate. Engage with other participants."
+
     def __init__(self, model_name: str = "claude-3-5-sonnet-20240620", api_key: str = None):
         self.model_name = model_name
-        self.client = anthropic.AsyncAnthropic(api_key=api_key or os.environ.get("ANTHROPIC_API_KEY"))
+        self.client = registry.anthropic_client(api_key or os.environ.get("ANTHROPIC_API_KEY"))
 
     @property
     def name(self) -> str:
         return "Claude"
 
-    async def generate_response(self, messages: List[dict]) -> str:
-        # ...existing code...
+    def _system(self):
+        if PROMPT_CACHE_MARKERS:
+            return [{"type": "text", "text": self.system_prompt, "cache_control": {"type": "ephemeral"}}]
+        return self.system_prompt
+
+    def format_messages(self, messages: List[dict]) -> List[dict]:
+        return to_anthropic(self.fit_context(messages), cache_breakpoint=PROMPT_CACHE_MARKERS)
+
+    async def generate_response(self, messages: List[dict], usage: Optional[PromptUsage] = None) -> str:
         try:
-            response = await self.client.messages.create(
-                model=self.model_name,
-                max_tokens=1024,
-                system=system_prompt,
-                messages=anthropic_msgs
+            formatted = self.format_messages(messages)
+            tokens = self.estimate_tokens(messages)
+            response = await rate_limits.get(self.name).call(
+                lambda: self.client.messages.create(
+                    model=self.model_name,
+                    max_tokens=1024,
+                    system=self._system(),
+                    messages=formatted
+                ),
+                tokens
             )
+            if usage is not None:
+                usage.record_anthropic(response.usage)
+                self.record_usage(tokens, usage)
             return response.content[0].text
         except Exception as e:
-            return f"Error from Claude: {str(e)}"
-
-    async def stream_response(self, messages: List[dict]) -> AsyncGenerator[str, None]:
-        system_prompt = "You are Claude, participating in a group chat debate. Engage with other participants."
-        anthropic_msgs = []
-        for m in messages:
-            role = "user" if m['role'] == "user" else "assistant"
-            content = f"[{m['name']}]: {m['content']}" if m.get('name') else m['content']
-            anthropic_msgs.append({"role": role, "content": content})
+            provider_error(self.name, e)
+            raise
 
+    async def stream_response(self, messages: List[dict], usage: Optional[PromptUsage] = None,
+                              prefix: str = "") -> AsyncGenerator[str, None]:
         try:
-            async with self.client.messages.stream(
-                max_tokens=1024,
-                system=system_prompt,
-                messages=anthropic_msgs,
-                model=self.model_name,
-            ) as stream:
+            formatted = self.format_messages(messages)
+            if prefix:
+                # 预填助手回复的开头，模型从这里接着写（末尾不能是空白）
+                formatted = formatted + [{"role": "assistant", "content": prefix.rstrip()}]
+            tokens = self.estimate_tokens(messages)
+            async with AsyncExitStack() as stack:
+                # 请求在进入 stream 上下文时发出，429 在这一步重试
+                stream = await rate_limits.get(self.name).call(
+                    lambda: stack.enter_async_context(self.client.messages.stream(
+                        max_tokens=1024,
+                        system=self._system(),
+                        messages=formatted,
+                        model=self.model_name,
+                    )),
+                    tokens
+                )
                 async for text in stream.text_stream:
                     yield text
+                if usage is not None:
+                    usage.record_anthropic((await stream.get_final_message()).usage)
+                    self.record_usage(tokens, usage)
         except Exception as e:
-            yield f"Error from Claude: {str(e)}"
+            provider_error(self.name, e)
+            raise
+
+@register_provider("grok", "grok-")
+class GrokProvider(OpenAICompatibleProvider):
+    system_prompt = "You are Grok, a witty AI. Join the debate."
 
-class GrokProvider(LLMProvider):
     def __init__(self, model_name: str = "grok-beta", api_key: str = None):
         self.model_name = model_name
         # Assuming Grok uses OpenAI compatible API endpoint
-        self.client = openai.AsyncOpenAI(
-            api_key=api_key or os.environ.get("XAI_API_KEY"),
-            base_url="https://api.x.ai/v1" 
+        self.client = registry.openai_client(
+            "grok",
+            api_key or os.environ.get("XAI_API_KEY"),
+            base_url="https://api.x.ai/v1"
         )
 
     @property
     def name(self) -> str:
         return "Grok"
 
-    async def generate_response(self, messages: List[dict]) -> str:
-        # ...existing code...
-        try:
-            response = await self.client.chat.completions.create(
-                model=self.model_name,
-                messages=formatted_msgs
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"Error from Grok: {str(e)}"
-
-    async def stream_response(self, messages: List[dict]) -> AsyncGenerator[str, None]:
-        formatted_msgs = [{"role": "system", "content": "You are Grok, a witty AI. Join the debate."}]
-        for m in messages:
-            role = "user" if m['role'] == "user" else "assistant"
-            content = f"[{m['name']}]: {m['content']}" if m.get('name') else m['content']
-            formatted_msgs.append({"role": role, "content": content})
-
-        try:
-            stream = await self.client.chat.completions.create(
-                model=self.model_name,
-                messages=formatted_msgs,
-                stream=True
-            )
-            async for chunk in stream:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
-        except Exception as e:
-            yield f"Error from Grok: {str(e)}"
-
+@register_provider("gemini", "gemini-")
 class GeminiProvider(LLMProvider):
+    system_prompt = "You are Gemini, participating in a group debate. Be concise and sharp."
+
     def __init__(self, model_name: str = "gemini-2.0-flash", api_key: str = None):
         self.model_name = model_name
         self.api_key = api_key or os.environ.get("GOOGLE_API_KEY")
         if self.api_key:
+            import google.generativeai as genai
             genai.configure(api_key=self.api_key)
-            self.model = genai.GenerativeModel(self.model_name)
+            # 系统提示词走 system_instruction，历史走原生多轮 contents
+            self.model = genai.GenerativeModel(self.model_name, system_instruction=self.system_prompt)
         else:
             self.model = None
 
@@ -214,159 +471,112 @@ class GeminiProvider(LLMProvider):
     def name(self) -> str:
         return "Gemini"
 
-    async def generate_response(self, messages: List[dict]) -> str:
-        # ...existing code...
+    def format_messages(self, messages: List[dict]) -> List[dict]:
+        return to_gemini(self.fit_context(messages))
+
+    async def generate_response(self, messages: List[dict], usage: Optional[PromptUsage] = None) -> str:
+        if not self.model:
+            raise RuntimeError("GOOGLE_API_KEY not configured.")
         try:
-            # We use generate_content for simplicity instead of chat session for stateless request
-            response = await self.model.generate_content_async(full_last_prompt)
+            formatted = self.format_messages(messages)
+            tokens = self.estimate_tokens(messages)
+            response = await rate_limits.get(self.name).call(
+                lambda: self.model.generate_content_async(formatted), tokens
+            )
+            if usage is not None:
+                usage.record_gemini(response.usage_metadata)
+                self.record_usage(tokens, usage)
             return response.text
         except Exception as e:
-            return f"Error from Gemini: {str(e)}"
+            provider_error(self.name, e)
+            raise
 
-    async def stream_response(self, messages: List[dict]) -> AsyncGenerator[str, None]:
+    async def stream_response(self, messages: List[dict], usage: Optional[PromptUsage] = None,
+                              prefix: str = "") -> AsyncGenerator[str, None]:
         if not self.model:
-            yield "Error: GOOGLE_API_KEY not configured."
-            return
-
-        history = []
-        for m in messages[:-1]:
-            role = "user" if m['role'] == "user" else "model"
-            content = f"[{m['name']}]: {m['content']}" if m.get('name') else m['content']
-            history.append({"role": role, "parts": [content]})
-            
-        last_msg = messages[-1]
-        last_content = f"[{last_msg['name']}]: {last_msg['content']}" if last_msg.get('name') else last_msg['content']
-        system_instruction = "System: You are Gemini, participating in a group debate. Be concise and sharp."
-        full_last_prompt = f"{system_instruction}\n\nContext so far:\n{history}\n\nLatest message:\n{last_content}"
+            raise RuntimeError("GOOGLE_API_KEY not configured.")
 
         try:
-            response = await self.model.generate_content_async(full_last_prompt, stream=True)
+            formatted = self.format_messages(messages)
+            if prefix:
+                formatted = formatted + [{"role": "model", "parts": [prefix]}, {"role": "user", "parts": [CONTINUE_PROMPT]}]
+            tokens = self.estimate_tokens(messages)
+            response = await rate_limits.get(self.name).call(
+                lambda: self.model.generate_content_async(formatted, stream=True), tokens
+            )
             async for chunk in response:
                 yield chunk.text
+            if usage is not None:
+                usage.record_gemini(response.usage_metadata)
+                self.record_usage(tokens, usage)
         except Exception as e:
-            yield f"Error from Gemini: {str(e)}"
+            provider_error(self.name, e)
+            raise
+
+@register_provider("qwen", "qwen", "qwq-")
+class QwenProvider(OpenAICompatibleProvider):
+    system_prompt = "You are Qwen, a helpful assistant in a group debate."
 
-class QwenProvider(LLMProvider):
     def __init__(self, model_name: str = "qwen-turbo", api_key: str = None):
         self.model_name = model_name
-        # dashscope.api_key needs to be set globally or passed in call
         self.api_key = api_key or os.environ.get("DASHSCOPE_API_KEY")
-        dashscope.api_key = self.api_key
+        # 走 DashScope 的 OpenAI 兼容接口：原生异步流式，不会像 dashscope.Generation.call 那样
+        # 在迭代时阻塞事件循环；关闭生成器即可取消上游请求
+        self.client = registry.openai_client(
+            "qwen",
+            self.api_key,
+            base_url=os.environ.get("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+        )
 
     @property
     def name(self) -> str:
         return "Qwen"
 
-    async def generate_response(self, messages: List[dict]) -> str:
-        # ...existing code...
-        try:
-            # Using sync call in async wrapper roughly, but dashscope has async call? 
-            # For simplicity using standard call. Blocking in async loop is not ideal but works for low traffic.
-            response = dashscope.Generation.call(
-                model=self.model_name,
-                messages=ds_msgs,
-                result_format='message',  # set the result to be "message" format.
-            )
-            if response.status_code == 200:
-                return response.output.choices[0].message.content
-            else:
-                return f"Error from Qwen: {response.code} - {response.message}"
-        except Exception as e:
-            return f"Error from Qwen: {str(e)}"
+    def format_messages(self, messages: List[dict]) -> List[dict]:
+        return to_dashscope(self.fit_context(messages), self.system_prompt)
 
-    async def stream_response(self, messages: List[dict]) -> AsyncGenerator[str, None]:
-        ds_msgs = []
-        for m in messages:
-            role = "user" if m['role'] == "user" else "assistant"
-            content = f"[{m['name']}]: {m['content']}" if m.get('name') else m['content']
-            ds_msgs.append({'role': role, 'content': content})
-        ds_msgs.insert(0, {'role': 'system', 'content': 'You are Qwen, a helpful assistant in a group debate.'})
+    def continuation(self, formatted: List[dict], prefix: str) -> List[dict]:
+        # DashScope 的 partial 模式：最后一条助手消息作为回复前缀
+        return formatted + [{"role": "assistant", "content": prefix, "partial": True}]
 
-        try:
-            responses = dashscope.Generation.call(
-                model=self.model_name,
-                messages=ds_msgs,
-                result_format='message',
-                stream=True,
-                incremental_output=True # Important for getting deltas
-            )
-            for response in responses:
-                if response.status_code == 200:
-                    yield response.output.choices[0].message.content
-                else:
-                    yield f"Error: {response.code} - {response.message}"
-        except Exception as e:
-            yield f"Error from Qwen: {str(e)}"
+@register_provider("doubao", "doubao-")
+class DoubaoProvider(OpenAICompatibleProvider):
+    system_prompt = "You are Doubao, a helpful assistant in a group debate."
 
-class DoubaoProvider(LLMProvider):
     def __init__(self, model_name: str = None, api_key: str = None):
         # For Doubao, model_name should really be the Endpoint ID
+        # model_name 只用来确定上下文窗口大小（如 doubao-pro-32k）
+        self.model_name = model_name or "doubao-pro-32k"
         self.api_key = api_key or os.environ.get("VOLCENGINE_API_KEY")
         self.endpoint_id = os.environ.get("DOUBAO_ENDPOINT_ID")
         # Use OpenAI client for Doubao (Compatible mode)
-        self.client = openai.AsyncOpenAI(
-            api_key=self.api_key,
-            base_url="https://ark.cn-beijing.volces.com/api/v3"
+        self.client = registry.openai_client(
+            "doubao",
+            self.api_key,
+            base_url=os.environ.get("DOUBAO_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
         )
 
     @property
     def name(self) -> str:
         return "Doubao"
 
-    async def generate_response(self, messages: List[dict]) -> str:
-        # ...existing code...
-        try:
-            if not self.endpoint_id:
-                return "Error: DOUBAO_ENDPOINT_ID not configured."
-
-            # Doubao requires the 'model' parameter to be the Endpoint ID
-            completion = await self.client.chat.completions.create(
-                model=self.endpoint_id,
-                messages=formatted_msgs,
-            )
-            return completion.choices[0].message.content
-        except Exception as e:
-            return f"Error from Doubao: {str(e)}"
-
-    async def stream_response(self, messages: List[dict]) -> AsyncGenerator[str, None]:
-        formatted_msgs = [{"role": "system", "content": "You are Doubao, a helpful assistant in a group debate."}]
-        for m in messages:
-            role = "user" if m['role'] == "user" else "assistant"
-            content = f"[{m['name']}]: {m['content']}" if m.get('name') else m['content']
-            formatted_msgs.append({"role": role, "content": content})
-
-        try:
-            if not self.endpoint_id:
-                yield "Error: DOUBAO_ENDPOINT_ID not configured."
-                return
-
-            stream = await self.client.chat.completions.create(
-                model=self.endpoint_id,
-                messages=formatted_msgs,
-                stream=True
-            )
-            async for chunk in stream:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
-        except Exception as e:
-            yield f"Error from Doubao: {str(e)}"
+    @property
+    def request_model(self) -> str:
+        # Doubao requires the 'model' parameter to be the Endpoint ID
+        return self.endpoint_id
+
+    async def generate_response(self, messages: List[dict], usage: Optional[PromptUsage] = None) -> str:
+        if not self.endpoint_id:
+            raise RuntimeError("DOUBAO_ENDPOINT_ID not configured.")
+        return await super().generate_response(messages, usage)
+
+    async def stream_response(self, messages: List[dict], usage: Optional[PromptUsage] = None,
+                              prefix: str = "") -> AsyncGenerator[str, None]:
+        if not self.endpoint_id:
+            raise RuntimeError("DOUBAO_ENDPOINT_ID not configured.")
+        async for chunk in super().stream_response(messages, usage, prefix):
+            yield chunk
 
 def get_provider(name: str) -> LLMProvider:
-    if "gpt" in name.lower():
-        return OpenAIProvider(model_name=name)
-    elif "claude" in name.lower():
-        return ClaudeProvider(model_name=name)
-    elif "deepseek" in name.lower():
-        return DeepSeekProvider(model_name=name)
-    elif "grok" in name.lower():
-        return GrokProvider(model_name=name)
-    elif "gemini" in name.lower():
-        return GeminiProvider(model_name=name)
-    elif "qwen" in name.lower():
-        return QwenProvider(model_name=name)
-    elif "doubao" in name.lower():
-        return DoubaoProvider(model_name=name)
-    else:
-        # Default fallback
-        return OpenAIProvider(model_name="gpt-3.5-turbo")
+    """返回进程内共享的 Provider 实例；未知的模型名抛出 UnknownModelError"""
+    return registry.get(name)
@@ -0,0 +1,225 @@
+"""模拟 OpenAI 兼容的 chat/completions 上游，用于压测，不花真实 API 费用
+
+可配置首 token 延迟（TTFT）、输出速度（tokens/s）、每次回复的 token 数、错误率和中途断流的比例；
+续写请求（DeepSeek 前缀续写、DashScope partial 模式、追加 CONTINUE_PROMPT）从前缀之后接着输出；
+返回的 usage 里按与上一次请求相同的消息前缀估算缓存命中的 token 数，
+格式与 DeepSeek（prompt_cache_hit_tokens）和 OpenAI（prompt_tokens_details）一致。
+
+单独运行（在 backend 目录下）：
+    python loadtest/fake_upstream.py --port 18555 --ttft-ms 300 --tps 40
+然后设置 DEEPSEEK_BASE_URL / DOUBAO_BASE_URL / OPENAI_BASE_URL=http://127.0.0.1:18555/v1
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass
+from typing import Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_builder import count_message_tokens  # noqa: E402
+from llm_providers import CONTINUE_PROMPT  # noqa: E402
+
+# 回复内容从这段文字里循环取，每个字算一个 token
+REPLY_TEXT = "我认为这个问题需要从多个角度来看待，技术进步会改变工作的形态，但同时也会创造新的岗位和机会。"
+
+
+@dataclass
+class FakeUpstreamConfig:
+    ttft_ms: float = 300.0
+    tokens_per_sec: float = 40.0
+    reply_tokens: int = 120
+    error_rate: float = 0.0
+    # 每个模型同时处理的请求数上限，超出时返回 429 和 Retry-After（0 表示不限制）
+    max_concurrent: int = 0
+    # 流式回复输出到一半时断开连接的比例
+    drop_rate: float = 0.0
+    # TTFT 和每个 token 间隔的随机抖动比例
+    jitter: float = 0.1
+
+
+def _prompt_tokens(messages: List[dict]) -> List[int]:
+    return [count_message_tokens(m.get("name"), str(m.get("content") or "")) for m in messages]
+
+
+def create_app(config: FakeUpstreamConfig) -> FastAPI:
+    app = FastAPI()
+    # 每个模型上一次请求的消息，用来模拟前缀缓存
+    last_prompts: Dict[str, List[dict]] = {}
+    stats = {"requests": 0, "errors": 0, "rate_limited": 0, "dropped": 0, "continuations": 0}
+    in_flight: Dict[str, int] = {}
+
+    def usage_for(model: str, messages: List[dict], completion_tokens: int) -> dict:
+        counts = _prompt_tokens(messages)
+        previous = last_prompts.get(model, [])
+        shared = 0
+        for old, new in zip(previous, messages):
+            if old != new:
+                break
+            shared += 1
+        last_prompts[model] = messages
+        prompt_tokens = sum(counts)
+        # 上游缓存按 64 token 的块命中
+        cached = sum(counts[:shared]) // 64 * 64
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_cache_hit_tokens": cached,
+            "prompt_cache_miss_tokens": prompt_tokens - cached,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+    def jittered(seconds: float) -> float:
+        return max(seconds * random.uniform(1 - config.jitter, 1 + config.jitter), 0)
+
+    def reply_tokens() -> List[str]:
+        text = REPLY_TEXT * (config.reply_tokens // len(REPLY_TEXT) + 1)
+        return list(text[:config.reply_tokens])
+
+    def continued_from(messages: List[dict]) -> int:
+        """续写请求中已输出的字数，不是续写时返回 0"""
+        if messages and messages[-1].get("role") == "assistant" and (messages[-1].get("prefix") or messages[-1].get("partial")):
+            return len(messages[-1].get("content") or "")
+        if len(messages) >= 2 and messages[-1].get("content") == CONTINUE_PROMPT and messages[-2].get("role") == "assistant":
+            return len(messages[-2].get("content") or "")
+        return 0
+
+    @app.post("/v1/chat/completions")
+    @app.post("/chat/completions")
+    @app.post("/v1/beta/chat/completions")
+    @app.post("/beta/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        model = body.get("model", "fake")
+        messages = body.get("messages", [])
+
+        if random.random() < config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(
+                {"error": {"message": "simulated upstream error", "type": "server_error"}},
+                status_code=500
+            )
+
+        if config.max_concurrent and in_flight.get(model, 0) >= config.max_concurrent:
+            stats["rate_limited"] += 1
+            return JSONResponse(
+                {"error": {"message": "simulated rate limit", "type": "rate_limit_error"}},
+                status_code=429, headers={"Retry-After": "1"}
+            )
+        in_flight[model] = in_flight.get(model, 0) + 1
+
+        tokens = reply_tokens()
+        skip = continued_from(messages)
+        if skip:
+            stats["continuations"] += 1
+            tokens = tokens[skip:]
+        drop_at = random.randrange(1, len(tokens)) if len(tokens) > 1 and random.random() < config.drop_rate else None
+        created = int(time.time())
+        completion_id = f"chatcmpl-fake-{stats['requests']}"
+
+        if not body.get("stream"):
+            try:
+                await asyncio.sleep(jittered(config.ttft_ms / 1000 + len(tokens) / config.tokens_per_sec))
+            finally:
+                in_flight[model] -= 1
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage_for(model, messages, len(tokens)),
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunk(delta: dict, finish_reason=None) -> str:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        async def events():
+            try:
+                async for event in stream_events():
+                    yield event
+            finally:
+                in_flight[model] -= 1
+
+        async def stream_events():
+            await asyncio.sleep(jittered(config.ttft_ms / 1000))
+            yield chunk({"role": "assistant", "content": ""})
+            interval = 1 / config.tokens_per_sec
+            for i, token in enumerate(tokens):
+                if i == drop_at:
+                    stats["dropped"] += 1
+                    raise ConnectionResetError("simulated dropped stream")
+                yield chunk({"content": token})
+                await asyncio.sleep(jittered(interval))
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                data = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [],
+                    "usage": usage_for(model, messages, len(tokens)),
+                }
+                yield f"data: {json.dumps(data)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/v1/models")
+    @app.get("/models")
+    async def models():
+        # 预热请求会访问 base_url，这里给个正常响应
+        return {"object": "list", "data": [{"id": "fake", "object": "model"}]}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible streaming upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18555)
+    parser.add_argument("--ttft-ms", type=float, default=300.0)
+    parser.add_argument("--tps", type=float, default=40.0, help="每秒输出 token 数")
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrent", type=int, default=0, help="每个模型的并发上限，超出返回 429")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="流式回复中途断开的比例")
+    args = parser.parse_args()
+
+    config = FakeUpstreamConfig(ttft_ms=args.ttft_ms, tokens_per_sec=args.tps,
+                                reply_tokens=args.reply_tokens, error_rate=args.error_rate,
+                                max_concurrent=args.max_concurrent, drop_rate=args.drop_rate)
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
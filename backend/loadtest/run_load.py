@@ -0,0 +1,369 @@
+"""/ws/debate 端到端压测：N 个并发 WebSocket 客户端各自跑一场辩论
+
+默认在本进程内启动模拟上游（fake_upstream.py）和后端（一个 uvicorn worker），
+通过 DEEPSEEK_BASE_URL / DOUBAO_BASE_URL / OPENAI_BASE_URL / DASHSCOPE_BASE_URL 把 Provider 指向模拟上游，
+不会请求真实 API。结束后按百分位输出：
+  - ttft            stream_start 到第一帧 stream_delta 的时间（客户端视角的首字延迟）
+  - first_token     发送辩题到收到第一帧 stream_delta 的时间
+  - inter_frame     同一 Agent 相邻两帧 stream_delta 的间隔
+  - broadcast_lag   服务端生成事件到客户端收到的时间（依赖 WS_FRAME_TIMESTAMPS=1）
+  - loop_lag        后端事件循环的调度延迟（仅进程内模式）
+以及进程 RSS 的增长，和每场辩论的字节数（payload 为解压后的帧内容，wire 为实际收到的 TCP 字节，含压缩）。
+
+用法（在 backend 目录下）：
+    python loadtest/run_load.py --clients 50 --rounds 2
+    python loadtest/run_load.py --clients 200 --ramp 10 --ttft-ms 800 --tps 30 --error-rate 0.02
+    python loadtest/run_load.py --target ws://127.0.0.1:8000/ws/debate   # 压已经在运行的后端
+    python loadtest/run_load.py --proto compact --enc msgpack             # 紧凑协议；--no-deflate 关闭压缩对比
+
+进程内模式下客户端、后端和模拟上游共用一个 Python 进程（GIL），数字偏保守；
+要更接近线上，可以单独启动模拟上游和后端（后端加 WS_FRAME_TIMESTAMPS=1），再用 --target 压测。
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import uvicorn  # noqa: E402
+import websockets  # noqa: E402
+from websockets.asyncio.client import ClientConnection  # noqa: E402
+
+from loadtest.fake_upstream import FakeUpstreamConfig, create_app  # noqa: E402
+from wire import expand  # noqa: E402
+from ws_protocol import TunedWebSocketProtocol  # noqa: E402
+
+TOPIC = "人工智能是否会取代人类工作？"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_bytes() -> int:
+    """当前进程的常驻内存（Linux 读 /proc，其他平台退回到峰值 RSS）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class ServerThread:
+    """在独立线程和事件循环里运行一个 uvicorn Server"""
+
+    def __init__(self, app, port: int, **config):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", **config))
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        async def serve():
+            self.loop = asyncio.get_running_loop()
+            await self.server.serve()
+        asyncio.run(serve())
+
+    def start(self, timeout: float = 10.0):
+        self.thread.start()
+        deadline = time.time() + timeout
+        while not self.server.started:
+            if time.time() > deadline or not self.thread.is_alive():
+                raise RuntimeError("server failed to start")
+            time.sleep(0.02)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+async def monitor_loop_lag(samples: List[float], stop: threading.Event, interval: float = 0.05):
+    """在被测事件循环里周期性 sleep，实际醒来时间比预期晚多少就是调度延迟"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(loop.time() - start - interval, 0.0))
+
+
+class CountingConnection(ClientConnection):
+    """记录从 socket 收到的原始字节数（压缩后、含帧头）"""
+
+    wire_bytes = 0
+
+    def data_received(self, data: bytes):
+        self.wire_bytes += len(data)
+        super().data_received(data)
+
+
+@dataclass
+class ClientResult:
+    ttft: List[float] = field(default_factory=list)
+    first_token: Optional[float] = None
+    inter_frame: List[float] = field(default_factory=list)
+    broadcast_lag: List[float] = field(default_factory=list)
+    frames: int = 0
+    bytes: int = 0
+    wire_bytes: int = 0
+    turns: int = 0
+    duration: float = 0.0
+    error: Optional[str] = None
+
+
+async def run_client(url: str, args, delay: float) -> ClientResult:
+    result = ClientResult()
+    await asyncio.sleep(delay)
+    room_id = f"load-{uuid.uuid4().hex[:12]}"
+    request = {
+        "content": TOPIC,
+        "timestamp": time.time(),
+        "agents": args.agents,
+        "rounds": args.rounds,
+        "summarizer": args.summarizer,
+        "parallel": args.parallel,
+    }
+    query = f"room={room_id}"
+    if args.proto == "compact":
+        query += f"&proto=compact&enc={args.enc}"
+        if args.enc == "msgpack":
+            import msgpack
+    agents: Dict[int, str] = {}
+    stream_started: Dict[str, float] = {}
+    last_delta: Dict[str, float] = {}
+    debate_complete = False
+    start = time.perf_counter()
+    try:
+        async with websockets.connect(f"{url}?{query}", max_size=None, create_connection=CountingConnection,
+                                      compression=None if args.no_deflate else "deflate") as ws:
+            await ws.send(json.dumps(request, ensure_ascii=False))
+            sent = time.perf_counter()
+            async with asyncio.timeout(args.timeout):
+                async for raw in ws:
+                    now = time.perf_counter()
+                    received_at = time.time()
+                    result.frames += 1
+                    if isinstance(raw, bytes):
+                        result.bytes += len(raw)
+                        frame = msgpack.unpackb(raw, strict_map_key=False)
+                    else:
+                        result.bytes += len(raw.encode())
+                        frame = json.loads(raw)
+                    if args.proto == "compact":
+                        frame = expand(frame, agents)
+                        if frame is None:
+                            continue
+                    if "ts" in frame:
+                        result.broadcast_lag.append(max(received_at - frame["ts"], 0.0))
+
+                    frame_type = frame.get("type")
+                    if frame_type == "stream_start":
+                        stream_started[frame.get("stream") or frame["data"].get("name")] = now
+                    elif frame_type == "stream_delta":
+                        agent = frame.get("stream") or frame.get("agent")
+                        if result.first_token is None:
+                            result.first_token = now - sent
+                        if agent in last_delta:
+                            result.inter_frame.append(now - last_delta[agent])
+                        elif agent in stream_started:
+                            result.ttft.append(now - stream_started[agent])
+                        last_delta[agent] = now
+                    elif frame_type == "stream_end":
+                        result.turns += 1
+                        agent = frame.get("stream") or frame.get("agent")
+                        last_delta.pop(agent, None)
+                        stream_started.pop(agent, None)
+                    elif frame_type == "debate_complete":
+                        debate_complete = True
+                    elif frame_type == "message" and debate_complete:
+                        # 总结之后的最终系统消息（成功或失败）标志本场辩论结束
+                        content = frame.get("data", {}).get("content", "")
+                        if content.startswith("✨") or content.startswith("⚠️ 总结生成失败"):
+                            break
+            result.wire_bytes = ws.wire_bytes
+    except TimeoutError:
+        result.error = "timeout"
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.duration = time.perf_counter() - start
+    return result
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+    return {"count": len(ordered), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": ordered[-1]}
+
+
+def print_report(results: List[ClientResult], loop_lag: List[float], rss: Dict[str, int], elapsed: float) -> dict:
+    errors = [r.error for r in results if r.error]
+    metrics = {
+        "ttft": percentiles([t for r in results for t in r.ttft]),
+        "first_token": percentiles([r.first_token for r in results if r.first_token is not None]),
+        "inter_frame": percentiles([t for r in results for t in r.inter_frame]),
+        "broadcast_lag": percentiles([t for r in results for t in r.broadcast_lag]),
+        "loop_lag": percentiles(loop_lag),
+        "debate_duration": percentiles([r.duration for r in results if not r.error]),
+    }
+    frames = sum(r.frames for r in results)
+    total_bytes = sum(r.bytes for r in results)
+    wire_bytes = sum(r.wire_bytes for r in results)
+    debates = max(len(results) - len(errors), 1)
+
+    print(f"\nclients {len(results)}, completed {len(results) - len(errors)}, errors {len(errors)}, "
+          f"wall {elapsed:.1f}s, turns {sum(r.turns for r in results)}")
+    print(f"frames {frames} ({frames / elapsed:.0f}/s), bytes {total_bytes / 1e6:.1f} MB ({total_bytes / elapsed / 1e6:.2f} MB/s)")
+    print(f"per debate: payload {total_bytes / debates / 1024:.1f} KB, wire {wire_bytes / debates / 1024:.1f} KB")
+    print(f"\n{'metric (ms)':<18} {'count':>8} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+    for name, p in metrics.items():
+        if not p:
+            print(f"{name:<18} {'-':>8}")
+            continue
+        print(f"{name:<18} {p['count']:>8} {p['p50'] * 1000:9.1f} {p['p90'] * 1000:9.1f} "
+              f"{p['p99'] * 1000:9.1f} {p['max'] * 1000:9.1f}")
+    if rss:
+        print(f"\nRSS start {rss['start'] / 2**20:.1f} MB, peak {rss['peak'] / 2**20:.1f} MB, "
+              f"end {rss['end'] / 2**20:.1f} MB, growth {(rss['end'] - rss['start']) / 2**20:+.1f} MB")
+    if errors:
+        distinct = sorted(set(errors))
+        print(f"\nerrors ({len(errors)}): " + "; ".join(distinct[:5]))
+
+    return {
+        "clients": len(results),
+        "errors": len(errors),
+        "wall_seconds": elapsed,
+        "frames": frames,
+        "bytes": total_bytes,
+        "wire_bytes": wire_bytes,
+        "metrics": metrics,
+        "rss": rss,
+    }
+
+
+async def drive(url: str, args) -> List[ClientResult]:
+    delays = [args.ramp * i / max(args.clients, 1) for i in range(args.clients)]
+    return await asyncio.gather(*[run_client(url, args, d) for d in delays])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="End-to-end load test for /ws/debate")
+    parser.add_argument("--clients", type=int, default=20, help="并发客户端（房间）数")
+    parser.add_argument("--ramp", type=float, default=0.0, help="在多少秒内逐步启动所有客户端")
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--agents", default="deepseek-chat,doubao-pro-32k,gpt-4o",
+                        help="逗号分隔；只有走 OpenAI 兼容接口的模型会被指向模拟上游")
+    parser.add_argument("--summarizer", default="deepseek-chat")
+    parser.add_argument("--parallel", action="store_true", help="每轮所有 Agent 同时发言")
+    parser.add_argument("--timeout", type=float, default=300.0, help="单个客户端的超时（秒）")
+    parser.add_argument("--ttft-ms", type=float, default=300.0, help="模拟上游的首 token 延迟")
+    parser.add_argument("--tps", type=float, default=40.0, help="模拟上游每秒输出 token 数")
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游返回 500 的比例（会自动重试）")
+    parser.add_argument("--upstream-max-concurrent", type=int, default=0,
+                        help="模拟上游每个模型的并发上限，超出返回 429")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="模拟上游流式回复中途断开的比例（会自动续写）")
+    parser.add_argument("--upstream", help="使用已经在运行的模拟上游，例如 http://127.0.0.1:18555/v1")
+    parser.add_argument("--target", help="压测已经在运行的后端，例如 ws://127.0.0.1:8000/ws/debate")
+    parser.add_argument("--proto", choices=["json", "compact"], default="json", help="WebSocket 帧协议")
+    parser.add_argument("--enc", choices=["json", "msgpack"], default="json", help="紧凑协议的编码")
+    parser.add_argument("--no-deflate", action="store_true", help="不协商 permessage-deflate")
+    parser.add_argument("--json", dest="json_path", help="把结果写入 JSON 文件")
+    args = parser.parse_args()
+    args.agents = [a.strip() for a in args.agents.split(",") if a.strip()]
+
+    upstream_server = None
+    backend_server = None
+    loop_lag: List[float] = []
+    stop_monitor = threading.Event()
+    rss: Dict[str, int] = {}
+
+    if not args.target:
+        upstream_url = args.upstream
+        if not upstream_url:
+            port = free_port()
+            config = FakeUpstreamConfig(ttft_ms=args.ttft_ms, tokens_per_sec=args.tps,
+                                        reply_tokens=args.reply_tokens, error_rate=args.error_rate,
+                                        max_concurrent=args.upstream_max_concurrent, drop_rate=args.drop_rate)
+            upstream_server = ServerThread(create_app(config), port)
+            upstream_server.start()
+            upstream_url = f"http://127.0.0.1:{port}/v1"
+
+        # 配置必须在导入 main 之前写入环境变量（各模块在导入时读取）
+        for key in ("DEEPSEEK_BASE_URL", "DOUBAO_BASE_URL", "OPENAI_BASE_URL", "DASHSCOPE_BASE_URL"):
+            os.environ[key] = upstream_url
+        for key in ("DEEPSEEK_API_KEY", "VOLCENGINE_API_KEY", "OPENAI_API_KEY", "DASHSCOPE_API_KEY"):
+            os.environ[key] = "loadtest"
+        os.environ.setdefault("DOUBAO_ENDPOINT_ID", "fake-endpoint")
+        os.environ["WS_FRAME_TIMESTAMPS"] = "1"
+        os.environ["LLM_WARMUP"] = "0"
+        # 所有模拟客户端来自同一个 IP，关闭按客户端的配额；全局并发上限仍按环境变量生效
+        os.environ["CLIENT_MAX_DEBATES"] = "0"
+        # 记录照常写入（计入开销），但写到临时目录
+        os.environ.setdefault("TRANSCRIPT_DB", os.path.join(tempfile.mkdtemp(prefix="aidebate-load-"), "transcripts.db"))
+
+        from main import app
+        port = free_port()
+        backend_server = ServerThread(app, port, ws=TunedWebSocketProtocol)
+        backend_server.start()
+        asyncio.run_coroutine_threadsafe(monitor_loop_lag(loop_lag, stop_monitor), backend_server.loop)
+        url = f"ws://127.0.0.1:{port}/ws/debate"
+        rss["start"] = rss["peak"] = rss_bytes()
+        print(f"backend {url}, upstream {upstream_url}")
+    else:
+        url = args.target
+
+    print(f"{args.clients} clients x {args.rounds} round(s), agents {', '.join(args.agents)}"
+          f"{' (parallel)' if args.parallel else ''}")
+
+    sampling = threading.Event()
+
+    def sample_rss():
+        while not sampling.wait(0.5):
+            rss["peak"] = max(rss["peak"], rss_bytes())
+
+    sampler = None
+    if rss:
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+    started = time.perf_counter()
+    results = asyncio.run(drive(url, args))
+    elapsed = time.perf_counter() - started
+
+    stop_monitor.set()
+    sampling.set()
+    if sampler is not None:
+        sampler.join()
+        rss["end"] = rss_bytes()
+        rss["peak"] = max(rss["peak"], rss["end"])
+
+    report = print_report(results, loop_lag, rss, elapsed)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if backend_server is not None:
+        backend_server.stop()
+    if upstream_server is not None:
+        upstream_server.stop()
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
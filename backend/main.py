@@ -1,14 +1,51 @@
 import asyncio
 import os
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import time
+import uuid
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import json
-from schemas import DebateRequest, Message
-from llm_providers import get_provider
+from contextlib import asynccontextmanager
+from schemas import DEBATE_MAX_AGENTS, DEBATE_MAX_ROUNDS, DebateRequest, DebateResponse, Message
+from llm_providers import LLMProvider, PromptUsage, get_provider, registry
 from web_search import WebSearcher
+from rooms import ROOM_ID_PATTERN, ClientConnection, DebateRoom, RoomRegistry
+from sse import SSE_HEADERS, SSEConnection
+from streaming import DeltaCoalescer, GuardedStream, fallback_for
+from transcript_store import create_store
+from event_bus import create_event_bus
+from web_search import search_cache
+from message_format import render_text
+from context_builder import count_message_tokens
+from summaries import ROUND_DIGEST_MODEL, ROUND_DIGESTS, RoundDigester
+from scheduler import DebateScheduler, ProviderLimiter, SchedulerRejected
+from wire import WireCodec, negotiate
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+import metrics
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动时在后台预热常用 Provider 的连接池（LLM_WARMUP=0 关闭），退出时关闭连接
+    warm_up = None
+    if os.environ.get("LLM_WARMUP", "1") == "1":
+        warm_up = asyncio.create_task(registry.warm_up(default_agents()))
+    await transcripts.start()
+    await event_bus.start(rooms)
+    # 定期按保留策略回收空闲房间，进程内存不随运行时间线性增长
+    sweeper = asyncio.create_task(rooms.sweep_forever())
+    yield
+    sweeper.cancel()
+    if warm_up is not None:
+        warm_up.cancel()
+    await registry.aclose()
+    await event_bus.close()
+    # 把尚未落盘的历史消息写完
+    await transcripts.close()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,92 +57,359 @@ app.add_middleware(
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, room: DebateRoom, since: Optional[int] = None,
+                      codec: Optional[WireCodec] = None):
         await websocket.accept()
-        self.active_connections.append(websocket)
-        # 发送现有历史记录给新连接的用户
-        if chat_history:
-            # 发送历史消息
-            for msg in chat_history:
-                await websocket.send_json({"type": "message", "data": msg})
-            
-            # 发送系统提示，表明是重连
-            await websocket.send_json({
-                "type": "message", 
-                "data": {
-                    "role": "system", 
-                    "content": "🔄 已恢复连接，加载历史记录..."
-                }
-            })
+        connection = ClientConnection(websocket, room, codec)
+        self.active_connections[websocket] = connection
+        connection.start()
+        # 告诉客户端房间 ID，客户端重连时带上 ?room=<id>&since=<seq> 即可续传；
+        # 协商了紧凑协议时同时告知实际生效的编码
+        session = {"type": "session", "room_id": room.id, "head_seq": room.seq}
+        if codec is not None:
+            session.update(proto="compact", enc=codec.encoding)
+        connection.send_event(session)
+        room.join(connection, since)
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: dict):
-        # 对副本进行迭代，防止在迭代过程中修改列表
-        for connection in list(self.active_connections):
-            try:
-                await connection.send_json(message)
-            except Exception:
-                # 发送失败则认为连接已断开
-                self.disconnect(connection)
+        connection = self.active_connections.pop(websocket, None)
+        if connection is not None:
+            connection.close()
 
 manager = ConnectionManager()
 
-# 模拟存储会话历史
-chat_history: List[dict] = []
+# 每个辩论会话（房间）各自保存历史记录，并持久化到记录存储（默认 SQLite）
+# 多 worker 部署时通过事件总线（EVENT_BUS_URL）共享房间事件和历史
+transcripts = create_store()
+event_bus = create_event_bus()
+rooms = RoomRegistry(transcripts, event_bus)
+
+# 同时进行的辩论数和打到每个 Provider 的并发请求数都有上限，超出的辩论排队
+scheduler = DebateScheduler()
+provider_limits = ProviderLimiter()
+
+# 连接数、房间数、历史大小等状态在 /metrics 被抓取时才读取
+metrics.register_state(
+    connections=lambda: len(manager.active_connections),
+    rooms=lambda: rooms.rooms,
+    search_stats=search_cache.stats
+)
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+# 管理接口的令牌；未设置时管理接口不可用
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+def require_admin(authorization: Optional[str], x_admin_token: Optional[str]):
+    token = x_admin_token or (authorization or "").removeprefix("Bearer ").strip()
+    if not ADMIN_TOKEN or token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/debug/memory")
+def memory_report(authorization: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
+    """历史记录和各类缓存的内存占用；包含房间 ID，需要管理令牌"""
+    require_admin(authorization, x_admin_token)
+    report = rooms.memory_report()
+    report["caches"] = {
+        "render_text": render_text.cache_info()._asdict(),
+        "count_message_tokens": count_message_tokens.cache_info()._asdict(),
+        "search": search_cache.stats(),
+    }
+    return report
+
+@app.get("/admin/debates")
+def list_debates(authorization: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
+    """正在进行和排队中的辩论"""
+    require_admin(authorization, x_admin_token)
+    return {
+        "running": scheduler.running,
+        "queued": scheduler.queued,
+        "max_concurrent": scheduler.max_concurrent,
+        "debates": scheduler.list(),
+        "providers": provider_limits.stats(),
+    }
+
+@app.delete("/admin/debates/{job_id}")
+async def cancel_debate(job_id: str, authorization: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
+    """取消一场辩论：排队中的直接移出队列，进行中的在当前位置中断"""
+    require_admin(authorization, x_admin_token)
+    if not await scheduler.cancel(job_id):
+        raise HTTPException(status_code=404, detail="Debate not found")
+    return {"id": job_id, "cancelled": True}
+
+@app.get("/rooms/{room_id}/messages")
+async def room_messages(room_id: str, before: Optional[int] = Query(None, ge=0), limit: int = Query(50, ge=1, le=500)):
+    """分页读取房间的历史消息：返回序号小于 before 的最近 limit 条，客户端向上滚动时按需加载"""
+    rows = await rooms.page(room_id, before, limit)
+    return {
+        "room_id": room_id,
+        "messages": [{**message, "seq": seq} for seq, message in rows],
+        "has_more": bool(rows) and rows[0][0] > 0,
+    }
+
+@app.post("/debates", response_model=DebateResponse)
+async def create_debate(debate: DebateRequest, request: Request):
+    """不建立 WebSocket 发起一场辩论；返回的 id 用于订阅 GET /debates/{id}/events"""
+    room = await rooms.get_or_create()
+    data_json = {
+        "content": debate.topic,
+        "timestamp": time.time(),
+        "agents": debate.selected_agents,
+        "rounds": debate.rounds,
+        "summarizer": debate.summarizer,
+        "parallel": debate.parallel,
+        "enable_web_search": debate.enable_web_search,
+    }
+    try:
+        job = await start_debate(room, client_address(request), data_json)
+    except SchedulerRejected as e:
+        rooms.discard(room)
+        raise HTTPException(status_code=429, detail=str(e))
+    message = "辩论已开始" if job.state == "running" else "服务器繁忙，辩论已进入队列"
+    return DebateResponse(status=job.state, message=message, id=room.id, job_id=job.id)
+
+@app.get("/debates/{debate_id}/events")
+async def debate_events(debate_id: str, since: Optional[int] = Query(None, ge=0),
+                        last_event_id: Optional[str] = Header(None)):
+    """辩论事件的 SSE 流；断线重连时按 Last-Event-ID（或 ?since=）补发错过的事件"""
+    if not ROOM_ID_PATTERN.match(debate_id):
+        raise HTTPException(status_code=404, detail="Debate not found")
+    # 不存在的 ID 不会创建房间
+    room = await rooms.find(debate_id)
+    if room is None or (not room.seq and not room.history):
+        raise HTTPException(status_code=404, detail="Debate not found")
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    connection = SSEConnection(room)
+    connection.send_event({"type": "session", "room_id": room.id, "head_seq": room.seq})
+    room.join(connection, since)
+    return StreamingResponse(connection.stream(), media_type="text/event-stream", headers=SSE_HEADERS)
 
 @app.websocket("/ws/debate")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    room = await rooms.get_or_create(websocket.query_params.get("room"))
+    since = websocket.query_params.get("since")
+    # ?proto=compact[&enc=msgpack] 协商紧凑协议，不带参数的老客户端仍使用 JSON
+    codec = negotiate(websocket.query_params.get("proto"), websocket.query_params.get("enc"))
+    await manager.connect(websocket, room, int(since) if since and since.isdigit() else None, codec)
     try:
         while True:
             data = await websocket.receive_text()
             data_json = json.loads(data)
-            
-            # 用户发送的消息
-            user_msg = Message(
-                role="user",
-                name="User",
-                content=data_json.get("content"),
-                timestamp=data_json.get("timestamp")
-            )
-            chat_history.append(user_msg.dict())
-            
-            # 广播用户的消息给所有（虽然主要是给自己看回显）
-            await manager.broadcast({"type": "message", "data": user_msg.dict()})
-
-            # 使用 asyncio.create_task 在后台运行辩论过程
-            # 这样即使用户连接断开（例如手机切后台），辩论仍然继续，
-            # 用户重新连接后可以通过 connect 方法中的历史记录回放看到进展
-            asyncio.create_task(run_debate(data_json, user_msg))
+            try:
+                await start_debate(room, client_address(websocket), data_json)
+            except SchedulerRejected as e:
+                # 只告诉发起的客户端；房间里可能有正在进行的辩论，其他人的状态不受影响
+                connection = manager.active_connections.get(websocket)
+                if connection is not None:
+                    connection.send_event({"type": "message", "data": {"role": "system", "content": f"⚠️ {e}"}})
+                    connection.send_event({"type": "debate_complete", "rejected": True})
                 
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception as e:
         print(f"Error: {e}")
         try:
-            await manager.broadcast({"type": "message", "data": {"role": "system", "content": f"Server Error: {str(e)}"}})
+            await room.broadcast({"type": "message", "data": {"role": "system", "content": f"Server Error: {str(e)}"}})
         except:
             pass
         manager.disconnect(websocket)
 
-async def run_debate(data_json: dict, user_msg: Message):
+async def start_debate(room: DebateRoom, client: str, data_json: dict):
+    """把辩论交给调度器，被接受后写入并广播用户的辩题；队列满或超出配额时抛出 SchedulerRejected"""
+    # 用户发送的消息
+    user_msg = Message(
+        role="user",
+        name="User",
+        content=data_json.get("content"),
+        timestamp=data_json.get("timestamp")
+    )
+
+    # 辩题在完整记录中的序号：本场辩论的提示词从这里开始，不包含房间里之前的辩论
+    topic_index = None
+
+    async def record_topic():
+        nonlocal topic_index
+        topic_index = await room.append(user_msg.dict())
+        # 广播用户的消息给房间内所有人（虽然主要是给自己看回显）
+        await room.broadcast({"type": "message", "data": user_msg.dict()})
+
+    # 辩论交给调度器在后台运行，超过并发上限时排队
+    # 这样即使用户连接断开（例如手机切后台），辩论仍然继续，
+    # 用户带着房间 ID 和最后收到的序号重新连接后，connect 方法会补发错过的事件
+    return await scheduler.submit(
+        room, client, user_msg.content or "",
+        lambda: track_debate(room, run_debate(room, data_json, user_msg, topic_index)),
+        on_accept=record_topic
+    )
+
+def client_address(connection: HTTPConnection) -> str:
+    """客户端 IP，用于按客户端分配配额
+
+    不直接读取 X-Forwarded-For：只有来自 FORWARDED_ALLOW_IPS 中代理的请求，uvicorn 才会用它改写 client.host，
+    直连后端的客户端无法伪造 IP 绕过配额。
+    """
+    return connection.client.host if connection.client else "unknown"
+
+def default_agents() -> List[str]:
+    """检查环境变量，哪个 Key 存在就启用哪个 Agent"""
+    available_agents = []
+    # 暂时注释掉无法付费的 AI
+    # if os.environ.get("OPENAI_API_KEY") and "your_" not in os.environ.get("OPENAI_API_KEY"):
+    #     available_agents.append("gpt-4o")
+    # if os.environ.get("ANTHROPIC_API_KEY") and "your_" not in os.environ.get("ANTHROPIC_API_KEY"):
+    #     available_agents.append("claude-3-5-sonnet")
+    # if os.environ.get("XAI_API_KEY") and "your_" not in os.environ.get("XAI_API_KEY"):
+    #     available_agents.append("grok-beta")
+    # if os.environ.get("GOOGLE_API_KEY") and "your_" not in os.environ.get("GOOGLE_API_KEY"):
+    #     available_agents.append("gemini-2.0-flash")
+
+    if os.environ.get("DEEPSEEK_API_KEY") and "your_" not in os.environ.get("DEEPSEEK_API_KEY"):
+        available_agents.append("deepseek-chat")
+    
+    if os.environ.get("DASHSCOPE_API_KEY") and "your_" not in os.environ.get("DASHSCOPE_API_KEY"):
+        available_agents.append("qwen-turbo")
+    
+    if os.environ.get("VOLCENGINE_API_KEY") and "your_" not in os.environ.get("VOLCENGINE_API_KEY"):
+        available_agents.append("doubao-pro-32k")
+
+    # 如果一个 key 都没有，就 fallback 到全选（即使会报错，方便用户知道有哪些）
+    if not available_agents:
+        # available_agents = ["deepseek-chat", "qwen-turbo", "doubao-pro-32k"]
+        available_agents = ["deepseek-chat"] # 最低保底
+    return available_agents
+
+def fallback_provider(provider: LLMProvider) -> Optional[LLMProvider]:
+    """STREAM_FALLBACKS 中为该 Provider 配置的备用模型"""
+    key = fallback_for(provider.name)
+    return get_provider(key) if key else None
+
+async def run_agent_turn(room: DebateRoom, agent_key: str, history: List[dict], user_msg: Message, data_json: dict) -> Tuple[dict, dict]:
+    """让一个 Agent 基于 history 流式发言
+
+    返回 (要写入历史的消息, 写入历史后要广播的结束帧)，由调用方决定何时提交。
+    """
+    provider = None
+    try:
+        provider = get_provider(agent_key)
+        
+        # 广播 typing 状态
+        await room.broadcast({
+            "type": "typing",
+            "agent": provider.name,
+            "status": True
+        })
+
+        # 初始化 AI 消息（空内容）让前端准备接收
+        agent_msg_ref = Message(
+            role="assistant",
+            name=provider.name,
+            content=""
+        )
+        # 每次发言一个流 ID：并行模式下不同模型可能同名（deepseek-chat 与 deepseek-reasoner 都叫 DeepSeek），
+        # stream_delta / stream_end 按流 ID 对应到各自的消息
+        stream_id = uuid.uuid4().hex[:8]
+        await room.broadcast({"type": "stream_start", "stream": stream_id, "data": agent_msg_ref.dict()})
+
+        full_response = ""
+        usage = PromptUsage()
+        # 合并细碎的增量片段，减少发往客户端的帧数
+        coalescer = DeltaCoalescer(room, provider.name, stream_id)
+        meter = None
+        stream = None
+        try:
+            # 使用流式调用；同一 Provider 的并发请求数受 PROVIDER_MAX_CONCURRENT 限制，等待名额的时间不计入 TTFT
+            async with provider_limits.slot(provider.name):
+                meter = metrics.StreamMeter(provider.name)
+                # 首 token / 中途停顿超过截止时间时中断，配置了备用模型时对冲
+                stream = GuardedStream(provider, history, usage, fallback=fallback_provider(provider))
+                async for chunk in stream:
+                    if chunk:
+                        meter.chunk()
+                        full_response += chunk
+                        # 广播增量内容
+                        await coalescer.push(chunk)
+        except Exception as stream_err:
+            # 续写也没能恢复；Provider 自己的错误已经计入指标，超时计入 aidebate_stream_timeouts_total
+            full_response += f"\n[Error: {stream_err}]"
+            await coalescer.push(f"\n[Error: {stream_err}]")
+        finally:
+            # 辩论被取消时停掉合并定时器，否则 stream_end 之后还会发出 stream_delta
+            coalescer.cancel()
+        if meter is not None:
+            meter.finish(usage.completion_tokens)
+        # 在 stream_end 之前发出缓冲中剩余的内容
+        await coalescer.close()
+
+        # 停止 typing
+        await room.broadcast({
+            "type": "typing",
+            "agent": provider.name,
+            "status": False
+        })
+        
+        agent_msg_ref.content = full_response
+        # 结束本次流，附带本轮 token 用量（其中多少命中了上游的提示词缓存）
+        end_frame = {"type": "stream_end", "agent": provider.name, "stream": stream_id}
+        if usage.prompt_tokens:
+            print(f"[Usage] {provider.name}: {usage}")
+            end_frame["usage"] = usage.as_dict()
+        if stream is not None and stream.provider is not provider:
+            # 本轮由备用模型完成
+            end_frame["fallback"] = stream.provider.name
+        return agent_msg_ref.dict(), end_frame
+        
+    except Exception as e:
+        # 如果 Provider 初始化本身都失败了
+        print(f"Agent Loop Error: {e}")
+        name = provider.name if provider is not None else agent_key
+        metrics.provider_error(name, e)
+        await room.broadcast({
+            "type": "typing",
+            "agent": agent_key,
+            "status": False
+        })
+        content = f"[{name} (Simulation)]: I see your point regarding '{user_msg.content}'. However, considering the data... (Error: config API Key to see real response)"
+        entry = {
+            "role": "assistant",
+            "name": name,
+            "content": content,
+            "timestamp": data_json.get("timestamp")
+        }
+        return entry, {"type": "message", "data": {"role": "assistant", "name": name, "content": content}}
+
+async def track_debate(room: DebateRoom, debate):
+    """统计正在进行的辩论数；房间的 active_debates 由调度器从提交到结束维护"""
+    metrics.DEBATES_TOTAL.inc()
+    with metrics.DEBATES_IN_FLIGHT.track_inprogress():
+        await debate
+
+async def run_debate(room: DebateRoom, data_json: dict, user_msg: Message, topic_index: int = 0):
     # 触发 AI 讨论逻辑
     # 从请求中读取，或者默认全选
-    req_agents = data_json.get("agents", [])
-    req_rounds = data_json.get("rounds", 1)  # 获取轮数，默认1轮
+    req_agents = data_json.get("agents") or []
+    if not isinstance(req_agents, list):
+        req_agents = []
+    req_agents = req_agents[:DEBATE_MAX_AGENTS]
+    # 获取轮数，默认1轮；WebSocket 消息没有经过校验，非法值按 1 轮处理
+    try:
+        req_rounds = int(data_json.get("rounds") or 1)
+    except (TypeError, ValueError):
+        req_rounds = 1
+    req_rounds = max(1, min(req_rounds, DEBATE_MAX_ROUNDS))
     req_summarizer = data_json.get("summarizer", "deepseek-chat")  # 获取总结者
     enable_web_search = data_json.get("enable_web_search", False)  # 是否启用联网搜索
+    parallel = data_json.get("parallel", False)  # 是否每轮所有 Agent 同时发言
     
     # 如果启用了联网搜索，先搜索相关信息
     search_context = ""
     if enable_web_search:
         try:
-            await manager.broadcast({
+            await room.broadcast({
                 "type": "message",
                 "data": {
                     "role": "system",
@@ -114,7 +418,7 @@ async def run_debate(data_json: dict, user_msg: Message):
             })
             
             searcher = WebSearcher()
-            search_results = searcher.search(user_msg.content, max_results=5)
+            search_results = await searcher.asearch(user_msg.content, max_results=5)
             search_context = searcher.format_search_results(search_results)
             
             # 将搜索结果添加到历史记录
@@ -123,9 +427,9 @@ async def run_debate(data_json: dict, user_msg: Message):
                 name="WebSearch",
                 content=search_context
             )
-            chat_history.append(search_msg.dict())
+            await room.append(search_msg.dict())
             
-            await manager.broadcast({
+            await room.broadcast({
                 "type": "message",
                 "data": {
                     "role": "system",
@@ -135,7 +439,7 @@ async def run_debate(data_json: dict, user_msg: Message):
             
         except Exception as search_err:
             print(f"Search error: {search_err}")
-            await manager.broadcast({
+            await room.broadcast({
                 "type": "message",
                 "data": {
                     "role": "system",
@@ -144,216 +448,176 @@ async def run_debate(data_json: dict, user_msg: Message):
             })
     
     # 如果前端没传 agents 列表，或者列表为空，我们就在后端动态决定使用哪些
-    # 逻辑：检查环境变量，哪个 Key 存在就启用哪个 Agent
-    if not req_agents:
-        available_agents = []
-        # 暂时注释掉无法付费的 AI
-        # if os.environ.get("OPENAI_API_KEY") and "your_" not in os.environ.get("OPENAI_API_KEY"):
-        #     available_agents.append("gpt-4o")
-        # if os.environ.get("ANTHROPIC_API_KEY") and "your_" not in os.environ.get("ANTHROPIC_API_KEY"):
-        #     available_agents.append("claude-3-5-sonnet")
-        # if os.environ.get("XAI_API_KEY") and "your_" not in os.environ.get("XAI_API_KEY"):
-        #     available_agents.append("grok-beta")
-        # if os.environ.get("GOOGLE_API_KEY") and "your_" not in os.environ.get("GOOGLE_API_KEY"):
-        #     available_agents.append("gemini-2.0-flash")
-
-        if os.environ.get("DEEPSEEK_API_KEY") and "your_" not in os.environ.get("DEEPSEEK_API_KEY"):
-            available_agents.append("deepseek-chat")
-        
-        if os.environ.get("DASHSCOPE_API_KEY") and "your_" not in os.environ.get("DASHSCOPE_API_KEY"):
-            available_agents.append("qwen-turbo")
-        
-        if os.environ.get("VOLCENGINE_API_KEY") and "your_" not in os.environ.get("VOLCENGINE_API_KEY"):
-            available_agents.append("doubao-pro-32k")
+    # 同一个模型列了多次时只发言一次
+    selected_agents = list(dict.fromkeys(req_agents or default_agents()))
 
-        # 如果一个 key 都没有，就 fallback 到全选（即使会报错，方便用户知道有哪些）
-        if not available_agents:
-            # available_agents = ["deepseek-chat", "qwen-turbo", "doubao-pro-32k"]
-                available_agents = ["deepseek-chat"] # 最低保底
-        
-        selected_agents = available_agents
-    else:
-        selected_agents = req_agents
-
-    # 多轮辩论循环
-    for round_num in range(1, req_rounds + 1):
-        # 广播当前轮数开始
-        await manager.broadcast({
-            "type": "round_start",
-            "round": round_num,
-            "total_rounds": req_rounds
-        })
-        
-        # 添加轮次分隔消息
-        if round_num > 1:
-            await manager.broadcast({
-                "type": "message",
-                "data": {
-                    "role": "system",
-                    "content": f"━━━━━━━━━━━━━ 第 {round_num} 轮辩论开始 ━━━━━━━━━━━━━"
-                }
-            })
+    # 每轮结束后在后台生成这一轮的概要，总结时只读概要和最后一轮
+    digester = None
+    if ROUND_DIGESTS and req_rounds > 1:
+        try:
+            digester = RoundDigester(get_provider(ROUND_DIGEST_MODEL or req_summarizer), user_msg.content, provider_limits)
+        except Exception as digest_err:
+            print(f"Digest setup error: {digest_err}")
 
-        # 异步触发每个 Agent 的回复
-        # 为了模拟群聊感觉，我们串行让它们发言，并在发言前广播 "正在输入..."
+    try:
+        # 多轮辩论循环
+        last_round: List[dict] = []
+        for round_num in range(1, req_rounds + 1):
+            round_start = room.history_end
+            # 广播当前轮数开始
+            await room.broadcast({
+                "type": "round_start",
+                "round": round_num,
+                "total_rounds": req_rounds
+            })
         
-        for agent_key in selected_agents:
-            try:
-                provider = get_provider(agent_key)
-                
-                # 广播 typing 状态
-                await manager.broadcast({
-                    "type": "typing",
-                    "agent": provider.name,
-                    "status": True
-                })
-
-                # 初始化 AI 消息（空内容）让前端准备接收
-                agent_msg_ref = Message(
-                    role="assistant",
-                    name=provider.name,
-                    content=""
-                )
-                await manager.broadcast({"type": "stream_start", "data": agent_msg_ref.dict()})
-
-                full_response = ""
-                try:
-                        # 使用流式调用
-                    async for chunk in provider.stream_response(chat_history):
-                        if chunk:
-                            full_response += chunk
-                            # 广播增量内容
-                            await manager.broadcast({
-                                "type": "stream_delta", 
-                                "agent": provider.name,
-                                "delta": chunk
-                            })
-                except Exception as stream_err:
-                    full_response += f"\n[Error: {stream_err}]"
-                    await manager.broadcast({
-                                "type": "stream_delta", 
-                                "agent": provider.name,
-                                "delta": f"\n[Error: {stream_err}]"
-                    })
-
-                # 停止 typing
-                await manager.broadcast({
-                    "type": "typing",
-                    "agent": provider.name,
-                    "status": False
-                })
-                
-                agent_msg_ref.content = full_response
-                # 存入历史
-                chat_history.append(agent_msg_ref.dict())
-                # 结束本次流
-                await manager.broadcast({"type": "stream_end", "agent": provider.name})
-                
-            except Exception as e:
-                # 如果 Provider 初始化本身都失败了
-                print(f"Agent Loop Error: {e}")
-                await manager.broadcast({
-                    "type": "typing",
-                    "agent": agent_key,
-                    "status": False
-                })
-                await manager.broadcast({
+            # 添加轮次分隔消息
+            if round_num > 1:
+                await room.broadcast({
                     "type": "message",
                     "data": {
-                        "role": "assistant",
-                        "name": provider.name,
-                        "content": f"[{provider.name} (Simulation)]: I see your point regarding '{user_msg.content}'. However, considering the data... (Error: config API Key to see real response)"
+                        "role": "system",
+                        "content": f"━━━━━━━━━━━━━ 第 {round_num} 轮辩论开始 ━━━━━━━━━━━━━"
                     }
                 })
-                chat_history.append({
-                    "role": "assistant",
-                    "name": provider.name,
-                    "content": f"[{provider.name} (Simulation)]: I see your point regarding '{user_msg.content}'. However, considering the data... (Error: config API Key to see real response)",
-                    "timestamp": data_json.get("timestamp")
-                })
+
+            # 异步触发每个 Agent 的回复
+            # 默认串行发言，模拟群聊感觉，并在发言前广播 "正在输入..."
+            # 并行模式下本轮所有 Agent 同时基于轮次开始时的历史生成，流按 agent 区分复用同一连接，
+            # 全部结束后按 selected_agents 的顺序写入历史，保证结果确定
+            if parallel:
+                round_history = room.history_since(topic_index)
+                results = await asyncio.gather(*[
+                    run_agent_turn(room, agent_key, round_history, user_msg, data_json)
+                    for agent_key in selected_agents
+                ])
+                for entry, closing_frame in results:
+                    await room.append(entry)
+                    await room.broadcast(closing_frame)
+            else:
+                for agent_key in selected_agents:
+                    entry, closing_frame = await run_agent_turn(room, agent_key, room.history_since(topic_index), user_msg, data_json)
+                    # 存入历史
+                    await room.append(entry)
+                    await room.broadcast(closing_frame)
         
-        # 广播当前轮次结束
-        await manager.broadcast({
-            "type": "round_end",
-            "round": round_num
-        })
-    
-    # 所有轮次完成
-    await manager.broadcast({
-        "type": "debate_complete",
-        "total_rounds": req_rounds
-    })
-    await manager.broadcast({
-        "type": "message",
-        "data": {
-            "role": "system",
-            "content": f"✓ 辩论已完成 ({req_rounds} 轮)，正在生成总结..."
-        }
-    })
+            # 广播当前轮次结束
+            await room.broadcast({
+                "type": "round_end",
+                "round": round_num
+            })
+            last_round = room.history_since(round_start)
+            if digester is not None and round_num < req_rounds:
+                digester.submit(round_num, last_round)
     
-    # 生成辩论总结
-    try:
-        summarizer_provider = get_provider(req_summarizer)
-        
-        # 构建总结提示词
-        summary_prompt = {
-            "role": "user",
-            "name": "System",
-            "content": f"请作为辩论总结者，对以上 {req_rounds} 轮关于「{user_msg.content}」的辩论进行全面总结。要求：\n1. 概括各方的核心观点\n2. 分析争议焦点\n3. 给出综合性结论\n4. 字数控制在300-500字"
-        }
-        chat_history.append(summary_prompt)
-        
-        # 广播总结开始
-        await manager.broadcast({
+        # 所有轮次完成
+        await room.broadcast({
+            "type": "debate_complete",
+            "total_rounds": req_rounds
+        })
+        await room.broadcast({
             "type": "message",
             "data": {
                 "role": "system",
-                "content": f"━━━━━━━━━━━━━ 📊 辩论总结 ({summarizer_provider.name}) ━━━━━━━━━━━━━"
+                "content": f"✓ 辩论已完成 ({req_rounds} 轮)，正在生成总结..."
             }
         })
+    
+        # 生成辩论总结
+        try:
+            summarizer_provider = get_provider(req_summarizer)
         
-        # 流式生成总结
-        summary_msg_ref = Message(
-            role="assistant",
-            name=f"{summarizer_provider.name} (总结)",
-            content=""
-        )
-        await manager.broadcast({"type": "stream_start", "data": summary_msg_ref.dict()})
+            # 构建总结提示词
+            summary_prompt = {
+                "role": "user",
+                "name": "System",
+                "content": f"请作为辩论总结者，对以上 {req_rounds} 轮关于「{user_msg.content}」的辩论进行全面总结。要求：\n1. 概括各方的核心观点\n2. 分析争议焦点\n3. 给出综合性结论\n4. 字数控制在300-500字"
+            }
+            await room.append(summary_prompt)
+            if digester is not None:
+                summary_input = await digester.summary_input(last_round) + [summary_prompt]
+            else:
+                summary_input = room.history_since(topic_index)
         
-        full_summary = ""
-        async for chunk in summarizer_provider.stream_response(chat_history):
-            if chunk:
-                full_summary += chunk
-                await manager.broadcast({
-                    "type": "stream_delta",
-                    "agent": f"{summarizer_provider.name} (总结)",
-                    "delta": chunk
-                })
+            # 广播总结开始
+            await room.broadcast({
+                "type": "message",
+                "data": {
+                    "role": "system",
+                    "content": f"━━━━━━━━━━━━━ 📊 辩论总结 ({summarizer_provider.name}) ━━━━━━━━━━━━━"
+                }
+            })
         
-        summary_msg_ref.content = full_summary
-        chat_history.append(summary_msg_ref.dict())
-        await manager.broadcast({"type": "stream_end", "agent": f"{summarizer_provider.name} (总结)"})
+            # 流式生成总结
+            summary_name = f"{summarizer_provider.name} (总结)"
+            summary_msg_ref = Message(
+                role="assistant",
+                name=summary_name,
+                content=""
+            )
+            stream_id = uuid.uuid4().hex[:8]
+            await room.broadcast({"type": "stream_start", "stream": stream_id, "data": summary_msg_ref.dict()})
         
-        # 最终完成消息
-        await manager.broadcast({
-            "type": "message",
-            "data": {
-                "role": "system",
-                "content": "✨ 辩论与分析已全部完成。"
-            }
-        })
-    except Exception as summary_err:
-        print(f"Summary Error: {summary_err}")
-        await manager.broadcast({
-            "type": "message",
-            "data": {
-                "role": "system",
-                "content": f"⚠️ 总结生成失败: {str(summary_err)}"
-            }
-        })
+            full_summary = ""
+            usage = PromptUsage()
+            coalescer = DeltaCoalescer(room, summary_name, stream_id)
+            meter = None
+            stream_err = None
+            try:
+                async with provider_limits.slot(summarizer_provider.name):
+                    meter = metrics.StreamMeter(summarizer_provider.name)
+                    stream = GuardedStream(summarizer_provider, summary_input, usage, fallback=fallback_provider(summarizer_provider))
+                    async for chunk in stream:
+                        if chunk:
+                            meter.chunk()
+                            full_summary += chunk
+                            await coalescer.push(chunk)
+            except Exception as e:
+                # 与发言相同：保留已输出的部分并附上错误，流照常结束
+                stream_err = e
+                full_summary += f"\n[Error: {e}]"
+                await coalescer.push(f"\n[Error: {e}]")
+            finally:
+                coalescer.cancel()
+            if meter is not None:
+                meter.finish(usage.completion_tokens)
+            await coalescer.close()
+        
+            summary_msg_ref.content = full_summary
+            await room.append(summary_msg_ref.dict())
+            end_frame = {"type": "stream_end", "agent": summary_name, "stream": stream_id}
+            if usage.prompt_tokens:
+                print(f"[Usage] {summary_name}: {usage}")
+                end_frame["usage"] = usage.as_dict()
+            await room.broadcast(end_frame)
+            if stream_err is not None:
+                raise stream_err
+        
+            # 最终完成消息
+            await room.broadcast({
+                "type": "message",
+                "data": {
+                    "role": "system",
+                    "content": "✨ 辩论与分析已全部完成。"
+                }
+            })
+        except Exception as summary_err:
+            print(f"Summary Error: {summary_err}")
+            await room.broadcast({
+                "type": "message",
+                "data": {
+                    "role": "system",
+                    "content": f"⚠️ 总结生成失败: {str(summary_err)}"
+                }
+            })
 
+    finally:
+        # 辩论被取消时不再继续生成概要
+        if digester is not None:
+            digester.cancel()
 
 if __name__ == "__main__":
     import uvicorn
     # Use string reference for reload to work
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    from ws_protocol import TunedWebSocketProtocol
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True, ws=TunedWebSocketProtocol)
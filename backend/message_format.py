@@ -0,0 +1,89 @@
+"""把辩论历史转换成各家 API 需要的消息格式
+
+每条消息渲染后的结果按 (role, name, content) 缓存，新一轮发言只需渲染新增的消息，
+旧消息直接复用缓存对象。返回的 dict 在多次调用之间共享，调用方不要原地修改。
+"""
+from functools import lru_cache
+from typing import List, Optional
+
+# 历史以其他 Agent 的发言结尾时补一条 user 消息，避免模型把它当成自己的话续写
+CONTINUE_PROMPT = "Please continue the debate with your own view."
+
+# 渲染缓存容量（条），应大于所有房间同时活跃的历史消息总数
+RENDER_CACHE_SIZE = 16384
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_text(name: Optional[str], content: str) -> str:
+    """群聊里需要带上发言者名字，模型才分得清是谁说的"""
+    return f"[{name}]: {content}" if name else content
+
+
+def _is_user(message: dict) -> bool:
+    return message.get("role") == "user"
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _openai_message(is_user: bool, name: Optional[str], content: str) -> dict:
+    return {"role": "user" if is_user else "assistant", "content": render_text(name, content)}
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _text_block(name: Optional[str], content: str) -> dict:
+    return {"type": "text", "text": render_text(name, content)}
+
+
+def to_openai(messages: List[dict], system_prompt: str) -> List[dict]:
+    """OpenAI Chat Completions 格式（DeepSeek / Doubao / Grok 等兼容接口通用）"""
+    formatted = [{"role": "system", "content": system_prompt}]
+    for m in messages:
+        formatted.append(_openai_message(_is_user(m), m.get("name"), m.get("content") or ""))
+    return formatted
+
+
+# DashScope 的兼容接口与 OpenAI 格式相同
+to_dashscope = to_openai
+
+
+def to_anthropic(messages: List[dict], cache_breakpoint: bool = False) -> List[dict]:
+    """Anthropic Messages 格式：角色必须交替、以 user 开头和结尾，相邻同角色的消息合并为多个 text block
+
+    cache_breakpoint 为 True 时在最后一条历史消息上加 cache_control，
+    下一轮请求的前缀与本轮相同，可以直接读取缓存。
+    """
+    formatted: List[dict] = []
+    for m in messages:
+        role = "user" if _is_user(m) else "assistant"
+        block = _text_block(m.get("name"), m.get("content") or "")
+        if formatted and formatted[-1]["role"] == role:
+            formatted[-1]["content"].append(block)
+        else:
+            formatted.append({"role": role, "content": [block]})
+    if not formatted or formatted[0]["role"] != "user":
+        formatted.insert(0, {"role": "user", "content": [{"type": "text", "text": "(debate begins)"}]})
+    if cache_breakpoint:
+        # 缓存的 block 是共享对象，复制一份再加标记
+        last = formatted[-1]["content"]
+        last[-1] = {**last[-1], "cache_control": {"type": "ephemeral"}}
+    if formatted[-1]["role"] != "user":
+        formatted.append({"role": "user", "content": [{"type": "text", "text": CONTINUE_PROMPT}]})
+    return formatted
+
+
+def to_gemini(messages: List[dict]) -> List[dict]:
+    """Gemini 原生多轮 contents 格式，相邻同角色的消息合并为多个 part
+
+    最后一条必须是 user，否则模型会把它当作自己的上一句话接着写。
+    系统提示词通过 GenerativeModel(system_instruction=...) 传入。
+    """
+    contents: List[dict] = []
+    for m in messages:
+        role = "user" if _is_user(m) else "model"
+        text = render_text(m.get("name"), m.get("content") or "")
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"].append(text)
+        else:
+            contents.append({"role": role, "parts": [text]})
+    if not contents or contents[-1]["role"] != "user":
+        contents.append({"role": "user", "parts": [CONTINUE_PROMPT]})
+    return contents
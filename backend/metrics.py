@@ -0,0 +1,105 @@
+"""Prometheus 指标，由 main.py 的 /metrics 接口导出
+
+事件类指标（TTFT、广播耗时、错误数等）在发生时记录；连接数、房间数、历史大小、
+搜索缓存命中率这类状态在抓取时由 StateCollector 现算，平时没有任何开销。
+"""
+import time
+from typing import Callable, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+DEBATES_IN_FLIGHT = Gauge("aidebate_debates_in_flight", "Debates currently running")
+DEBATES_TOTAL = Counter("aidebate_debates_total", "Debates started")
+
+PROVIDER_TTFT = Histogram(
+    "aidebate_provider_ttft_seconds", "Time from request to first streamed chunk", ["provider"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+)
+PROVIDER_TOKENS_PER_SECOND = Histogram(
+    "aidebate_provider_tokens_per_second", "Output speed after the first chunk", ["provider"],
+    buckets=(1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+)
+PROVIDER_ERRORS = Counter("aidebate_provider_errors_total", "Provider call failures", ["provider", "type"])
+PROVIDER_RATE_LIMITED = Counter("aidebate_provider_rate_limited_total", "429/529 responses from providers", ["provider"])
+PROVIDER_RETRIES = Counter("aidebate_provider_retries_total", "Provider requests retried", ["provider", "reason"])
+STREAM_TIMEOUTS = Counter("aidebate_stream_timeouts_total", "Streams that missed the TTFT or stall deadline",
+                          ["provider", "kind"])
+STREAM_RESUMES = Counter("aidebate_stream_resumes_total", "Streams continued from their partial output after a failure",
+                         ["provider", "outcome"])
+STREAM_HEDGES = Counter("aidebate_stream_hedges_total", "Hedged requests to a fallback model, by which side won",
+                        ["provider", "winner"])
+
+BROADCAST_DURATION = Histogram(
+    "aidebate_broadcast_duration_seconds", "Time to record, encode and enqueue one frame for a room",
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+)
+SEND_FAILURES = Counter("aidebate_websocket_send_failures_total", "Frames that could not be delivered", ["reason"])
+
+SEARCH_DURATION = Histogram(
+    "aidebate_search_duration_seconds", "Upstream web search latency (cache misses only)", ["outcome"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15)
+)
+
+
+def provider_error(provider: str, exc: BaseException):
+    PROVIDER_ERRORS.labels(provider, type(exc).__name__).inc()
+
+
+class StreamMeter:
+    """记录一次流式调用的 TTFT 和输出速度；每个 chunk 只多一次方法调用和一次比较"""
+    __slots__ = ("provider", "started", "first_chunk", "chunks")
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.started = time.perf_counter()
+        self.first_chunk: Optional[float] = None
+        self.chunks = 0
+
+    def chunk(self):
+        self.chunks += 1
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter()
+            PROVIDER_TTFT.labels(self.provider).observe(self.first_chunk - self.started)
+
+    def finish(self, completion_tokens: int = 0):
+        """流结束时调用；没有上游用量时按 chunk 数近似 token 数"""
+        if self.first_chunk is None:
+            return
+        elapsed = time.perf_counter() - self.first_chunk
+        tokens = completion_tokens or self.chunks
+        if elapsed > 0 and tokens > 1:
+            PROVIDER_TOKENS_PER_SECOND.labels(self.provider).observe(tokens / elapsed)
+
+
+class StateCollector:
+    """抓取时读取进程内状态：连接、房间、历史记录大小和搜索缓存"""
+
+    def __init__(self, connections: Callable[[], int], rooms: Callable[[], dict], search_stats: Callable[[], dict]):
+        self.connections = connections
+        self.rooms = rooms
+        self.search_stats = search_stats
+
+    def collect(self):
+        rooms = self.rooms()
+        messages = 0
+        history_bytes = 0
+        for room in rooms.values():
+            messages += len(room.history)
+            history_bytes += room.history_bytes
+
+        yield GaugeMetricFamily("aidebate_websocket_connections", "Open WebSocket connections", value=self.connections())
+        yield GaugeMetricFamily("aidebate_rooms", "Debate rooms held in memory", value=len(rooms))
+        yield GaugeMetricFamily("aidebate_history_messages", "Messages kept in room histories", value=messages)
+        yield GaugeMetricFamily("aidebate_history_bytes", "UTF-8 bytes of message content in room histories",
+                                value=history_bytes)
+
+        stats = self.search_stats()
+        yield CounterMetricFamily("aidebate_search_cache_hits", "Search cache hits", value=stats["hits"])
+        yield CounterMetricFamily("aidebate_search_cache_misses", "Search cache misses", value=stats["misses"])
+        yield GaugeMetricFamily("aidebate_search_cache_hit_ratio", "Search cache hit ratio", value=stats["hit_rate"])
+        yield GaugeMetricFamily("aidebate_search_cache_entries", "Search cache entries", value=stats["size"])
+
+
+def register_state(connections: Callable[[], int], rooms: Callable[[], dict], search_stats: Callable[[], dict]):
+    REGISTRY.register(StateCollector(connections, rooms, search_stats))
@@ -0,0 +1,244 @@
+"""上游限流：每个 Provider 的请求数 / token 数令牌桶、429 重试，以及自适应并发上限
+
+- 令牌桶：PROVIDER_RPM / PROVIDER_TPM 设置每分钟请求数和 token 数（0 表示不限制），
+  可用 PROVIDER_RPM_<NAME>、PROVIDER_TPM_<NAME>（如 _DEEPSEEK）单独设置。
+- 429：按 Retry-After 暂停该 Provider 的所有新请求后重试；没有 Retry-After 时指数退避。
+  连接错误和 5xx 也会重试，但不视为限流。
+- 并发（AIMD）：每次请求成功上限加 1/上限，收到 429 时减半，在 1 和 PROVIDER_MAX_CONCURRENT 之间调整，
+  负载高时稳定在上游能承受的并发数附近，而不是一波请求同时失败。
+"""
+import asyncio
+import email.utils
+import os
+import random
+import sys
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+
+from metrics import PROVIDER_RATE_LIMITED, PROVIDER_RETRIES
+
+T = TypeVar("T")
+
+# 每个 Provider 同时进行的请求数上限（自适应并发的最大值）
+PROVIDER_MAX_CONCURRENT = int(os.environ.get("PROVIDER_MAX_CONCURRENT", "10"))
+# 每分钟请求数 / token 数，0 表示不限制
+PROVIDER_RPM = int(os.environ.get("PROVIDER_RPM", "0"))
+PROVIDER_TPM = int(os.environ.get("PROVIDER_TPM", "0"))
+# 预估 token 数时为回复预留的 token 数，拿到实际用量后再修正
+RATE_LIMIT_COMPLETION_ESTIMATE = int(os.environ.get("RATE_LIMIT_COMPLETION_ESTIMATE", "1024"))
+# 429 和临时错误的最大重试次数，以及退避时间（秒）
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", "4"))
+RATE_LIMIT_BASE_BACKOFF = float(os.environ.get("RATE_LIMIT_BASE_BACKOFF", "1"))
+RATE_LIMIT_MAX_BACKOFF = float(os.environ.get("RATE_LIMIT_MAX_BACKOFF", "60"))
+
+# 请求状态通知：call 在限流排队或退避前调用 notify(False)，真正发出请求时调用 notify(True)。
+# GuardedStream 为自己的每一路请求设置它，排队和退避的时间不计入首 token 超时
+request_admitted: ContextVar[Optional[Callable[[bool], None]]] = ContextVar("request_admitted", default=None)
+
+
+def provider_setting(base: str, provider: str, default):
+    """读取 <base>_<PROVIDER> 环境变量，没有时用 default；返回值与 default 类型相同"""
+    key = base + "_" + "".join(c if c.isalnum() else "_" for c in provider).upper()
+    return type(default)(os.environ.get(key, default))
+
+
+def _status(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    return int(status) if isinstance(status, int) else None
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """429，或 Anthropic 的 529（过载）"""
+    return _status(exc) in (429, 529)
+
+
+def _transient_errors() -> tuple:
+    # SDK 按需导入（见 llm_providers），还没导入的 SDK 不可能抛出它的异常，这里也不为此导入它
+    errors = [httpx.TransportError]
+    for module in ("openai", "anthropic"):
+        sdk = sys.modules.get(module)
+        if sdk is not None:
+            errors.append(sdk.APIConnectionError)
+    return tuple(errors)
+
+
+def is_transient(exc: BaseException) -> bool:
+    return isinstance(exc, _transient_errors()) or _status(exc) in (500, 502, 503, 504)
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """从响应头读取建议的等待秒数（retry-after-ms、retry-after 秒数或 HTTP 日期）"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """每分钟补充 per_minute 个令牌，最多攒满一分钟的量；等待的调用按先后顺序取令牌"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float):
+        """按实际用量修正；实际比预估多时可以透支，后续请求等待补回"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+
+class AdaptiveConcurrency:
+    """AIMD 并发上限：成功时缓慢增加，限流时减半"""
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max(max_limit, 1)
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def increase(self):
+        if self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def decrease(self, cooldown: float):
+        # 同一波请求一起收到 429 时只减一次
+        now = time.monotonic()
+        if now - self._last_decrease >= cooldown:
+            self._last_decrease = now
+            self.limit = max(1.0, self.limit / 2)
+
+
+class ProviderRateLimit:
+    """一个 Provider 的限流状态，同一进程内所有调用共享"""
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        rpm = provider_setting("PROVIDER_RPM", provider, PROVIDER_RPM)
+        tpm = provider_setting("PROVIDER_TPM", provider, PROVIDER_TPM)
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.concurrency = AdaptiveConcurrency(provider_setting("PROVIDER_MAX_CONCURRENT", provider, PROVIDER_MAX_CONCURRENT))
+        # 收到 Retry-After 后，在此之前不发新请求
+        self.paused_until = 0.0
+
+    async def _admit(self, tokens: int):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        if self.requests is not None:
+            await self.requests.acquire()
+        if self.tokens is not None and tokens:
+            await self.tokens.acquire(tokens)
+
+    def _backoff(self, exc: BaseException, attempt: int) -> float:
+        suggested = retry_after(exc)
+        if suggested is not None:
+            return min(suggested, RATE_LIMIT_MAX_BACKOFF)
+        # 指数退避加随机抖动，避免所有请求同时重试
+        return min(RATE_LIMIT_BASE_BACKOFF * 2 ** attempt, RATE_LIMIT_MAX_BACKOFF) * random.uniform(0.5, 1)
+
+    async def call(self, request: Callable[[], Awaitable[T]], tokens: int = 0) -> T:
+        """在限流允许时发出请求；429 和临时错误按退避时间重试，其余错误直接抛出"""
+        notify = request_admitted.get()
+        attempt = 0
+        while True:
+            if notify is not None:
+                notify(False)
+            await self._admit(tokens)
+            if notify is not None:
+                notify(True)
+            try:
+                result = await request()
+            except Exception as e:
+                limited = is_rate_limited(e)
+                if attempt >= RATE_LIMIT_MAX_RETRIES or not (limited or is_transient(e)):
+                    raise
+                delay = self._backoff(e, attempt)
+                if limited:
+                    PROVIDER_RATE_LIMITED.labels(self.provider).inc()
+                    self.concurrency.decrease(cooldown=max(delay, 1.0))
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                PROVIDER_RETRIES.labels(self.provider, "rate_limited" if limited else "transient").inc()
+                attempt += 1
+                print(f"[RateLimit] {self.provider}: {type(e).__name__}, retry {attempt}/{RATE_LIMIT_MAX_RETRIES} "
+                      f"in {delay:.1f}s (concurrency limit {int(self.concurrency.limit)})")
+                if notify is not None:
+                    notify(False)
+                await asyncio.sleep(delay)
+                continue
+            self.concurrency.increase()
+            return result
+
+    def record_usage(self, estimated: int, actual: int):
+        if self.tokens is not None and actual:
+            self.tokens.adjust(actual - estimated)
+
+    def stats(self) -> dict:
+        return {
+            "concurrency_limit": int(self.concurrency.limit),
+            "max_concurrency": self.concurrency.max_limit,
+            "in_flight": self.concurrency.in_flight,
+            "paused_seconds": round(max(self.paused_until - time.monotonic(), 0.0), 1),
+        }
+
+
+class RateLimits:
+    def __init__(self):
+        self._providers: Dict[str, ProviderRateLimit] = {}
+
+    def get(self, provider: str) -> ProviderRateLimit:
+        limit = self._providers.get(provider)
+        if limit is None:
+            limit = self._providers[provider] = ProviderRateLimit(provider)
+        return limit
+
+    def stats(self) -> Dict[str, dict]:
+        return {name: limit.stats() for name, limit in self._providers.items()}
+
+
+rate_limits = RateLimits()
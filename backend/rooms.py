@@ -0,0 +1,553 @@
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from collections import deque
+from collections.abc import Mapping
+from functools import partial
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Set, Tuple
+from fastapi import WebSocket
+from metrics import BROADCAST_DURATION, SEND_FAILURES
+from transcript_store import TRANSCRIPT_RESTORE_MESSAGES, TranscriptStore
+from event_bus import EventBus, InProcessEventBus
+from wire import AGENT_DEFINITION, Frame, WireCodec, compact
+
+# 房间 ID 只允许简单字符，防止客户端传入任意长字符串
+ROOM_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# 每个房间保留的最近事件数（环形缓冲），断线重连时只补发缓冲内缺失的事件
+EVENT_BUFFER_SIZE = int(os.environ.get("ROOM_EVENT_BUFFER", "2000"))
+
+# 每个连接的发送队列长度（帧数），以及队列满时的处理策略：
+# resync - 丢弃积压的帧，改发一帧快照；disconnect - 直接断开慢连接
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", "256"))
+WS_SLOW_CONSUMER_POLICY = os.environ.get("WS_SLOW_CONSUMER_POLICY", "resync")
+
+# 快照里最多携带的历史消息数，更早的消息由客户端通过 /rooms/{id}/messages 分页读取
+ROOM_SNAPSHOT_MESSAGES = int(os.environ.get("ROOM_SNAPSHOT_MESSAGES", "200"))
+# 每个房间在内存中保留的最近历史消息数（进行中的房间同样生效），更早的只在存储中，分页时读取；0 表示不限制
+ROOM_HISTORY_MESSAGES = int(os.environ.get("ROOM_HISTORY_MESSAGES", "1000"))
+
+# 房间保留策略：只回收没有连接、没有进行中辩论的房间（记录已持久化，重连时从存储恢复）
+# ROOM_MAX_ROOMS - 内存中最多保留的房间数；ROOM_MAX_AGE - 空闲超过多少秒回收；
+# ROOM_MAX_HISTORY_BYTES - 所有房间历史内容的总字节数上限；0 表示不限制
+ROOM_MAX_ROOMS = int(os.environ.get("ROOM_MAX_ROOMS", "1000"))
+ROOM_MAX_AGE = float(os.environ.get("ROOM_MAX_AGE", "86400"))
+ROOM_MAX_HISTORY_BYTES = int(os.environ.get("ROOM_MAX_HISTORY_BYTES", str(256 * 1024 * 1024)))
+# 后台检查保留策略的间隔（秒）
+ROOM_SWEEP_INTERVAL = float(os.environ.get("ROOM_SWEEP_INTERVAL", "60"))
+# 刚结束的房间至少保留这么久，保证记录已经写入存储
+ROOM_EVICT_GRACE = 10.0
+
+# 为 1 时每个事件带上服务端发出时间 ts（秒），压测工具据此统计广播延迟
+WS_FRAME_TIMESTAMPS = os.environ.get("WS_FRAME_TIMESTAMPS", "0") == "1"
+
+
+class HistoryMessage(Mapping):
+    """历史记录中的一条消息
+
+    用 __slots__ 代替 dict 保存，角色和发言者名字驻留（intern），同名的消息共用一个字符串。
+    实现了只读 Mapping 接口，原来按 dict 读取历史的代码（m["role"]、m.get("name")、{**m}）不需要改。
+    """
+    __slots__ = ("role", "name", "content", "timestamp")
+    _fields = ("role", "name", "content", "timestamp")
+
+    def __init__(self, role: str, name: Optional[str], content: str, timestamp: Optional[float] = None):
+        self.role = sys.intern(role)
+        self.name = sys.intern(name) if name else name
+        self.content = content
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_dict(cls, message) -> "HistoryMessage":
+        if isinstance(message, cls):
+            return message
+        return cls(message.get("role") or "", message.get("name"), message.get("content") or "",
+                   message.get("timestamp"))
+
+    def __getitem__(self, key: str):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def __repr__(self) -> str:
+        return f"HistoryMessage({dict(self)!r})"
+
+    @property
+    def size(self) -> int:
+        """内容的 UTF-8 字节数，用于统计历史占用"""
+        return len(self.content.encode("utf-8"))
+
+
+def _encode_default(obj):
+    if isinstance(obj, HistoryMessage):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def encode_frame(message: dict) -> str:
+    """序列化一帧，与 send_json 的格式一致；广播时每帧只序列化一次"""
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"), default=_encode_default)
+
+
+class ClientConnection:
+    """一个 WebSocket 连接：有界发送队列 + 独立的写协程
+
+    broadcast 只把帧放进队列，不等待网络发送，一个慢连接不会拖慢其他人。
+    """
+
+    def __init__(self, websocket: WebSocket, room: "DebateRoom", codec: Optional[WireCodec] = None):
+        self.websocket = websocket
+        self.room = room
+        # 协商出的紧凑编码，None 为默认 JSON；known_agents 是已经告诉客户端的 agent 编号
+        self.codec = codec
+        self.known_agents: Set[int] = set()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.closed = False
+        self.writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def send(self, frame: Frame):
+        """非阻塞地把一帧（已编码）放入队列"""
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self._on_overflow()
+
+    def encode(self, event: dict) -> Frame:
+        if self.codec is None:
+            return encode_frame(event)
+        return self.codec.encode(compact(event, self.room.agent_ids))
+
+    def send_event(self, event: dict, encoded: Optional[dict] = None):
+        """按本连接协商的编码发送一帧；encoded 在同一次广播的各连接之间共享编码结果（None 键为默认 JSON）"""
+        codec = self.codec
+        if codec is None and encoded is not None:
+            self.send(encoded[None])
+            return
+        if codec is not None:
+            agent = event.get("agent")
+            if agent is not None:
+                agent_id = self.room.agent_id(agent)
+                if agent_id not in self.known_agents:
+                    self.known_agents.add(agent_id)
+                    self.send(codec.encode({"t": AGENT_DEFINITION, "i": agent_id, "n": agent}))
+        if encoded is None:
+            self.send(self.encode(event))
+            return
+        key = codec.key if codec is not None else None
+        frame = encoded.get(key)
+        if frame is None:
+            frame = encoded[key] = self.encode(event)
+        self.send(frame)
+
+    def _on_overflow(self):
+        SEND_FAILURES.labels(WS_SLOW_CONSUMER_POLICY).inc()
+        if WS_SLOW_CONSUMER_POLICY == "disconnect":
+            print(f"Slow consumer in room {self.room.id}, disconnecting")
+            self.close()
+            asyncio.create_task(self._close_socket())
+            return
+        # 积压的帧全部作废，快照里已经包含了它们的内容；其中可能有 agent 定义帧，之后重新定义
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.known_agents.clear()
+        self.queue.put_nowait(self.encode(self.room.snapshot()))
+
+    async def _write_loop(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                if isinstance(frame, bytes):
+                    await self.websocket.send_bytes(frame)
+                else:
+                    await self.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # 发送失败则认为连接已断开
+            SEND_FAILURES.labels("error").inc()
+            self.close()
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close(code=1013)
+        except Exception:
+            pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.room.unsubscribe(self)
+        if self.writer is not None and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+
+class DebateRoom:
+    """一个辩论会话：拥有独立的 ID、历史记录和订阅者集合
+
+    多 worker 部署时，每个 worker 上的 DebateRoom 是共享状态的镜像，由事件总线投递的事件驱动。
+    """
+
+    def __init__(self, room_id: str, store: Optional[TranscriptStore] = None, bus: Optional[EventBus] = None):
+        self.id = room_id
+        self.store = store or TranscriptStore()
+        self.bus = bus or InProcessEventBus()
+        self.history: List[HistoryMessage] = []
+        # history[0] 在完整记录中的序号；从存储恢复时只载入最近的一段，更早的留在存储里
+        self.history_offset = 0
+        # 内存中历史内容的字节数
+        self.history_bytes = 0
+        # 多 worker 时先于前面的消息到达的历史消息：序号 -> 消息，前面的到齐后再写入 history
+        self.early_history: Dict[int, HistoryMessage] = {}
+        self.subscribers: Set[ClientConnection] = set()
+        self.created_at = time.time()
+        # 最近一次写入历史或连接变化的时间，保留策略按它判断房间是否空闲
+        self.updated_at = self.created_at
+        # 排队中和正在进行的辩论数（由调度器维护），大于 0 时房间不会被回收
+        self.active_debates = 0
+        # 单调递增的事件序号，以及最近事件的环形缓冲
+        self.seq = 0
+        self.events: Deque[Tuple[int, dict]] = deque(maxlen=EVENT_BUFFER_SIZE)
+        # 正在流式输出、尚未写入 history 的消息：流 ID（老的事件没有时用 agent 名字）-> (消息, 已收到的片段)
+        self.streaming: Dict[str, Tuple[dict, List[str]]] = {}
+        # 紧凑协议中 agent 名字 -> 编号
+        self.agent_ids: Dict[str, int] = {}
+        # 正在从共享状态初始化时，期间总线投递的事件和历史消息先暂存在这里，初始化完成后再处理
+        self.loading: Optional[asyncio.Event] = None
+        self.pending: List[Callable[[], None]] = []
+
+    def subscribe(self, connection: ClientConnection):
+        self.subscribers.add(connection)
+        self.updated_at = time.time()
+
+    async def append(self, message: dict) -> int:
+        """写入历史记录，返回它在完整记录中的序号
+
+        序号由事件总线分配（多 worker 时全局唯一），再写入本地并交给存储在后台持久化。
+        """
+        entry = HistoryMessage.from_dict(message)
+        index = await self.bus.append_history(self, entry)
+        self._insert_history(index, entry)
+        self.store.append(self.id, index, entry)
+        return index
+
+    def history_since(self, index: int) -> List[HistoryMessage]:
+        """序号不小于 index 的历史消息（只含内存中的部分）"""
+        return self.history[max(index - self.history_offset, 0):]
+
+    @property
+    def history_end(self) -> int:
+        """下一条历史消息的序号"""
+        return self.history_offset + len(self.history)
+
+    def _insert_history(self, index: int, entry: HistoryMessage):
+        """按序号写入本地历史：已有的序号跳过，超前的先暂存，等前面的消息到齐后依次写入"""
+        end = self.history_offset + len(self.history)
+        if index < end:
+            return
+        if index > end:
+            self.early_history[index] = entry
+            return
+        while entry is not None:
+            self.history.append(entry)
+            self.history_bytes += entry.size
+            end += 1
+            entry = self.early_history.pop(end, None)
+        self.updated_at = time.time()
+        if ROOM_HISTORY_MESSAGES > 0 and len(self.history) > ROOM_HISTORY_MESSAGES:
+            # 长期使用的房间（前端复用同一个房间 ID）只在内存中保留最近的一段
+            dropped = self.history[:-ROOM_HISTORY_MESSAGES]
+            del self.history[:-ROOM_HISTORY_MESSAGES]
+            self.history_offset += len(dropped)
+            self.history_bytes -= sum(m.size for m in dropped)
+
+    def mirror_history(self, index: int, message: dict):
+        """事件总线投递的历史消息（包括本 worker 写入的）；初始化时已经读到的按序号跳过"""
+        if self.loading is not None:
+            self.pending.append(partial(self.mirror_history, index, message))
+            return
+        self._insert_history(index, HistoryMessage.from_dict(message))
+
+    def restore(self, rows: List[Tuple[int, dict]]):
+        """用存储里读出的 (序号, 消息) 初始化历史"""
+        if not rows:
+            return
+        self.history_offset = rows[0][0]
+        self.history = [HistoryMessage.from_dict(message) for _, message in rows]
+        self.history_bytes = sum(m.size for m in self.history)
+
+    @property
+    def idle(self) -> bool:
+        """没有连接、也没有进行中的辩论"""
+        return not self.subscribers and self.active_debates == 0
+
+    async def page(self, before: Optional[int], limit: int) -> List[Tuple[int, dict]]:
+        """序号小于 before 的最近 limit 条历史消息（按序号升序），内存里没有的部分从存储读取"""
+        end = self.history_offset + len(self.history)
+        if before is not None:
+            end = min(before, end)
+        start = max(end - limit, 0)
+        rows: List[Tuple[int, dict]] = []
+        if start < self.history_offset:
+            stored_end = min(end, self.history_offset)
+            rows = await self.store.page(self.id, stored_end, stored_end - start)
+        for seq in range(max(start, self.history_offset), end):
+            rows.append((seq, self.history[seq - self.history_offset]))
+        return rows
+
+    def join(self, connection: ClientConnection, since: Optional[int] = None):
+        """补发新连接错过的事件并订阅
+
+        只补发 since 之后的事件；超出环形缓冲范围（或超过发送队列容量）时发送一帧快照。
+        从补发到订阅都是同步执行，补发与实时推送之间不会丢事件也不会乱序。
+        """
+        if since is None:
+            if self.history or self.streaming:
+                connection.send_event(self.snapshot())
+        else:
+            missed = self.events_since(since)
+            if missed is None or len(missed) >= WS_SEND_QUEUE_SIZE:
+                connection.send_event(self.snapshot())
+            else:
+                for event in missed:
+                    connection.send_event(event)
+        self.subscribe(connection)
+
+    def unsubscribe(self, connection: ClientConnection):
+        self.subscribers.discard(connection)
+        self.updated_at = time.time()
+
+    def stamp(self, message: dict) -> dict:
+        """按需给事件加上服务端时间戳"""
+        if WS_FRAME_TIMESTAMPS:
+            return {**message, "ts": time.time()}
+        return message
+
+    def record(self, message: dict) -> dict:
+        """在本地分配序号并记录事件（进程内总线）"""
+        event = {**self.stamp(message), "seq": self.seq + 1}
+        self.apply(event)
+        return event
+
+    def apply(self, event: dict):
+        """把一个已分配序号的事件写入环形缓冲，并跟踪流式消息的当前内容"""
+        self.seq = max(self.seq, event["seq"])
+        self.events.append((event["seq"], event))
+
+        event_type = event.get("type")
+        if event_type == "stream_start":
+            data = event["data"]
+            self.streaming[event.get("stream") or data.get("name")] = (data, [])
+        elif event_type == "stream_delta":
+            partial = self.streaming.get(event.get("stream") or event.get("agent"))
+            if partial is not None:
+                partial[1].append(event.get("delta", ""))
+        elif event_type == "stream_end":
+            self.streaming.pop(event.get("stream") or event.get("agent"), None)
+
+    def agent_id(self, name: str) -> int:
+        """紧凑协议中 agent 名字对应的编号，在房间内分配"""
+        agent_id = self.agent_ids.get(name)
+        if agent_id is None:
+            agent_id = self.agent_ids[name] = len(self.agent_ids)
+        return agent_id
+
+    def fan_out(self, event: dict, text: str):
+        """发送给本房间在本 worker 上的订阅者；text 是默认协议的 JSON，紧凑编码每种只编码一次"""
+        encoded = {None: text}
+        # 对副本迭代，防止迭代中修改集合
+        for connection in list(self.subscribers):
+            connection.send_event(event, encoded)
+
+    def deliver(self, text: str):
+        """事件总线投递的已编码事件帧：更新镜像状态并转发给本地连接"""
+        if self.loading is not None:
+            self.pending.append(partial(self.deliver, text))
+            return
+        event = json.loads(text)
+        # 初始化时已经从事件日志读到的事件不再重复处理
+        if event["seq"] <= self.seq:
+            return
+        self.apply(event)
+        self.fan_out(event, text)
+
+    def events_since(self, since: int) -> Optional[List[dict]]:
+        """返回序号大于 since 的事件；若已超出缓冲范围则返回 None（需要快照）"""
+        if since == self.seq:
+            return []
+        # since 比当前序号还大，说明服务端已重启，客户端状态不可信
+        if since > self.seq or not self.events or since < self.events[0][0] - 1:
+            return None
+        # 从尾部往前取，开销只与错过的事件数有关
+        missed = []
+        for seq, event in reversed(self.events):
+            if seq <= since:
+                break
+            missed.append(event)
+        missed.reverse()
+        return missed
+
+    def snapshot(self) -> dict:
+        """一次性描述房间当前状态的紧凑快照帧"""
+        # 带上流 ID，客户端收到快照后能把后续的 stream_delta 对应到这些消息
+        streaming = [
+            {**data, "content": "".join(parts), "stream": stream}
+            for stream, (data, parts) in self.streaming.items()
+        ]
+        history = self.history[-ROOM_SNAPSHOT_MESSAGES:] if ROOM_SNAPSHOT_MESSAGES > 0 else []
+        return {
+            "type": "snapshot",
+            "seq": self.seq,
+            "history": history,
+            # 快照中第一条历史消息的序号，大于 0 说明还有更早的消息可以分页读取
+            "history_start": self.history_offset + len(self.history) - len(history),
+            "streaming": streaming,
+        }
+
+    async def broadcast(self, message: dict):
+        started = time.perf_counter()
+        await self.bus.publish(self, message)
+        BROADCAST_DURATION.observe(time.perf_counter() - started)
+
+
+class RoomRegistry:
+    """本进程的房间表；内存里没有的房间从事件总线的共享状态或记录存储中恢复"""
+
+    def __init__(self, store: Optional[TranscriptStore] = None, bus: Optional[EventBus] = None):
+        self.store = store or TranscriptStore()
+        self.bus = bus or InProcessEventBus()
+        self.rooms: Dict[str, DebateRoom] = {}
+
+    def get(self, room_id: str) -> Optional[DebateRoom]:
+        return self.rooms.get(room_id)
+
+    async def get_or_create(self, room_id: Optional[str] = None) -> DebateRoom:
+        """按 ID 取房间；ID 为空或非法时新建一个随机 ID 的房间"""
+        if not room_id or not ROOM_ID_PATTERN.match(room_id):
+            room_id = uuid.uuid4().hex
+        room = self.rooms.get(room_id)
+        if room is not None:
+            # 另一个连接正在初始化这个房间，等它完成
+            if room.loading is not None:
+                await room.loading.wait()
+            return room
+
+        # 先登记再读取：读取期间总线投递的事件暂存在 pending 里，读完后按序号补上
+        room = DebateRoom(room_id, self.store, self.bus)
+        room.loading = asyncio.Event()
+        self.rooms[room_id] = room
+        try:
+            await self.bus.watch(room_id)
+            # 服务重启或房间被回收后，只载入最近的一段历史
+            if not await self.bus.restore(room, TRANSCRIPT_RESTORE_MESSAGES):
+                room.restore(await self.store.tail(room_id, TRANSCRIPT_RESTORE_MESSAGES))
+        finally:
+            loading, room.loading = room.loading, None
+            pending, room.pending = room.pending, []
+            for handle in pending:
+                handle()
+            loading.set()
+        if ROOM_MAX_ROOMS > 0 and len(self.rooms) > ROOM_MAX_ROOMS:
+            self.sweep()
+        return room
+
+    async def find(self, room_id: str) -> Optional[DebateRoom]:
+        """按 ID 取已有的房间；内存、事件总线和记录存储中都没有时返回 None，不会创建房间"""
+        if room_id not in self.rooms:
+            if not await self.bus.exists(room_id) and not await self.store.tail(room_id, 1):
+                return None
+        return await self.get_or_create(room_id)
+
+    def discard(self, room: DebateRoom):
+        """移除一个刚创建、还没有任何内容的房间（例如发起辩论被拒绝时）"""
+        if self.rooms.get(room.id) is room and room.idle and not room.seq and not room.history:
+            del self.rooms[room.id]
+            self.bus.unwatch(room.id)
+
+    async def page(self, room_id: str, before: Optional[int], limit: int) -> List[Tuple[int, dict]]:
+        """分页读取历史；房间不在内存中时直接查存储，不会因此创建房间"""
+        room = self.rooms.get(room_id)
+        if room is not None:
+            return await room.page(before, limit)
+        if before is None:
+            return await self.store.tail(room_id, limit)
+        return await self.store.page(room_id, before, limit)
+
+    @property
+    def history_bytes(self) -> int:
+        return sum(room.history_bytes for room in self.rooms.values())
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """按保留策略回收空闲房间，返回回收的房间数
+
+        先回收空闲超过 ROOM_MAX_AGE 的房间，仍超出房间数或字节数上限时按最久未活动的顺序继续回收。
+        """
+        now = time.time() if now is None else now
+        candidates = sorted(
+            (room for room in self.rooms.values() if room.idle and now - room.updated_at >= ROOM_EVICT_GRACE),
+            key=lambda room: room.updated_at
+        )
+        evicted = 0
+        total_bytes = self.history_bytes
+        for room in candidates:
+            expired = ROOM_MAX_AGE > 0 and now - room.updated_at > ROOM_MAX_AGE
+            too_many = ROOM_MAX_ROOMS > 0 and len(self.rooms) > ROOM_MAX_ROOMS
+            too_big = ROOM_MAX_HISTORY_BYTES > 0 and total_bytes > ROOM_MAX_HISTORY_BYTES
+            if not (expired or too_many or too_big):
+                # 候选按活动时间排序，后面的房间更新，也不会过期
+                break
+            del self.rooms[room.id]
+            self.bus.unwatch(room.id)
+            total_bytes -= room.history_bytes
+            evicted += 1
+        if evicted:
+            print(f"[Rooms] evicted {evicted} idle rooms, {len(self.rooms)} left, history {total_bytes} bytes")
+        return evicted
+
+    async def sweep_forever(self, interval: float = ROOM_SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def memory_report(self, top: int = 10) -> dict:
+        """历史记录的内存占用概况"""
+        now = time.time()
+        rooms = sorted(self.rooms.values(), key=lambda room: room.history_bytes, reverse=True)
+        return {
+            "rooms": len(rooms),
+            "active_rooms": sum(1 for room in rooms if not room.idle),
+            "history_messages": sum(len(room.history) for room in rooms),
+            "history_bytes": sum(room.history_bytes for room in rooms),
+            "buffered_events": sum(len(room.events) for room in rooms),
+            "limits": {
+                "max_rooms": ROOM_MAX_ROOMS,
+                "max_age_seconds": ROOM_MAX_AGE,
+                "max_history_bytes": ROOM_MAX_HISTORY_BYTES,
+            },
+            "largest_rooms": [
+                {
+                    "room_id": room.id,
+                    "messages": len(room.history),
+                    "history_bytes": room.history_bytes,
+                    "subscribers": len(room.subscribers),
+                    "active_debates": room.active_debates,
+                    "idle_seconds": round(now - room.updated_at, 1),
+                }
+                for room in rooms[:top]
+            ],
+        }
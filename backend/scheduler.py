@@ -0,0 +1,203 @@
+"""辩论调度：全局并发上限、排队、按客户端公平分配，以及每个 Provider 的并发上限
+
+同时进行的辩论超过 DEBATE_MAX_CONCURRENT 时新辩论进入队列，排队中的客户端会收到
+{"type": "queue", "position": n} 帧；同一客户端已有的辩论越多，新提交的辩论排得越靠后，
+一个用户连续提交不会挤占其他人。上限都是按 worker 进程计算的。
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Coroutine, Dict, List, Optional
+
+from rate_limit import rate_limits
+
+# 同时进行的辩论数上限，以及排队数上限（超出时拒绝）
+DEBATE_MAX_CONCURRENT = int(os.environ.get("DEBATE_MAX_CONCURRENT", "20"))
+DEBATE_MAX_QUEUED = int(os.environ.get("DEBATE_MAX_QUEUED", "200"))
+# 每个客户端（按 IP）同时排队 + 进行中的辩论数上限，0 表示不限制
+CLIENT_MAX_DEBATES = int(os.environ.get("CLIENT_MAX_DEBATES", "2"))
+
+
+class SchedulerRejected(Exception):
+    """队列已满或客户端超出配额，辩论没有被接受"""
+
+
+class DebateJob:
+    """一场已提交的辩论"""
+
+    def __init__(self, room, client: str, topic: str, run: Callable[[], Coroutine]):
+        self.id = uuid.uuid4().hex[:12]
+        self.room = room
+        self.client = client
+        self.topic = topic
+        self.run = run
+        self.state = "queued"
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        # 排队期间给客户端发过位置，开始时要通知它离开队列
+        self.notified = False
+
+    def as_dict(self) -> dict:
+        now = time.time()
+        return {
+            "id": self.id,
+            "room_id": self.room.id,
+            "client": self.client,
+            "topic": self.topic[:100],
+            "state": self.state,
+            "waited_seconds": round((self.started_at or now) - self.created_at, 1),
+            "running_seconds": round(now - self.started_at, 1) if self.started_at else 0.0,
+        }
+
+
+class DebateScheduler:
+    """有界的辩论调度器：超过并发上限的辩论按 (客户端已有辩论数, 提交顺序) 排队"""
+
+    def __init__(self, max_concurrent: int = DEBATE_MAX_CONCURRENT, max_queued: int = DEBATE_MAX_QUEUED,
+                 client_quota: int = CLIENT_MAX_DEBATES):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.client_quota = client_quota
+        self.jobs: Dict[str, DebateJob] = {}
+        self.running = 0
+        self._queue: List[tuple] = []
+        self._counter = itertools.count()
+        self._client_jobs: Dict[str, int] = {}
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.state == "queued")
+
+    async def submit(self, room, client: str, topic: str, run: Callable[[], Coroutine],
+                     on_accept: Optional[Callable[[], Awaitable]] = None) -> DebateJob:
+        """提交一场辩论；队列满或超出客户端配额时抛出 SchedulerRejected
+
+        on_accept 在通过准入检查之后、辩论开始之前调用（例如写入并广播辩题），被拒绝的辩论不会留下任何内容。
+        """
+        load = self._client_jobs.get(client, 0)
+        if self.client_quota > 0 and load >= self.client_quota:
+            raise SchedulerRejected(f"你已有 {load} 场辩论在进行或排队，请等待结束后再发起")
+        if self.running >= self.max_concurrent and self.queued >= self.max_queued:
+            raise SchedulerRejected("当前排队人数过多，请稍后再试")
+
+        job = DebateJob(room, client, topic, run)
+        self.jobs[job.id] = job
+        self._client_jobs[client] = load + 1
+        # 排队期间房间同样算作忙碌，不会被保留策略回收
+        room.active_debates += 1
+        if on_accept is not None:
+            # 名额已经占住，等待期间其他提交不会超出上限
+            try:
+                await on_accept()
+            except BaseException:
+                if job.state == "queued":
+                    self._finish(job)
+                raise
+        heapq.heappush(self._queue, (load, next(self._counter), job))
+        self._dispatch()
+        if job.state == "queued":
+            await self._notify_positions()
+        return job
+
+    def _dispatch(self):
+        while self.running < self.max_concurrent and self._queue:
+            _, _, job = heapq.heappop(self._queue)
+            if job.state != "queued":
+                # 排队期间已被取消
+                continue
+            job.state = "running"
+            job.started_at = time.time()
+            self.running += 1
+            job.task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job: DebateJob):
+        try:
+            if job.notified:
+                await job.room.broadcast({"type": "queue", "job_id": job.id, "position": 0, "queued": self.queued})
+            await job.run()
+            job.state = "done"
+        except asyncio.CancelledError:
+            job.state = "cancelled"
+            await self._announce_cancel(job)
+        except Exception as e:
+            job.state = "failed"
+            print(f"Debate {job.id} failed: {e}")
+            # 告诉客户端辩论已经结束，否则界面会一直停在"辩论中"
+            try:
+                await self._announce_end(job, f"⚠️ 辩论出错: {e}", failed=True)
+            except Exception as notify_err:
+                print(f"Debate {job.id} failure notice failed: {notify_err}")
+        finally:
+            self.running -= 1
+            self._finish(job)
+            self._dispatch()
+            await self._notify_positions()
+
+    def _finish(self, job: DebateJob):
+        self.jobs.pop(job.id, None)
+        job.room.active_debates -= 1
+        remaining = self._client_jobs.get(job.client, 1) - 1
+        if remaining > 0:
+            self._client_jobs[job.client] = remaining
+        else:
+            self._client_jobs.pop(job.client, None)
+
+    async def _notify_positions(self):
+        """告诉每个排队中的房间当前排在第几位"""
+        waiting = sorted((entry for entry in self._queue if entry[2].state == "queued"), key=lambda e: e[:2])
+        for position, (_, _, job) in enumerate(waiting, start=1):
+            job.notified = True
+            await job.room.broadcast({"type": "queue", "job_id": job.id, "position": position, "queued": len(waiting)})
+
+    async def _announce_cancel(self, job: DebateJob):
+        await self._announce_end(job, "⛔ 辩论已被管理员取消", cancelled=True)
+
+    async def _announce_end(self, job: DebateJob, notice: str, **complete):
+        """辩论中途结束（取消或出错）时通知房间"""
+        room = job.room
+        # 结束被中断的流式消息，客户端不会一直显示"正在输入"
+        for stream, (data, _) in list(room.streaming.items()):
+            agent = data.get("name")
+            await room.broadcast({"type": "typing", "agent": agent, "status": False})
+            await room.broadcast({"type": "stream_end", "agent": agent, "stream": stream})
+        await room.broadcast({"type": "message", "data": {"role": "system", "content": notice}})
+        await room.broadcast({"type": "debate_complete", **complete})
+
+    async def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        if job.state == "queued":
+            # 堆里的条目在出队时跳过
+            job.state = "cancelled"
+            self._finish(job)
+            await job.room.broadcast({"type": "message", "data": {"role": "system", "content": "⛔ 排队中的辩论已被取消"}})
+            await job.room.broadcast({"type": "debate_complete", "cancelled": True})
+            await self._notify_positions()
+        elif job.task is not None:
+            job.task.cancel()
+        return True
+
+    def list(self) -> List[dict]:
+        return [job.as_dict() for job in sorted(self.jobs.values(), key=lambda j: j.created_at)]
+
+
+class ProviderLimiter:
+    """每个 Provider 的并发上限；上限由 rate_limit 按上游的 429 自适应调整，最大为 PROVIDER_MAX_CONCURRENT"""
+
+    @asynccontextmanager
+    async def slot(self, provider: str):
+        concurrency = rate_limits.get(provider).concurrency
+        await concurrency.acquire()
+        try:
+            yield
+        finally:
+            await concurrency.release()
+
+    def stats(self) -> Dict[str, dict]:
+        return rate_limits.stats()
@@ -1,7 +1,12 @@
 from typing import List, Optional, Literal
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+import os
 import time
 
+# 一场辩论的轮数和参与模型数上限，REST 请求超出时返回 422，WebSocket 请求按上限截断
+DEBATE_MAX_ROUNDS = int(os.environ.get("DEBATE_MAX_ROUNDS", "10"))
+DEBATE_MAX_AGENTS = int(os.environ.get("DEBATE_MAX_AGENTS", "8"))
+
 class Message(BaseModel):
     role: str  # "user", "assistant" (for generic AI), or specific agent names like "Claude", "ChatGPT", "DeepSeek"
     name: Optional[str] = None # 具体显示的名称，例如 "DeepSeek V3"
@@ -10,9 +15,14 @@ class Message(BaseModel):
 
 class DebateRequest(BaseModel):
     topic: str
-    selected_agents: List[str] # ["gpt-4o", "claude-3-5-sonnet", "deepseek-chat", "grok-beta"]
-    rounds: int = 3 # 讨论轮数
+    selected_agents: List[str] = Field([], max_length=DEBATE_MAX_AGENTS) # ["gpt-4o", "claude-3-5-sonnet", "deepseek-chat", "grok-beta"]，为空时使用已配置 Key 的模型
+    rounds: int = Field(3, ge=1, le=DEBATE_MAX_ROUNDS) # 讨论轮数
+    summarizer: str = "deepseek-chat" # 总结者
+    parallel: bool = False # 每轮所有 Agent 同时发言
+    enable_web_search: bool = False # 辩论前联网搜索
 
 class DebateResponse(BaseModel):
-    status: str
+    status: str # "queued" 或 "running"
     message: str
+    id: Optional[str] = None # 辩论 ID（即房间 ID），事件流为 GET /debates/{id}/events，也可用 /ws/debate?room={id} 观看
+    job_id: Optional[str] = None # 调度任务 ID，可用于 DELETE /admin/debates/{job_id}
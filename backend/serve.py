@@ -0,0 +1,23 @@
+"""生产启动入口：与 python -m uvicorn main:app 相同，但 WebSocket 使用调优过的压缩参数（见 ws_protocol.py）
+
+    python serve.py                       # 监听 HOST:PORT，默认 0.0.0.0:8000
+    WEB_CONCURRENCY=4 python serve.py     # 多 worker，需要配合 EVENT_BUS_URL
+
+只信任 FORWARDED_ALLOW_IPS（默认 127.0.0.1，可写网段）中代理发来的 X-Forwarded-For，其余请求按连接地址识别客户端。
+"""
+import os
+
+import uvicorn
+
+from ws_protocol import TunedWebSocketProtocol
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "main:app",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8000")),
+        workers=int(os.environ.get("WEB_CONCURRENCY", "1")),
+        ws=TunedWebSocketProtocol,
+        proxy_headers=True,
+        forwarded_allow_ips=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+    )
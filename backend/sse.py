@@ -0,0 +1,83 @@
+"""Server-Sent Events 订阅：GET /debates/{id}/events
+
+每个房间事件是一条 SSE 消息，data 是与 WebSocket 默认协议相同的 JSON，id 是事件序号（snapshot 为房间当前序号）。
+浏览器的 EventSource 断线重连时自动带上 Last-Event-ID，服务端从环形缓冲补发错过的事件，超出范围时发送快照，
+与 WebSocket 的 ?since= 续传规则相同。没有事件时定期发送注释行，防止代理因空闲断开连接。
+"""
+import asyncio
+import os
+from typing import AsyncIterator, Optional
+
+from rooms import ClientConnection, DebateRoom, encode_frame
+
+# 没有事件时发送保活注释的间隔（秒）
+SSE_KEEPALIVE = float(os.environ.get("SSE_KEEPALIVE", "15"))
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    # nginx 按响应关闭缓冲，事件立即发给客户端
+    "X-Accel-Buffering": "no",
+}
+
+
+def sse_message(event: dict, text: Optional[str] = None) -> str:
+    """一条 SSE 消息；json 编码不含换行，data 只占一行"""
+    if text is None:
+        text = encode_frame(event)
+    seq = event.get("seq")
+    if seq is None:
+        return f"data: {text}\n\n"
+    return f"id: {seq}\ndata: {text}\n\n"
+
+
+class SSEConnection(ClientConnection):
+    """一个 SSE 订阅
+
+    复用 ClientConnection 的有界队列和慢消费者策略，但没有写协程：响应体的生成器直接从队列取出消息。
+    """
+
+    def __init__(self, room: DebateRoom):
+        super().__init__(None, room)
+
+    def start(self):
+        pass
+
+    def encode(self, event: dict) -> str:
+        return sse_message(event)
+
+    def send_event(self, event: dict, encoded: Optional[dict] = None):
+        if encoded is None:
+            self.send(sse_message(event))
+            return
+        # 同一次广播的所有 SSE 订阅共用一份消息，JSON 部分与 WebSocket 连接共用
+        frame = encoded.get("sse")
+        if frame is None:
+            frame = encoded["sse"] = sse_message(event, encoded.get(None))
+        self.send(frame)
+
+    async def _close_socket(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        # 唤醒正在等待的生成器，让响应结束
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def stream(self) -> AsyncIterator[str]:
+        """响应体；客户端断开时 Starlette 取消生成器，在 finally 中退订"""
+        try:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(self.queue.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            self.close()
@@ -0,0 +1,323 @@
+import asyncio
+import os
+import time
+from typing import AsyncGenerator, Dict, List, Optional
+
+from llm_providers import LLMProvider, PromptUsage
+from metrics import STREAM_HEDGES, STREAM_RESUMES, STREAM_TIMEOUTS
+from rate_limit import provider_setting, request_admitted
+
+# stream_delta 合并窗口：距上次发送超过 STREAM_FLUSH_MS 毫秒，或缓冲超过 STREAM_FLUSH_BYTES 字节就发送
+# STREAM_FLUSH_MS=0 表示不合并，每个片段单独发送
+STREAM_FLUSH_MS = float(os.environ.get("STREAM_FLUSH_MS", "40"))
+STREAM_FLUSH_BYTES = int(os.environ.get("STREAM_FLUSH_BYTES", "512"))
+
+# 首 token 超时与流中断（两个 chunk 之间）超时，单位秒，0 表示不限制；
+# 可用 STREAM_TTFT_TIMEOUT_<NAME>、STREAM_STALL_TIMEOUT_<NAME>（如 _DOUBAO）单独设置
+STREAM_TTFT_TIMEOUT = float(os.environ.get("STREAM_TTFT_TIMEOUT", "20"))
+STREAM_STALL_TIMEOUT = float(os.environ.get("STREAM_STALL_TIMEOUT", "30"))
+# 首 token 超时后向备用模型发出对冲请求，先开始输出的一方胜出，例如 "Doubao=deepseek-chat,Qwen=deepseek-chat"
+STREAM_FALLBACKS = os.environ.get("STREAM_FALLBACKS", "")
+# 输出中途失败（断线、上游报错、停顿超时）后，以已输出内容为前缀续写的最大次数，0 表示不续写
+STREAM_RESUME_RETRIES = int(os.environ.get("STREAM_RESUME_RETRIES", "2"))
+
+
+def _parse_fallbacks(value: str) -> Dict[str, str]:
+    fallbacks = {}
+    for item in value.split(","):
+        if "=" in item:
+            provider, model = item.split("=", 1)
+            fallbacks[provider.strip().lower()] = model.strip()
+    return fallbacks
+
+
+_fallbacks = _parse_fallbacks(STREAM_FALLBACKS)
+
+
+def fallback_for(provider_name: str) -> Optional[str]:
+    """Provider 的备用模型（get_provider 的参数），没有配置时返回 None"""
+    return _fallbacks.get(provider_name.lower())
+
+
+class DeltaCoalescer:
+    """把同一个 agent 流里的小片段合并成较少的 stream_delta 帧
+
+    第一个片段立即发送（保证首字延迟），之后按时间窗口或字节数批量发送，
+    close() 会发送剩余内容，调用方应在广播 stream_end 之前调用；
+    cancel() 停掉等待中的定时发送，调用方应在 finally 中调用，流被取消时不会在 stream_end 之后再发出内容。
+    """
+
+    def __init__(self, room, agent: str, stream: Optional[str] = None, flush_ms: Optional[float] = None,
+                 flush_bytes: Optional[int] = None):
+        self.room = room
+        self.agent = agent
+        # stream_start 中的流 ID，同名 agent 并行发言时客户端按它区分
+        self.stream = stream
+        self.interval = (STREAM_FLUSH_MS if flush_ms is None else flush_ms) / 1000
+        self.flush_bytes = STREAM_FLUSH_BYTES if flush_bytes is None else flush_bytes
+        self._parts: List[str] = []
+        self._size = 0
+        self._last_flush = 0.0
+        self._first_sent = False
+        self._timer: Optional[asyncio.Task] = None
+        # 定时任务睡醒后正在执行的那次发送；cancel() 需要连它一起停掉
+        self._sending: Optional[asyncio.Task] = None
+        # 发送串行化：定时发送和 push()/close() 触发的发送不会交叠，帧按内容顺序发出
+        self._lock = asyncio.Lock()
+
+    async def push(self, delta: str):
+        if not delta:
+            return
+        self._parts.append(delta)
+        self._size += len(delta.encode("utf-8"))
+
+        if not self._first_sent or self.interval <= 0 or self._size >= self.flush_bytes:
+            await self.flush()
+            return
+        remaining = self.interval - (time.monotonic() - self._last_flush)
+        if remaining <= 0:
+            await self.flush()
+        elif self._timer is None:
+            # 窗口内没有新片段时也要按时发送，避免上游卡住时内容滞留在缓冲里
+            self._timer = asyncio.create_task(self._flush_later(remaining))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        self._timer = None
+        self._sending = asyncio.current_task()
+        try:
+            await self.flush()
+        finally:
+            self._sending = None
+
+    async def flush(self):
+        # 还在等待的定时发送直接取消；已经在发送的由锁排在前面，本次等它发完再发
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self._parts:
+                return
+            delta = "".join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            self._first_sent = True
+            self._last_flush = time.monotonic()
+            frame = {"type": "stream_delta", "agent": self.agent, "delta": delta}
+            if self.stream is not None:
+                frame["stream"] = self.stream
+            await self.room.broadcast(frame)
+
+    async def close(self):
+        """等进行中的定时发送完成后，发送缓冲中剩余的内容"""
+        await self.flush()
+
+    def cancel(self):
+        """停掉等待中和正在进行的定时发送；缓冲的内容仍由 close() 发送，流被取消时随之丢弃"""
+        for task in (self._timer, self._sending):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self._timer = None
+        self._sending = None
+
+
+class StreamTimeout(Exception):
+    """首 token 或流中途超过了截止时间"""
+
+
+class _Attempt:
+    """一路流式请求：生成器、它自己的用量，以及正在等待的下一个 chunk
+
+    sent_at 是请求发出的时间，首 token 超时从这里算起；请求在限流排队或 429 退避时为 None（计时暂停），
+    sent 在请求发出时置位。不经过 rate_limit 的 Provider 从创建时开始计时。
+    """
+
+    def __init__(self, provider: LLMProvider, messages: List[dict], prefix: str = ""):
+        self.provider = provider
+        self.usage = PromptUsage()
+        self.sent = asyncio.Event()
+        self.sent_at: Optional[float] = None
+        self._admitted(True)
+        if prefix:
+            self.stream = provider.stream_response(messages, usage=self.usage, prefix=prefix).__aiter__()
+        else:
+            self.stream = provider.stream_response(messages, usage=self.usage).__aiter__()
+        # 请求在这个任务里发出，任务创建时复制上下文，限流器通过 request_admitted 通知本请求的状态
+        token = request_admitted.set(self._admitted)
+        try:
+            self.next = asyncio.ensure_future(self.stream.__anext__())
+        finally:
+            request_admitted.reset(token)
+
+    def _admitted(self, sent: bool):
+        if sent:
+            self.sent_at = time.monotonic()
+            self.sent.set()
+        else:
+            self.sent_at = None
+            self.sent.clear()
+
+    async def cancel(self):
+        self.next.cancel()
+        await asyncio.gather(self.next, return_exceptions=True)
+        await self.stream.aclose()
+
+
+class GuardedStream:
+    """带截止时间的流式调用
+
+    首 token 超过 ttft 秒未到（从请求真正发出算起，不含限流排队和 429 退避；或主请求在输出前出错）：配置了备用模型时同时向它发起请求，
+    先输出的一方胜出，另一方被取消；对冲后再等 ttft 秒仍无输出，或没有备用模型，抛出 StreamTimeout。
+    开始输出后两个 chunk 之间超过 stall 秒，同样抛出 StreamTimeout，已输出的内容由调用方保留。
+    推理模型输出推理过程时 Provider 产出的空 chunk 同样算作输出，只是不会出现在回复里。
+    输出中途失败时，以已输出的内容为前缀向同一 Provider 发起续写（最多 STREAM_RESUME_RETRIES 次），
+    续写的内容接在同一个流里，调用方看不出中断；次数用完仍失败才抛出最后一次的异常。
+    各次请求的 token 用量之和在流结束时写入 usage，胜出的 Provider 保存在 self.provider。
+    """
+
+    def __init__(self, provider: LLMProvider, messages: List[dict], usage: Optional[PromptUsage] = None,
+                 fallback: Optional[LLMProvider] = None):
+        self.provider = provider
+        self.messages = messages
+        self.usage = usage
+        self.fallback = fallback if fallback is not None and fallback.name != provider.name else None
+        self.ttft = provider_setting("STREAM_TTFT_TIMEOUT", provider.name, STREAM_TTFT_TIMEOUT)
+        self.stall = provider_setting("STREAM_STALL_TIMEOUT", provider.name, STREAM_STALL_TIMEOUT)
+        self.hedged = False
+        self.resumes = 0
+
+    def __aiter__(self) -> AsyncGenerator[str, None]:
+        return self._chunks()
+
+    async def _wait_first(self, attempts: List[_Attempt]) -> set:
+        """等任意一路返回第一个 chunk，返回已完成的 next；首 token 超时返回空集合
+
+        计时从最后加入的一路真正发出请求开始，它在限流排队或退避时暂停，发出后重新计时。
+        """
+        latest = attempts[-1]
+        while True:
+            waiter = None
+            timeout = None
+            if self.ttft > 0:
+                if latest.sent_at is None:
+                    waiter = asyncio.ensure_future(latest.sent.wait())
+                else:
+                    timeout = latest.sent_at + self.ttft - time.monotonic()
+                    if timeout <= 0:
+                        return set()
+            futures = [a.next for a in attempts] + ([waiter] if waiter is not None else [])
+            try:
+                done, _ = await asyncio.wait(futures, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if waiter is not None:
+                    waiter.cancel()
+            done.discard(waiter)
+            if done:
+                return done
+            # 请求刚发出，或者等待期间进入了退避：按新的状态重新计算截止时间
+
+    async def _first(self) -> tuple:
+        """等到某一路返回第一个 chunk，返回 (胜出的请求, 第一个 chunk)；流为空时 chunk 为 None"""
+        attempts = [_Attempt(self.provider, self.messages)]
+        winner = None
+        try:
+            while True:
+                done = await self._wait_first(attempts)
+                if not done:
+                    STREAM_TIMEOUTS.labels(self.provider.name, "ttft").inc()
+                    if self.hedged or self.fallback is None:
+                        raise StreamTimeout(f"{self.provider.name} 超过 {self.ttft:g} 秒没有返回首个 token")
+                    self._hedge(attempts, "ttft")
+                    continue
+                for attempt in [a for a in attempts if a.next in done]:
+                    error = attempt.next.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        winner = attempt
+                        return attempt, attempt.next.result() if error is None else None
+                    attempts.remove(attempt)
+                    await attempt.cancel()
+                    if not attempts:
+                        if self.hedged or self.fallback is None:
+                            raise error
+                        self._hedge(attempts, "error")
+        finally:
+            for attempt in attempts:
+                if attempt is not winner:
+                    await attempt.cancel()
+
+    def _hedge(self, attempts: List[_Attempt], reason: str):
+        print(f"[Hedge] {self.provider.name} {reason}, also asking {self.fallback.name}")
+        self.hedged = True
+        attempts.append(_Attempt(self.fallback, self.messages))
+
+    async def _next(self, attempt: _Attempt) -> str:
+        if self.stall <= 0:
+            return await attempt.stream.__anext__()
+        try:
+            return await asyncio.wait_for(attempt.stream.__anext__(), self.stall)
+        except asyncio.TimeoutError:
+            STREAM_TIMEOUTS.labels(attempt.provider.name, "stall").inc()
+            raise StreamTimeout(f"{attempt.provider.name} 超过 {self.stall:g} 秒没有新的输出")
+
+    async def _resume(self, prefix: str) -> tuple:
+        """以 prefix 为前缀向同一 Provider 续写，返回 (续写请求, 第一个 chunk)"""
+        attempt = _Attempt(self.provider, self.messages, prefix)
+        try:
+            if not await self._wait_first([attempt]):
+                STREAM_TIMEOUTS.labels(self.provider.name, "ttft").inc()
+                raise StreamTimeout(f"{self.provider.name} 续写超过 {self.ttft:g} 秒没有返回首个 token")
+            chunk = attempt.next.result()
+        except StopAsyncIteration:
+            # 续写没有新内容：上一次其实已经写完了
+            chunk = None
+        except BaseException:
+            await attempt.cancel()
+            raise
+        return attempt, chunk
+
+    def _add_usage(self, attempt: _Attempt):
+        if self.usage is not None:
+            self.usage.prompt_tokens += attempt.usage.prompt_tokens
+            self.usage.cached_tokens += attempt.usage.cached_tokens
+            self.usage.completion_tokens += attempt.usage.completion_tokens
+
+    async def _chunks(self) -> AsyncGenerator[str, None]:
+        attempt, chunk = await self._first()
+        if self.hedged:
+            STREAM_HEDGES.labels(self.provider.name, "fallback" if attempt.provider is self.fallback else "primary").inc()
+        self.provider = attempt.provider
+        output: List[str] = []
+        try:
+            while True:
+                try:
+                    while chunk is not None:
+                        output.append(chunk)
+                        yield chunk
+                        try:
+                            chunk = await self._next(attempt)
+                        except StopAsyncIteration:
+                            chunk = None
+                    break
+                except Exception as e:
+                    error = e
+                # 输出中途失败：以已输出的内容为前缀续写，续写请求本身失败也计入次数
+                self._add_usage(attempt)
+                await attempt.stream.aclose()
+                while True:
+                    if self.resumes >= STREAM_RESUME_RETRIES:
+                        if self.resumes:
+                            STREAM_RESUMES.labels(self.provider.name, "failed").inc()
+                        raise error
+                    self.resumes += 1
+                    print(f"[Resume] {self.provider.name} failed after {sum(len(c) for c in output)} chars "
+                          f"({type(error).__name__}: {error}), continuing ({self.resumes}/{STREAM_RESUME_RETRIES})")
+                    try:
+                        attempt, chunk = await self._resume("".join(output))
+                        break
+                    except Exception as e:
+                        error = e
+            self._add_usage(attempt)
+            if self.resumes:
+                STREAM_RESUMES.labels(self.provider.name, "ok").inc()
+        finally:
+            await attempt.stream.aclose()
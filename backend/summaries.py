@@ -0,0 +1,76 @@
+"""滚动的每轮概要：辩论进行时在后台压缩已结束的轮次，最终总结只读概要和最后一轮
+
+第 N 轮结束后立即在后台把这一轮的发言压缩成一段短概要（与第 N+1 轮的辩论同时进行），
+总结时的输入 = 辩题 + 前面各轮的概要 + 最后一轮的原始发言，不再随轮数线性增长，
+总结的首 token 延迟和输入 token 数基本不受轮数影响。某一轮的概要失败或在 ROUND_DIGEST_TIMEOUT 内没有完成时，
+退回使用这一轮的原始发言。
+"""
+import asyncio
+import os
+from typing import Dict, List, Optional
+
+from llm_providers import LLMProvider
+
+# 为 0 时不生成概要，总结直接读取完整历史
+ROUND_DIGESTS = os.environ.get("ROUND_DIGESTS", "1") == "1"
+# 每轮概要的字数上限（写在提示词里）
+ROUND_DIGEST_CHARS = int(os.environ.get("ROUND_DIGEST_CHARS", "200"))
+# 生成概要使用的模型，为空时使用总结者
+ROUND_DIGEST_MODEL = os.environ.get("ROUND_DIGEST_MODEL", "")
+# 总结开始前等待尚未完成的概要的最长时间（秒，0 不限制），所有轮次共用这一期限
+ROUND_DIGEST_TIMEOUT = float(os.environ.get("ROUND_DIGEST_TIMEOUT", "10"))
+
+
+class RoundDigester:
+    """为一场辩论的各轮生成概要"""
+
+    def __init__(self, provider: LLMProvider, topic: str, limiter=None):
+        self.provider = provider
+        self.topic = topic
+        # 与发言共用 Provider 的并发上限
+        self.limiter = limiter
+        self.rounds: Dict[int, List[dict]] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    def submit(self, round_num: int, messages: List[dict]):
+        """第 round_num 轮结束后调用，立即返回，概要在后台生成"""
+        self.rounds[round_num] = list(messages)
+        self.tasks[round_num] = asyncio.create_task(self._digest(round_num, self.rounds[round_num]))
+
+    async def _digest(self, round_num: int, messages: List[dict]) -> str:
+        prompt = {
+            "role": "user",
+            "name": "System",
+            "content": f"以上是关于「{self.topic}」的第 {round_num} 轮辩论。请用不超过 {ROUND_DIGEST_CHARS} 字概括"
+                       f"本轮各方的核心论点、论据和新出现的分歧，保留发言者名字，只输出概要。"
+        }
+        if self.limiter is None:
+            return await self.provider.generate_response(messages + [prompt])
+        async with self.limiter.slot(self.provider.name):
+            return await self.provider.generate_response(messages + [prompt])
+
+    async def summary_input(self, last_round: List[dict]) -> List[dict]:
+        """总结的输入：辩题、已结束各轮的概要（失败或超时的轮次用原始发言）、最后一轮的原始发言"""
+        messages = [{"role": "user", "name": "User", "content": self.topic}]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ROUND_DIGEST_TIMEOUT
+        for round_num in sorted(self.tasks):
+            digest: Optional[str] = None
+            timeout = max(deadline - loop.time(), 0) if ROUND_DIGEST_TIMEOUT > 0 else None
+            try:
+                # 超时时 wait_for 会取消概要任务
+                digest = await asyncio.wait_for(self.tasks[round_num], timeout)
+            except asyncio.TimeoutError:
+                print(f"[Digest] round {round_num} not ready after {ROUND_DIGEST_TIMEOUT}s, using full transcript")
+            except Exception as e:
+                print(f"[Digest] round {round_num} failed, using full transcript: {e}")
+            if digest:
+                messages.append({"role": "user", "name": f"第 {round_num} 轮概要", "content": digest})
+            else:
+                messages.extend(self.rounds[round_num])
+        messages.extend(last_round)
+        return messages
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
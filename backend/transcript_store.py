@@ -0,0 +1,192 @@
+"""辩论记录的持久化：按房间 ID + 序号追加保存历史消息
+
+只保存写入历史的完整消息（不保存流式增量）。append 只把消息放进内存队列，
+由后台协程攒批后在单独的线程里写入，不会给流式推送增加延迟。
+"""
+import asyncio
+import json
+import os
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, List, Optional, Tuple
+
+# 记录文件路径（相对于后端工作目录）；设为空字符串则只保存在内存里，重启后丢失
+TRANSCRIPT_DB = os.environ.get("TRANSCRIPT_DB", "data/transcripts.db")
+# 每批最多写入的消息数，以及攒批等待的时间
+TRANSCRIPT_BATCH_SIZE = int(os.environ.get("TRANSCRIPT_BATCH_SIZE", "200"))
+TRANSCRIPT_FLUSH_MS = float(os.environ.get("TRANSCRIPT_FLUSH_MS", "500"))
+# 从存储恢复房间时载入内存的最近消息数，更早的消息由客户端按需分页读取
+TRANSCRIPT_RESTORE_MESSAGES = int(os.environ.get("TRANSCRIPT_RESTORE_MESSAGES", "200"))
+
+# 有独立列的字段，其余字段序列化后放进 extra
+_COLUMNS = ("role", "name", "content", "timestamp")
+
+
+class TranscriptStore:
+    """存储接口；默认实现不做持久化"""
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def append(self, room_id: str, seq: int, message: dict):
+        """追加一条消息，不阻塞调用方"""
+        pass
+
+    async def tail(self, room_id: str, limit: int) -> List[Tuple[int, dict]]:
+        """房间最近的 limit 条消息，按序号升序"""
+        return []
+
+    async def page(self, room_id: str, before: int, limit: int) -> List[Tuple[int, dict]]:
+        """序号小于 before 的最近 limit 条消息，按序号升序"""
+        return []
+
+
+class SQLiteTranscriptStore(TranscriptStore):
+    """SQLite（WAL 模式）存储：写入和读取各用一个连接、各在一个线程里执行"""
+
+    def __init__(self, path: str, batch_size: int = TRANSCRIPT_BATCH_SIZE, flush_ms: float = TRANSCRIPT_FLUSH_MS):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        # 待写入的行；append 只往这里追加，写协程被唤醒后整批取走
+        self.pending: Deque[tuple] = deque()
+        self.writer: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closing = False
+        self._write_pool: Optional[ThreadPoolExecutor] = None
+        self._read_pool: Optional[ThreadPoolExecutor] = None
+        self._write_conn: Optional[sqlite3.Connection] = None
+        self._read_conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._write_conn = self._connect()
+        self._write_conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                room_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                name TEXT,
+                content TEXT NOT NULL,
+                timestamp REAL,
+                extra TEXT,
+                PRIMARY KEY (room_id, seq)
+            ) WITHOUT ROWID
+        """)
+        self._write_conn.commit()
+        self._read_conn = self._connect()
+
+    async def start(self):
+        self._write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="transcript-write")
+        self._read_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="transcript-read")
+        await asyncio.get_running_loop().run_in_executor(self._write_pool, self._open)
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self.writer = asyncio.create_task(self._write_loop())
+        if self.pending:
+            self._wakeup.set()
+        print(f"[Transcript] SQLite store at {self.path}")
+
+    async def close(self):
+        # 通知写协程把剩下的消息写完后退出
+        if self.writer is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self.writer
+            self.writer = None
+        for conn in (self._write_conn, self._read_conn):
+            if conn is not None:
+                conn.close()
+        self._write_conn = self._read_conn = None
+        for pool in (self._write_pool, self._read_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+    def append(self, room_id: str, seq: int, message: dict):
+        extra = {k: v for k, v in message.items() if k not in _COLUMNS}
+        self.pending.append((
+            room_id,
+            seq,
+            message.get("role") or "",
+            message.get("name"),
+            message.get("content") or "",
+            message.get("timestamp"),
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+        ))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _take_batch(self) -> list:
+        batch = []
+        while self.pending and len(batch) < self.batch_size:
+            batch.append(self.pending.popleft())
+        return batch
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            # 不够一批时等一会儿，把同一时段的消息合并成一个事务
+            if not self._closing and len(self.pending) < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            while self.pending:
+                batch = self._take_batch()
+                try:
+                    await loop.run_in_executor(self._write_pool, self._write, batch)
+                except Exception as e:
+                    print(f"[Transcript] write failed, {len(batch)} messages dropped: {e}")
+            if self._closing:
+                return
+
+    def _write(self, rows: list):
+        with self._write_conn:
+            self._write_conn.executemany(
+                "INSERT OR REPLACE INTO messages (room_id, seq, role, name, content, timestamp, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def _select(self, sql: str, params: tuple) -> List[Tuple[int, dict]]:
+        rows = self._read_conn.execute(sql, params).fetchall()
+        result = []
+        for seq, role, name, content, timestamp, extra in reversed(rows):
+            message = {"role": role, "name": name, "content": content, "timestamp": timestamp}
+            if extra:
+                message.update(json.loads(extra))
+            result.append((seq, message))
+        return result
+
+    async def tail(self, room_id: str, limit: int) -> List[Tuple[int, dict]]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._read_pool, self._select,
+            "SELECT seq, role, name, content, timestamp, extra FROM messages "
+            "WHERE room_id = ? ORDER BY seq DESC LIMIT ?",
+            (room_id, limit)
+        )
+
+    async def page(self, room_id: str, before: int, limit: int) -> List[Tuple[int, dict]]:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._read_pool, self._select,
+            "SELECT seq, role, name, content, timestamp, extra FROM messages "
+            "WHERE room_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+            (room_id, before, limit)
+        )
+
+
+def create_store() -> TranscriptStore:
+    if not TRANSCRIPT_DB:
+        return TranscriptStore()
+    return SQLiteTranscriptStore(TRANSCRIPT_DB)
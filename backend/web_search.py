@@ -1,12 +1,72 @@
 import asyncio
+import os
+import time
+from collections import OrderedDict
 from ddgs import DDGS
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+from metrics import SEARCH_DURATION
+
+# 搜索结果缓存：TTL 秒后过期，超过容量按最近最少使用淘汰
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "600"))
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "256"))
+# 单次搜索的超时秒数
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", "10"))
+
+class SearchCache:
+    """带 TTL 过期和容量上限（LRU 淘汰）的搜索结果缓存"""
+
+    def __init__(self, ttl: float = SEARCH_CACHE_TTL, max_size: int = SEARCH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[float, List[Dict]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(query: str, max_results: int) -> Tuple[str, int]:
+        """大小写和多余空白不同的同一查询共用一个缓存项"""
+        return " ".join(query.casefold().split()), max_results
+
+    def get(self, key: Tuple[str, int]) -> Optional[List[Dict]]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Tuple[str, int], results: List[Dict]):
+        self._entries[key] = (time.monotonic() + self.ttl, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+# 进程内共享的缓存，各个 WebSearcher 实例共用
+search_cache = SearchCache()
 
 class WebSearcher:
     """联网搜索工具"""
     
-    def __init__(self):
-        pass
+    # 正在进行中的搜索，同一查询并发到达时只请求一次
+    _inflight: Dict[Tuple[str, int], "asyncio.Future"] = {}
+
+    def __init__(self, cache: Optional[SearchCache] = None):
+        self.cache = cache or search_cache
     
     def search(self, query: str, max_results: int = 5) -> List[Dict]:
         """
@@ -33,6 +93,49 @@ class WebSearcher:
             print(f"Search error: {e}")
             return []
     
+    async def asearch(self, query: str, max_results: int = 5, timeout: Optional[float] = None) -> List[Dict]:
+        """
+        异步搜索：先查缓存，未命中时在线程池里执行同步搜索，不阻塞事件循环
+
+        Args:
+            query: 搜索关键词
+            max_results: 最多返回结果数
+            timeout: 超时秒数，默认 SEARCH_TIMEOUT
+
+        Returns:
+            搜索结果列表；超时或失败时返回空列表
+        """
+        key = self.cache.make_key(query, max_results)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        inflight = WebSearcher._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        WebSearcher._inflight[key] = future
+        results: List[Dict] = []
+        outcome = "timeout"
+        started = time.perf_counter()
+        try:
+            results = await asyncio.wait_for(
+                asyncio.to_thread(self.search, query, max_results),
+                timeout=SEARCH_TIMEOUT if timeout is None else timeout
+            )
+            # 失败或无结果不缓存，下次再试
+            if results:
+                self.cache.put(key, results)
+            outcome = "ok" if results else "empty"
+        except asyncio.TimeoutError:
+            print(f"Search timeout: {query}")
+        finally:
+            SEARCH_DURATION.labels(outcome).observe(time.perf_counter() - started)
+            WebSearcher._inflight.pop(key, None)
+            future.set_result(results)
+        return results
+
     def format_search_results(self, results: List[Dict]) -> str:
         """格式化搜索结果为文本"""
         if not results:
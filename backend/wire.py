@@ -0,0 +1,114 @@
+"""/ws/debate 的线上编码
+
+默认（proto=json）每帧是完整的 JSON 对象，老客户端不受影响。客户端连接时可以协商紧凑协议：
+
+    /ws/debate?proto=compact            短键名 + 数字事件类型 + agent 编号，仍是 JSON 文本帧
+    /ws/debate?proto=compact&enc=msgpack 同上，用 MessagePack 编码为二进制帧
+
+紧凑帧只改写顶层字段：键名按 KEY_CODES 缩短，type 换成 EVENT_CODES 中的数字，agent 名字换成编号。
+编号由房间统一分配（同一帧对所有紧凑连接编码结果相同，仍然只编码一次），每个连接第一次遇到某个编号前
+先收到一帧定义 {"t": AGENT_DEFINITION, "i": 编号, "n": 名字}。客户端按相反的映射还原后与默认协议的帧完全一致。
+服务端没有安装 msgpack 时退回紧凑 JSON，session 帧中的 proto / enc 字段是实际生效的协议。
+"""
+import json
+from collections.abc import Mapping
+from typing import Dict, Optional, Union
+
+EVENT_CODES: Dict[str, int] = {
+    "session": 0,
+    "snapshot": 1,
+    "message": 2,
+    "stream_start": 3,
+    "stream_delta": 4,
+    "stream_end": 5,
+    "typing": 6,
+    "round_start": 7,
+    "round_end": 8,
+    "debate_complete": 9,
+    "queue": 10,
+}
+# 连接级的 agent 编号定义帧，不是房间事件，没有序号
+AGENT_DEFINITION = 99
+
+KEY_CODES: Dict[str, str] = {
+    "type": "t",
+    "seq": "s",
+    "agent": "a",
+    "delta": "d",
+    "data": "m",
+    "status": "o",
+    "usage": "u",
+    "round": "r",
+    "total_rounds": "n",
+    "ts": "z",
+    "stream": "k",
+}
+
+EVENT_NAMES = {code: name for name, code in EVENT_CODES.items()}
+KEY_NAMES = {short: key for key, short in KEY_CODES.items()}
+
+Frame = Union[str, bytes]
+
+
+def _plain(obj):
+    # HistoryMessage 等只读映射按普通 dict 编码
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def compact(event: dict, agent_ids: Dict[str, int]) -> dict:
+    """把一帧改写为紧凑形式；agent_ids 中必须已有该帧的 agent"""
+    frame = {}
+    for key, value in event.items():
+        if key == "type":
+            value = EVENT_CODES.get(value, value)
+        elif key == "agent":
+            value = agent_ids[value]
+        frame[KEY_CODES.get(key, key)] = value
+    return frame
+
+
+def expand(frame: dict, agents: Dict[int, str]) -> Optional[dict]:
+    """compact 的逆变换，供 Python 客户端（压测）使用；agent 定义帧写入 agents 并返回 None"""
+    if frame.get("t") == AGENT_DEFINITION:
+        agents[frame["i"]] = frame["n"]
+        return None
+    event = {}
+    for key, value in frame.items():
+        name = KEY_NAMES.get(key, key)
+        if name == "type":
+            value = EVENT_NAMES.get(value, value)
+        elif name == "agent":
+            value = agents.get(value, value)
+        event[name] = value
+    return event
+
+
+class WireCodec:
+    """一个连接协商出的编码方式；key 相同的连接共用同一份编码结果"""
+
+    def __init__(self, encoding: str = "json"):
+        self.encoding = encoding
+        self.key = ("compact", encoding)
+        if encoding == "msgpack":
+            # 只有客户端请求 MessagePack 时才需要安装 msgpack
+            import msgpack
+            self._packer = msgpack.Packer(default=_plain)
+
+    def encode(self, frame: dict) -> Frame:
+        if self.encoding == "msgpack":
+            return self._packer.pack(frame)
+        return json.dumps(frame, ensure_ascii=False, separators=(",", ":"), default=_plain)
+
+
+def negotiate(proto: Optional[str], enc: Optional[str]) -> Optional[WireCodec]:
+    """根据连接参数选择编码；默认协议返回 None"""
+    if proto != "compact":
+        return None
+    if enc == "msgpack":
+        try:
+            return WireCodec("msgpack")
+        except ImportError:
+            print("[Wire] msgpack not installed, falling back to compact JSON")
+    return WireCodec("json")
@@ -0,0 +1,35 @@
+"""调优过的 WebSocket permessage-deflate
+
+uvicorn 开启 permessage-deflate 时使用 zlib 的默认参数（32 KB 窗口、memLevel 8），每个连接的压缩状态约 300 KB。
+辩论的帧都是几十到几百字节的流式片段，压缩率主要来自上下文接管（context takeover，相邻帧共用字典），
+窗口缩小到 4 KB 后压缩率几乎不变，每个连接的内存降到几十 KB。参数可用 WS_DEFLATE_* 环境变量调整。
+
+uvicorn 的命令行只能选择内置的 WebSocket 实现，需要通过 serve.py 或 uvicorn.run(..., ws=TunedWebSocketProtocol) 启动。
+"""
+import os
+
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+# 压缩窗口大小（2 的幂，9-15），以及 zlib 的 memLevel（1-9）和压缩级别（1-9）
+WS_DEFLATE_WINDOW_BITS = int(os.environ.get("WS_DEFLATE_WINDOW_BITS", "12"))
+WS_DEFLATE_MEM_LEVEL = int(os.environ.get("WS_DEFLATE_MEM_LEVEL", "5"))
+WS_DEFLATE_LEVEL = int(os.environ.get("WS_DEFLATE_LEVEL", "6"))
+
+
+def deflate_factory() -> ServerPerMessageDeflateFactory:
+    return ServerPerMessageDeflateFactory(
+        server_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        # 客户端支持时同样限制它的窗口，服务端解压客户端消息的内存也随之减少
+        client_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        compress_settings={"memLevel": WS_DEFLATE_MEM_LEVEL, "level": WS_DEFLATE_LEVEL},
+    )
+
+
+class TunedWebSocketProtocol(WebSocketProtocol):
+    """uvicorn 的 websockets 实现，只替换 permessage-deflate 的参数"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate:
+            self.available_extensions = [deflate_factory()]
@@ -1,6 +1,7 @@
 import React, { useState, useEffect, useRef } from 'react'
 import { Send, Bot, User, Play, Square } from 'lucide-react'
-import { getBackendURL } from './config'
+import { getBackendURL, getBackendHTTPURL } from './config'
+import { WIRE_PARAMS, createDecoder } from './wire'
 
 // Define types for our messages
 interface Message {
@@ -8,6 +9,7 @@ interface Message {
   name?: string
   content: string
   timestamp?: number
+  stream?: string // 流式消息的流 ID
 }
 
 interface TypingStatus {
@@ -25,8 +27,13 @@ function App() {
   const [isDebating, setIsDebating] = useState(false) // 是否正在辩论中
   const [summarizer, setSummarizer] = useState('deepseek-chat') // 总结者
   const [enableWebSearch, setEnableWebSearch] = useState(false) // 联网搜索开关
+  const [parallel, setParallel] = useState(false) // 每轮所有 AI 同时发言
+  const [historyStart, setHistoryStart] = useState(0) // 已加载的最早一条历史消息的序号，大于 0 时可以继续向前加载
+  const [queuePosition, setQueuePosition] = useState(0) // 服务器繁忙时辩论在队列中的位置，0 表示未排队
   
   const wsRef = useRef<WebSocket | null>(null)
+  const lastSeqRef = useRef<number | null>(null) // 最后收到的事件序号，用于断线续传
+  const closingRef = useRef(false) // 组件卸载时不再自动重连
   const messagesEndRef = useRef<HTMLDivElement>(null)
   
   // 可用的 AI 选项
@@ -45,7 +52,14 @@ function App() {
     if (wsRef.current?.readyState === WebSocket.OPEN) return
 
     const backendURL = getBackendURL()
-    const ws = new WebSocket(`${backendURL}/ws/debate`)
+    // 带上房间 ID 和最后收到的序号，重连后只补发错过的事件
+    const roomId = localStorage.getItem('debateRoomId')
+    const params = new URLSearchParams(WIRE_PARAMS)
+    if (roomId) params.set('room', roomId)
+    if (roomId && lastSeqRef.current !== null) params.set('since', String(lastSeqRef.current))
+    const ws = new WebSocket(`${backendURL}/ws/debate?${params.toString()}`)
+    ws.binaryType = 'arraybuffer'
+    const decodeFrame = createDecoder()
     
     ws.onopen = () => {
       console.log('Connected to WebSocket')
@@ -58,7 +72,13 @@ function App() {
     }
 
     ws.onmessage = (event) => {
-      const payload = JSON.parse(event.data)
+      const payload = decodeFrame(event.data)
+      if (payload === null) return
+      if (typeof payload.seq === 'number') {
+        // 重放与实时推送可能衔接处重叠，丢弃已处理过的事件
+        if (payload.type !== 'snapshot' && lastSeqRef.current !== null && payload.seq <= lastSeqRef.current) return
+        lastSeqRef.current = payload.seq
+      }
       handleStreamMessage(payload)
     }
 
@@ -69,6 +89,10 @@ function App() {
         role: 'system',
         content: 'Disconnected from server.'
       }])
+      // 手机切后台等情况会断线，稍后自动重连并续传
+      if (!closingRef.current) {
+        setTimeout(connectWebSocket, 2000)
+      }
     }
 
     ws.onerror = (err) => {
@@ -81,42 +105,70 @@ function App() {
   useEffect(() => {
     connectWebSocket()
     return () => {
+      closingRef.current = true
       wsRef.current?.close()
     }
   }, [])
 
+  // 快照只带最近的历史，更早的消息按需分页读取
+  const loadEarlierMessages = async () => {
+    const roomId = localStorage.getItem('debateRoomId')
+    if (!roomId || historyStart <= 0) return
+    try {
+      const res = await fetch(`${getBackendHTTPURL()}/rooms/${roomId}/messages?before=${historyStart}&limit=50`)
+      const page = await res.json()
+      if (page.messages.length === 0) {
+        setHistoryStart(0)
+        return
+      }
+      setMessages(prev => [...page.messages, ...prev])
+      setHistoryStart(page.has_more ? page.messages[0].seq : 0)
+    } catch (err) {
+      console.error('Failed to load earlier messages:', err)
+    }
+  }
+
   // Handle streaming updates
   const handleStreamMessage = (payload: any) => {
-    if (payload.type === 'round_start') {
+    if (payload.type === 'session') {
+      if (payload.room_id !== localStorage.getItem('debateRoomId')) {
+        // 换了房间，旧的序号不再有效
+        lastSeqRef.current = payload.head_seq
+      }
+      localStorage.setItem('debateRoomId', payload.room_id)
+    } else if (payload.type === 'snapshot') {
+      // 错过的事件太多时，服务端直接发送完整快照
+      setMessages([...payload.history, ...payload.streaming])
+      setHistoryStart(payload.history_start ?? 0)
+    } else if (payload.type === 'queue') {
+      setQueuePosition(payload.position)
+    } else if (payload.type === 'round_start') {
       setCurrentRound(payload.round)
       setIsDebating(true)
+      setQueuePosition(0)
     } else if (payload.type === 'round_end') {
       // Round ended
     } else if (payload.type === 'debate_complete') {
       setIsDebating(false)
       setCurrentRound(0)
+      setQueuePosition(0)
     } else if (payload.type === 'stream_start') {
       const msg = payload.data
-      setMessages(prev => [...prev, { ...msg, isStreaming: true }])
+      setMessages(prev => [...prev, { ...msg, stream: payload.stream, isStreaming: true }])
     } else if (payload.type === 'stream_delta') {
-      const { agent, delta } = payload
+      const { agent, delta, stream } = payload
       setMessages(prev => {
-        // Find last message from this agent
-        const lastMsgIndex = prev.length - 1
-        if (lastMsgIndex === -1) return prev
-        const lastMsg = prev[lastMsgIndex]
-        
-        // Simple check: make sure we are updating the correct agent message. 
-        // Since we process sequentially, the last message should be the one streaming.
-        if (lastMsg.role === 'assistant' && lastMsg.name === agent) {
-           const newMessages = [...prev]
-           newMessages[lastMsgIndex] = {
-             ...lastMsg,
-             content: lastMsg.content + delta
-           }
-           return newMessages
+        // 并行模式下多个 Agent 同时输出（可能同名），按流 ID 找到对应的消息；老服务端没有流 ID 时按 agent 找最近一条
+        let idx = prev.length - 1
+        while (idx >= 0 && !(stream ? prev[idx].stream === stream
+                                    : prev[idx].role === 'assistant' && prev[idx].name === agent)) idx--
+        if (idx === -1) return prev
+        const newMessages = [...prev]
+        newMessages[idx] = {
+          ...prev[idx],
+          content: prev[idx].content + delta
         }
-        return prev
+        return newMessages
       })
     } else if (payload.type === 'stream_end') {
        // Optional: Mark as finished styling
@@ -149,7 +201,8 @@ function App() {
       agents: selectedAgents,
       rounds: rounds, // 传递轮数到后端
       summarizer: summarizer, // 传递总结者到后端
-      enable_web_search: enableWebSearch // 传递联网搜索开关
+      enable_web_search: enableWebSearch, // 传递联网搜索开关
+      parallel: parallel // 并行发言开关
     }
     
     wsRef.current.send(JSON.stringify(payload))
@@ -173,6 +226,12 @@ function App() {
           AI Debate Platform
         </h1>
         <div className="flex items-center gap-4">
+          {/* 排队中 */}
+          {isDebating && queuePosition > 0 && (
+            <div className="text-sm bg-yellow-600 px-3 py-1 rounded-full font-semibold">
+              排队中：第 {queuePosition} 位
+            </div>
+          )}
           {/* 显示当前轮数 */}
           {isDebating && currentRound > 0 && (
             <div className="text-sm bg-blue-600 px-3 py-1 rounded-full font-semibold animate-pulse">
@@ -188,6 +247,16 @@ function App() {
 
       {/* Chat Area */}
       <div className="flex-1 overflow-y-auto p-4 space-y-4">
+        {historyStart > 0 && (
+          <div className="flex justify-center">
+            <button
+              onClick={loadEarlierMessages}
+              className="text-xs text-blue-600 hover:underline"
+            >
+              加载更早的消息
+            </button>
+          </div>
+        )}
         {messages.map((msg, index) => {
           const isUser = msg.role === 'user'
           const isSystem = msg.role === 'system'
@@ -302,6 +371,25 @@ function App() {
               {enableWebSearch ? '✓ 已开启' : '✗ 已关闭'}
             </button>
           </div>
+
+          {/* 并行发言开关 */}
+          <div className="flex items-center gap-2">
+            <label className="text-gray-400 flex items-center gap-1">
+              <span>⚡</span>
+              <span>并行发言:</span>
+            </label>
+            <button
+              onClick={() => setParallel(!parallel)}
+              disabled={isDebating}
+              className={`px-3 py-1 rounded-lg border-2 transition-all ${
+                parallel 
+                  ? 'bg-green-600 border-green-500 text-white' 
+                  : 'bg-gray-700 border-gray-600 text-gray-300'
+              } ${isDebating ? 'opacity-50 cursor-not-allowed' : 'hover:opacity-80 cursor-pointer'}`}
+            >
+              {parallel ? '✓ 已开启' : '✗ 已关闭'}
+            </button>
+          </div>
         </div>
         
         <div className="flex gap-2">
@@ -0,0 +1,88 @@
+// MessagePack 解码：只需要解码服务端（Python msgpack.Packer）发来的帧，不引入额外依赖
+// 支持 nil / bool / 整数 / 浮点 / str / bin / array / map，扩展类型（ext）不会出现在帧中
+
+const textDecoder = new TextDecoder()
+
+export const decode = (bytes: Uint8Array): any => {
+  const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength)
+  let pos = 0
+
+  const str = (length: number) => {
+    const value = textDecoder.decode(bytes.subarray(pos, pos + length))
+    pos += length
+    return value
+  }
+  const bin = (length: number) => {
+    const value = bytes.slice(pos, pos + length)
+    pos += length
+    return value
+  }
+  const array = (length: number) => {
+    const value = new Array(length)
+    for (let i = 0; i < length; i++) value[i] = read()
+    return value
+  }
+  const map = (length: number) => {
+    const value: Record<string, any> = {}
+    for (let i = 0; i < length; i++) {
+      const key = read()
+      value[key] = read()
+    }
+    return value
+  }
+  const uint = (size: number) => {
+    let value: number
+    if (size === 1) value = view.getUint8(pos)
+    else if (size === 2) value = view.getUint16(pos)
+    else if (size === 4) value = view.getUint32(pos)
+    else value = Number(view.getBigUint64(pos))
+    pos += size
+    return value
+  }
+  const int = (size: number) => {
+    let value: number
+    if (size === 1) value = view.getInt8(pos)
+    else if (size === 2) value = view.getInt16(pos)
+    else if (size === 4) value = view.getInt32(pos)
+    else value = Number(view.getBigInt64(pos))
+    pos += size
+    return value
+  }
+
+  const read = (): any => {
+    const type = bytes[pos++]
+    if (type <= 0x7f) return type
+    if (type <= 0x8f) return map(type & 0x0f)
+    if (type <= 0x9f) return array(type & 0x0f)
+    if (type <= 0xbf) return str(type & 0x1f)
+    if (type >= 0xe0) return type - 0x100
+    switch (type) {
+      case 0xc0: return null
+      case 0xc2: return false
+      case 0xc3: return true
+      case 0xc4: return bin(uint(1))
+      case 0xc5: return bin(uint(2))
+      case 0xc6: return bin(uint(4))
+      case 0xca: { const value = view.getFloat32(pos); pos += 4; return value }
+      case 0xcb: { const value = view.getFloat64(pos); pos += 8; return value }
+      case 0xcc: return uint(1)
+      case 0xcd: return uint(2)
+      case 0xce: return uint(4)
+      case 0xcf: return uint(8)
+      case 0xd0: return int(1)
+      case 0xd1: return int(2)
+      case 0xd2: return int(4)
+      case 0xd3: return int(8)
+      case 0xd9: return str(uint(1))
+      case 0xda: return str(uint(2))
+      case 0xdb: return str(uint(4))
+      case 0xdc: return array(uint(2))
+      case 0xdd: return array(uint(4))
+      case 0xde: return map(uint(2))
+      case 0xdf: return map(uint(4))
+    }
+    throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`)
+  }
+
+  return read()
+}
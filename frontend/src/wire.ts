@@ -0,0 +1,37 @@
+import { decode } from './msgpack'
+
+// 紧凑协议的解码，映射表与 backend/wire.py 保持一致
+const EVENT_NAMES = [
+  'session', 'snapshot', 'message', 'stream_start', 'stream_delta', 'stream_end',
+  'typing', 'round_start', 'round_end', 'debate_complete', 'queue',
+]
+const AGENT_DEFINITION = 99
+const KEY_NAMES: Record<string, string> = {
+  t: 'type', s: 'seq', a: 'agent', d: 'delta', m: 'data',
+  o: 'status', u: 'usage', r: 'round', n: 'total_rounds', z: 'ts', k: 'stream',
+}
+
+// 连接时带上的协商参数：短键名 + 数字事件类型 + agent 编号，MessagePack 二进制帧
+export const WIRE_PARAMS = { proto: 'compact', enc: 'msgpack' }
+
+// 每个连接一个解码器：agent 编号表只在本连接内有效。返回还原后的帧，agent 定义帧返回 null
+export const createDecoder = () => {
+  const agents = new Map<number, string>()
+  return (data: string | ArrayBuffer): any => {
+    const frame: any = typeof data === 'string' ? JSON.parse(data) : decode(new Uint8Array(data))
+    // 服务端不支持紧凑协议时收到的是默认格式的帧，原样使用
+    if (!('t' in frame)) return frame
+    if (frame.t === AGENT_DEFINITION) {
+      agents.set(frame.i, frame.n)
+      return null
+    }
+    const payload: any = {}
+    for (const [key, value] of Object.entries(frame)) {
+      const name = KEY_NAMES[key] ?? key
+      if (name === 'type') payload.type = typeof value === 'number' ? EVENT_NAMES[value] : value
+      else if (name === 'agent') payload.agent = agents.get(value as number) ?? value
+      else payload[name] = value
+    }
+    return payload
+  }
+}